@@ -0,0 +1,113 @@
+from c_ast.lex import Lexer
+from c_ast.parse import Parser
+from c_ast.semantics import Checker
+from ir.ir_tac import TAC
+from ir.ir_tacvm import TACVM
+from ir.ir_passes import get_default_pass_manager
+from ir.ir_tac_parse import parse_tac
+from ir.ir_profile import VMProfiler
+from ir.ir_jit import TACJIT
+from ir.ir_batch import BatchedVM, NotBatchable
+import time
+
+# compares TACVM runs of each input before and after the selected passes.
+# .tac inputs (main.py --emit tac) skip the front end. the printed form of both tacs is
+# parsed back and has to run to the same result
+
+ir_passes = get_default_pass_manager().get_optimization_names()
+
+def build_tac(source_file: str, is_tac: bool = False) -> TAC:
+    if is_tac:
+        return parse_tac(source_file)
+
+    result = Parser(Lexer(source_file).tokenize(), source_file).parse()
+    Checker().check_source_file(result)
+    tac = TAC()
+    tac.tac_source_file(result)
+    return tac
+
+def check_round_trip(tac_text: str, return_val: object, input_file: str):
+    vm = TACVM(parse_tac(tac_text))
+    vm.run()
+    assert vm.return_val == return_val, f"{input_file}: printed tac returns {vm.return_val}, not {return_val}"
+
+def time_vm(tac: TAC, interpret: bool = False, jit: bool = False):
+    # includes preparing the closures, or translating and compiling the functions
+    vm = TACVM(tac)
+    start = time.perf_counter()
+    if jit:
+        TACJIT(vm).run()
+    else:
+        vm.run(interpret)
+    return vm, time.perf_counter() - start
+
+if __name__ == "__main__":
+    import argparse
+    argp = argparse.ArgumentParser(prog="bench", description="Benchmark TAC passes on the IR VM")
+    argp.add_argument("input_files", type=str, nargs="+")
+    argp.add_argument("-p", "--passes", type=str, nargs="*", default=ir_passes, choices=ir_passes)
+    argp.add_argument("--time-passes", action="store_true", help="print per pass stats for every input")
+    argp.add_argument("--verify-ir", action="store_true", help="check the TAC after every pass")
+    argp.add_argument("--interpret", action="store_true", help="time the VM's instruction by instruction interpreter instead of its prepared closures")
+    argp.add_argument("--jit", action="store_true", help="time the VM running python functions translated from the TAC")
+    argp.add_argument("--batch", type=int, default=None, metavar="LANES", help="also run the optimized tac on this many lanes at once with numpy")
+    argp.add_argument("--profile", action="store_true", help="print where the optimized run spends its instructions")
+    argp.add_argument("--flamegraph", type=str, default=None, help="write the optimized runs' call stacks here, in collapsed stack format")
+
+    opt = argp.parse_args()
+    collapsed_stacks = []
+    print(f"{'file':<32} {'ins':>6} {'ins opt':>8} {'steps':>9} {'steps opt':>10} {'depth':>6} {'depth opt':>10} {'branches':>9} {'branches opt':>13} {'time':>9} {'time opt':>9}")
+    for input_file in opt.input_files:
+        with open(input_file, 'r') as f:
+            source_file = f.read()
+
+        # printed before running, since runs give the stack slots addresses
+        base_tac = build_tac(source_file, input_file.endswith(".tac"))
+        base_text = base_tac.pretty_tac_ir()
+        base_vm, base_time = time_vm(base_tac, opt.interpret, opt.jit)
+
+        pass_manager = get_default_pass_manager(opt.verify_ir, opt.time_passes)
+        if input_file.endswith(".tac"):
+            pass_manager.tac = parse_tac(source_file)
+        else:
+            pass_manager.ast = Parser(Lexer(source_file).tokenize(), source_file).parse()
+            pass_manager.run_pass("check")
+            pass_manager.run([name for name in opt.passes if pass_manager.passes[name].ir == "ast"])
+            pass_manager.lower_to_tac()
+        pass_manager.run([name for name in opt.passes if pass_manager.passes[name].ir == "tac"])
+        tac = pass_manager.tac
+        opt_text = tac.pretty_tac_ir()
+        opt_vm, opt_time = time_vm(tac, opt.interpret, opt.jit)
+
+        assert base_vm.return_val == opt_vm.return_val, f"{input_file}: {base_vm.return_val} != {opt_vm.return_val}"
+        check_round_trip(base_text, base_vm.return_val, input_file)
+        check_round_trip(opt_text, opt_vm.return_val, input_file)
+        print(f"{input_file:<32} {len(base_vm.tac.ir_code):>6} {len(tac.ir_code):>8} {base_vm.steps:>9} {opt_vm.steps:>10} " + \
+              f"{base_vm.max_call_depth:>6} {opt_vm.max_call_depth:>10} {base_vm.branches:>9} {opt_vm.branches:>13} " + \
+              f"{base_time*1000:>7.2f}ms {opt_time*1000:>7.2f}ms")
+        if opt.time_passes:
+            print(pass_manager.pretty_stats())
+
+        if opt.batch:
+            batched_vm = BatchedVM(tac)
+            try:
+                start = time.perf_counter()
+                return_vals = batched_vm.run(lanes=opt.batch)
+                batch_time = time.perf_counter() - start
+                assert all(val == opt_vm.return_val for val in return_vals), f"{input_file}: batched run differs"
+                print(f"  batched x{opt.batch}: {batched_vm.lane_steps} lane steps in {batch_time*1000:.2f}ms, " + \
+                      f"{batched_vm.lane_steps / batch_time / 1e6:.1f}M per second")
+            except NotBatchable as e:
+                print(f"  batched x{opt.batch}: {e}")
+
+        # a separate run, so the timings above stay unprofiled
+        if opt.profile or opt.flamegraph:
+            profiler = VMProfiler(TACVM(tac))
+            profiler.run()
+            if opt.profile:
+                print(profiler.pretty_report())
+            collapsed_stacks.append(profiler.get_collapsed_stacks(root=input_file))
+
+    if opt.flamegraph:
+        with open(opt.flamegraph, 'w') as f:
+            f.write('\n'.join(collapsed_stacks) + '\n')
@@ -10,8 +10,8 @@ class Lexer:
         self.p = 0
         self.code = code
 
-    def advance(self):
-        self.p += 1
+    def advance(self, n: int = 1):
+        self.p += n
 
     def has_next(self) -> bool:
         return self.p < len(self.code)
@@ -150,13 +150,24 @@ class Lexer:
                 return self.create_token("less_than", "<")
         
         elif curr_char == "&":
-            # add short circuiting bit ops later
-            self.advance()
-            return self.create_token("ampersand", curr_char)
+            if self.peek_char() == "&":
+                self.advance(2)
+                return self.create_token("logical_and", "&&")
+            else:
+                self.advance()
+                return self.create_token("ampersand", curr_char)
 
         elif curr_char == "|":
+            if self.peek_char() == "|":
+                self.advance(2)
+                return self.create_token("logical_or", "||")
+            else:
+                self.advance()
+                return self.create_token("pipe", curr_char)
+
+        elif curr_char == "!":
             self.advance()
-            return self.create_token("pipe", curr_char)
+            return self.create_token("bang", curr_char)
             
         elif curr_char == '*':
             self.advance()
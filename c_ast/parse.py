@@ -3,10 +3,10 @@ from c_ast.pland_ast import *
 from c_ast.lex import LexicalToken
 
 valid_expr_start = ["literal_decimal", "literal_integer", "identifier", "left_paren",
-                    "minus", "ampersand", "star"]
+                    "minus", "ampersand", "star", "bang"]
 valid_stmt_start_tokens = ["left_brace", "right_brace", "return", "while", "if", 
                            "identifier", "struct", "unsigned", "literal_decimal", 
-                           "literal_integer", "left_paren", "minus", "ampersand", "star"]
+                           "literal_integer", "left_paren", "minus", "ampersand", "star", "bang"]
 integral_types = ["char", "short", "int", "long"] # must take care of unsigned in ast
 float_types = ["float", "double"]
 basic_types = integral_types + float_types
@@ -166,7 +166,7 @@ error: {msg}""")
         return self.tag_ast_with_debug(left)
 
     def parse_unary(self):
-        while self.at_tok_type() in ["minus", "star", "ampersand"]:
+        while self.at_tok_type() in ["minus", "star", "ampersand", "bang"]:
             unary_op = self.at_tok_type()
             self.advance()
             if unary_op == "minus":
@@ -175,6 +175,8 @@ error: {msg}""")
                 return self.tag_ast_with_debug(OpUnaryNode("deref", self.parse_unary()))
             elif unary_op == "ampersand":
                 return self.tag_ast_with_debug(OpUnaryNode("ref", self.parse_unary()))
+            elif unary_op == "bang":
+                return self.tag_ast_with_debug(OpUnaryNode("not", self.parse_unary()))
         
         return self.tag_ast_with_debug(self.parse_dot())
     
@@ -229,8 +231,26 @@ error: {msg}""")
         
         return self.tag_ast_with_debug(left)
     
+    def parse_logical_and(self):
+        left = self.parse_bitwise()
+
+        while self.has_next() and self.at_tok_type() == "logical_and":
+            self.advance()
+            left = OpBinaryNode("logical_and", left, self.parse_bitwise())
+
+        return self.tag_ast_with_debug(left)
+
+    def parse_logical_or(self):
+        left = self.parse_logical_and()
+
+        while self.has_next() and self.at_tok_type() == "logical_or":
+            self.advance()
+            left = OpBinaryNode("logical_or", left, self.parse_logical_and())
+
+        return self.tag_ast_with_debug(left)
+
     def parse_expr(self):
-        return self.tag_ast_with_debug(self.parse_bitwise())
+        return self.tag_ast_with_debug(self.parse_logical_or())
     
     def parse_stmt_return(self):
         self.parser_assert(self.at_tok_type() == "return", "return statement start")
@@ -81,7 +81,7 @@ class OpBinaryNode(TypeableASTNode):
     def __str__(self) -> str:
         op = { "add": '+', "sub": '-', "mul": "*", "div": "/", "equality": "==", 
               "less_than": '<', "less_than_equal": "<=", "greater_than": '>', "greater_than_equal": ">=",
-               "bit_and": '&', "bit_or": '|' }[self.op]
+               "bit_and": '&', "bit_or": '|', "logical_and": "&&", "logical_or": "||" }[self.op]
         return f"{paren_exprs(self.val1)} {op} {paren_exprs(self.val2)}"
     
     def pretty_ast(self) -> str:
@@ -96,7 +96,7 @@ class OpUnaryNode(TypeableASTNode):
     val: object
 
     def __str__(self) -> str:
-        op = { "neg": '-', "deref": "*", "ref": "&" }[self.op]
+        op = { "neg": '-', "deref": "*", "ref": "&", "not": "!" }[self.op]
         return f"{op}{paren_exprs(self.val)}"
     
     def pretty_ast(self) -> str:
@@ -230,3 +230,15 @@ class SourceFileNode(ASTNode):
     
     def pretty_ast(self) -> str:
         return '\n'.join(map(indent_newlines, [x.pretty_ast() for x in self.fun_defs]))
+
+def get_address_taken(node: ASTNode) -> Set[str]:
+    # ir names of the variables & is applied to, those need a stack slot
+    if isinstance(node, OpUnaryNode) and node.op == "ref" and isinstance(node.val, VarNode):
+        return { node.val.get_ir_name() }
+
+    names = set()
+    for val in vars(node).values():
+        for child in (val if isinstance(val, list) else [val]):
+            if isinstance(child, ASTNode):
+                names |= get_address_taken(child)
+    return names
@@ -9,10 +9,10 @@ type_hierarchy = {
 # manages scoping, definitions, and types in scope within a function definition
 # also used for checking function definition return type
 class BlockContext:
-    def __init__(self, expected_return_type) -> None:
+    def __init__(self, expected_return_type, variable_idx: int = 0) -> None:
         self.block_idx = 0
         self.return_type = expected_return_type
-        self.variable_idx = 0
+        self.variable_idx = variable_idx
 
         self.block_idx_to_vardict: List[Dict[str, VarNode]] = [{}]
         self.function_locals = []
@@ -59,6 +59,9 @@ class Checker:
         self.function_to_type = {}
         # for function signature to verify parameter types
         self.function_name_to_ast: Dict[str, FunDefNode] = {}
+        # ir names number variables across the whole file, since the ir keeps one map of
+        # variable locations for every function
+        self.variable_idx = 0
 
     @staticmethod
     def cmp_expr_type(expr_type, expected_type):
@@ -111,6 +114,12 @@ class Checker:
             expr_left_type = self.get_expr_type(expr.val1, block_ctx)
             expr_right_type = self.get_expr_type(expr.val2, block_ctx)
 
+            if expr.op in ["logical_and", "logical_or"]:
+                # each side is only tested against zero, so they don't need the same type
+                for operand_type in [expr_left_type, expr_right_type]:
+                    assert operand_type in integral_types or operand_type == "any number", f"cannot apply {expr.op} on nonintegral type"
+                return "int"
+
             # promote nodes
             expr.val1 = self.get_as_promoted(expr.val1, expr_right_type)
             expr.val2 = self.get_as_promoted(expr.val2, expr_left_type)
@@ -131,6 +140,9 @@ class Checker:
             elif expr.op == "deref":
                 assert operand_type[-1] == '*', "pointer required for * deref"
                 return operand_type[:-1]
+            elif expr.op == "not":
+                assert operand_type in integral_types or operand_type == "any number", "cannot apply logical not on nonintegral type"
+                return "int"
 
             return operand_type
         
@@ -224,7 +236,7 @@ class Checker:
         block_ctx.pop_block_idx()
 
     def check_fun_def(self, fun_def: FunDefNode):
-        block_ctx = BlockContext(fun_def.fun_type)
+        block_ctx = BlockContext(fun_def.fun_type, self.variable_idx)
 
         self.function_to_type[fun_def.fun_name] = fun_def.fun_type
         self.function_name_to_ast[fun_def.fun_name] = fun_def
@@ -236,6 +248,7 @@ class Checker:
         self.check_stmt_block(fun_def.body, block_ctx, new_block=False)
 
         fun_def.set_locals(block_ctx.function_locals)
+        self.variable_idx = block_ctx.variable_idx
         
     def check_source_file(self, src_file: SourceFileNode):
         for fun_def in src_file.fun_defs:
@@ -1,16 +1,25 @@
 from c_ast.pland_ast import *
-from typing import Dict, List
+from typing import Dict, List, Set
 
 # move, jump, jump_if, jump_not, call, ret, add, sub, mul, div, or, and, gt, gte, lt, lte, eq
 integral_types = { "char": 1, "short": 2, "int": 4, "long": 8 }
 floating_types = { "float": 4, "double": 8 }
 
+comparison_codes = { "equality": "e", "less_than": "l", "less_than_equal": "le", "greater_than": "g", "greater_than_equal": "ge" }
+# condition code that holds exactly when the key doesn't
+negated_codes = { "e": "ne", "ne": "e", "l": "ge", "ge": "l", "le": "g", "g": "le", "b": "ae", "ae": "b", "be": "a", "a": "be" }
+# condition code for the same comparison with its operands swapped
+swapped_codes = { "e": "e", "ne": "ne", "l": "g", "g": "l", "le": "ge", "ge": "le", "b": "a", "a": "b", "be": "ae", "ae": "be" }
+# the condition code of a signed comparison for unsigned operands
+unsigned_codes = { "e": "e", "ne": "ne", "l": "b", "le": "be", "g": "a", "ge": "ae" }
+
 def is_unsigned(type_name: str):
     return type_name.startswith("unsigned")
 
 def size_from_type(type_name: str):
     # if it's not an integral or floating type, it's a pointer (no structs, enums, or unions yet), so it's 8 bytes
     word_size = 8
+    type_name = type_name.removeprefix("unsigned ")
     if type_name in integral_types:
         word_size = integral_types[type_name]
     elif type_name in floating_types:
@@ -18,6 +27,35 @@ def size_from_type(type_name: str):
 
     return word_size
 
+reg64_to_reg = {
+    "rax": { 1: "al", 2: "ax", 4: "eax", 8: "rax" },
+    "rbx": { 1: "bl", 2: "bx", 4: "ebx", 8: "rbx" },
+    "rdi": { 1: "dil", 2: "di", 4: "edi", 8: "rdi" },
+    "rsi": { 1: "sil", 2: "si", 4: "esi", 8: "rsi" },
+    "rdx": { 1: "dl", 2: "dx", 4: "edx", 8: "rdx" },
+    "rcx": { 1: "cl", 2: "cx", 4: "ecx", 8: "rcx" },
+    "r8": { 1: "r8b", 2: "r8w", 4: "r8d", 8: "r8" },
+    "r9": { 1: "r9b", 2: "r9w", 4: "r9d", 8: "r9" },
+    "r10": { 1: "r10b", 2: "r10w", 4: "r10d", 8: "r10" },
+    "r11": { 1: "r11b", 2: "r11w", 4: "r11d", 8: "r11" },
+    "r12": { 1: "r12b", 2: "r12w", 4: "r12d", 8: "r12" },
+    "r13": { 1: "r13b", 2: "r13w", 4: "r13d", 8: "r13" },
+    "r14": { 1: "r14b", 2: "r14w", 4: "r14d", 8: "r14" },
+    "r15": { 1: "r15b", 2: "r15w", 4: "r15d", 8: "r15" },
+    "rbp": { 1: "bpl", 2: "bp", 4: "ebp", 8: "rbp" },
+    "rsp": { 1: "spl", 2: "sp", 4: "esp", 8: "rsp" },
+}
+reg_to_reg64 = { reg: reg64 for reg64, regs in reg64_to_reg.items() for reg in regs.values() }
+
+# the type whose memory operands have size bytes
+size_to_type = { 1: "char", 2: "short", 4: "int", 8: "long" }
+
+# registers the default path evaluates expressions in, taken in this order. a call
+# clobbers the scratch ones, so values live across one go in the callee saved ones,
+# which a function saves when it uses them
+scratch_registers = ["r10", "r11"]
+callee_saved_registers = ["rbx", "r12", "r13", "r14", "r15"]
+
 @dataclass
 class VirtualRegister:
     register_name: str
@@ -26,27 +64,18 @@ class VirtualRegister:
     def __str__(self) -> str:
         return self.register_name
     
-    def as_size(self, size=8) -> str:
-        reg_to_reg64 = { }
-        reg64_to_reg = {
-            "rax": { 1: "al", 2: "ax", 4: "eax", 8: "rax" },
-            "rbx": { 1: "bl", 2: "bx", 4: "ebx", 8: "rbx" },
-            "rdi": { 1: "dil", 2: "di", 4: "edi", 8: "rdi" },
-            "rsi": { 1: "sil", 2: "si", 4: "esi", 8: "rsi" },
-            "rdx": { 1: "dl", 2: "dx", 4: "edx", 8: "rdx" },
-            "rcx": { 1: "cl", 2: "cx", 4: "ecx", 8: "rcx" },
-            "r8": { 1: "r8b", 2: "r8w", 4: "r8d", 8: "r8" },
-            "r9": { 1: "r9b", 2: "r9w", 4: "r9d", 8: "r9" },
-        }
-
-        for k in reg64_to_reg:
-            for v in reg64_to_reg[k].values():
-                reg_to_reg64[v] = k
-            
-        reg64 = reg_to_reg64[self.register_name]
+    def as_size(self, size=8) -> "VirtualRegister":
+        # virtual registers keep their name, the allocator picks the sized name of the
+        # physical register it gives them
+        if not self.register_name in reg_to_reg64:
+            return VirtualRegister(self.register_name, word_size=size)
 
+        reg64 = reg_to_reg64[self.register_name]
         return VirtualRegister(reg64_to_reg[reg64][size], word_size=size)
 
+    def is_physical(self) -> bool:
+        return self.register_name in reg_to_reg64
+
 class Immediate: pass # just so vscode gives me the green color
 Immediate = int | float
 
@@ -83,6 +112,17 @@ class MemoryLocation:
 class Operand: pass
 Operand = Immediate | VirtualRegister | MemoryLocation
 
+def operand_size(operand: Operand) -> int:
+    if isinstance(operand, MemoryLocation):
+        return size_from_type(operand.val_type)
+    elif isinstance(operand, VirtualRegister):
+        return operand.word_size
+    return 8
+
+def fits_imm32(val: Immediate) -> bool:
+    # most instructions only take a sign extended 32 bit immediate, mov to a register is the exception
+    return not isinstance(val, int) or -2**31 <= val < 2**31
+
 @dataclass
 class X86Instruction: pass
 
@@ -99,6 +139,22 @@ class Move(TypedInstruction):
     def __str__(self) -> str:
         return f"mov {self.dest}, {self.src}"
 
+@dataclass
+class MoveExtend(TypedInstruction):
+    # fills all 8 bytes of the dest register from a smaller src
+    dest: Operand
+    src: Operand
+    signed: bool = True
+
+    def __str__(self) -> str:
+        size = operand_size(self.src)
+        if size == 4 and not self.signed:
+            # writing a 4 byte register clears the upper half
+            return f"mov {self.dest.as_size(4)}, {self.src}"
+
+        op = "movsxd" if size == 4 else ("movsx" if self.signed else "movzx")
+        return f"{op} {self.dest}, {self.src}"
+
 @dataclass
 class SetCmp(TypedInstruction):
     op: str
@@ -107,6 +163,15 @@ class SetCmp(TypedInstruction):
     def __str__(self) -> str:
         return f"set{self.op} {self.dest}"
 
+@dataclass
+class JumpCmp(X86Instruction):
+    # conditional jump on the flags of the last cmp, op is the condition code like SetCmp's
+    op: str
+    dest: Operand
+
+    def __str__(self) -> str:
+        return f"j{self.op} {self.dest}"
+
 @dataclass
 class Jump(X86Instruction):
     dest: Operand
@@ -132,6 +197,8 @@ class JumpIfNot(X86Instruction):
 @dataclass 
 class Call(X86Instruction):
     target: Operand
+    # how many of the arg registers hold args
+    register_args: int = 0
 
     def __str__(self) -> str:
         return f"call {self.target}"
@@ -169,6 +236,23 @@ class Arithmetic(X86Instruction):
     def __str__(self) -> str:
         return f"{self.op} {self.dest}, {self.src}"
 
+@dataclass
+class SignExtend(X86Instruction):
+    # rdx:rax = rax sign extended (edx:eax for 4 bytes), for idiv
+    word_size: int = 8
+
+    def __str__(self) -> str:
+        return "cdq" if self.word_size == 4 else "cqo"
+
+@dataclass
+class Divide(X86Instruction):
+    # rax = rdx:rax / src, rdx = the remainder
+    op: str
+    src: Operand
+
+    def __str__(self) -> str:
+        return f"{self.op} {self.src}"
+
 @dataclass
 class LoadEffectiveAddress(X86Instruction):
     dest: Operand
@@ -199,8 +283,20 @@ class LoadEffectiveAddress(X86Instruction):
 
         return f"lea {self.dest}, [{self.base_reg} {offset_sign} {offset}]"
 
+def contains_call(node: ASTNode) -> bool:
+    if isinstance(node, FunCallNode):
+        return True
+
+    for val in vars(node).values():
+        for child in (val if isinstance(val, list) else [val]):
+            if isinstance(child, ASTNode) and contains_call(child):
+                return True
+    return False
+
 class X86VirtCodeGen:
     def __init__(self, use_virt_regs=False) -> None:
+        # with use_virt_regs every value gets its own t<n> register and only variables that
+        # have their address taken live on the stack. x86_regalloc maps them to physical ones
         self.use_virt_regs = use_virt_regs
         self.is_ebx_in_use = False
 
@@ -216,14 +312,28 @@ class X86VirtCodeGen:
         self.rbp = VirtualRegister("rbp")
         self.rax = VirtualRegister("rax")
         self.rbx = VirtualRegister("rbx")
+        self.rdx = VirtualRegister("rdx")
 
         self.arg_registers = [
             VirtualRegister("rdi"), VirtualRegister("rsi"), VirtualRegister("rdx"), 
             VirtualRegister("rcx"), VirtualRegister("r8"), VirtualRegister("r9")
         ]
 
-        # for the sake of my sanity, assume all locals are on the stack
-        self.var_ir_to_location: Dict[str, MemoryLocation] = {}
+        # for the sake of my sanity, assume all locals are on the stack (unless use_virt_regs)
+        self.var_ir_to_location: Dict[str, MemoryLocation | VirtualRegister] = {}
+        # where a return jumps to and the bytes of stack slots so far
+        self.return_label: str = None
+        self.frame_bytes = 0
+
+        # the default path's register pool: the 64 bit names of the registers holding values,
+        # the callee saved ones the function uses (and where it saves them), and the rbp
+        # offsets of its spill slots
+        self.busy_registers: Set[str] = set()
+        self.register_saves: Dict[str, MemoryLocation] = {}
+        self.spill_offsets: Set[int] = set()
+        self.free_spill_slots: List[MemoryLocation] = []
+        # the return type of the function being generated
+        self.fun_type: str = None
 
         self.label_to_ins_idx: Dict[str, int] = {}
         self.ir_code: List[X86Instruction] = []
@@ -242,15 +352,55 @@ class X86VirtCodeGen:
     def advance_label_idx(self):
         self.current_label_idx += 1
 
-    def get_next_temp_register(self, word_size=8) -> VirtualRegister:
+    def get_next_temp_register(self, word_size=8, across_calls=False) -> VirtualRegister:
         if self.use_virt_regs:
             old_id = self.temp_reg_idx
             self.temp_reg_idx += 1
 
             return VirtualRegister(f"t{old_id}")
-        
-        # use ebx probably
-        return self.rbx.as_size(word_size)
+
+        reg_name = self.get_free_register(across_calls)
+        assert reg_name, "out of registers for the expression"
+        self.busy_registers.add(reg_name)
+        if reg_name in callee_saved_registers and not reg_name in self.register_saves:
+            # its slot is only known once the function's spill slots are
+            self.register_saves[reg_name] = None
+        return VirtualRegister(reg_name).as_size(word_size)
+
+    def get_free_register(self, across_calls: bool) -> str | None:
+        # scratch registers cost nothing, callee saved ones a save and a restore the first time
+        saved = [name for name in callee_saved_registers if name in self.register_saves]
+        unsaved = [name for name in callee_saved_registers if not name in self.register_saves]
+        candidates = ([] if across_calls else scratch_registers) + saved + unsaved
+        return next((name for name in candidates if not name in self.busy_registers), None)
+
+    def count_free_registers(self) -> int:
+        return len(scratch_registers) + len(callee_saved_registers) - len(self.busy_registers)
+
+    def is_pool_register(self, operand: Operand) -> bool:
+        return isinstance(operand, VirtualRegister) and reg_to_reg64.get(operand.register_name) in self.busy_registers
+
+    def free_operand(self, operand: Operand):
+        # gives back the pool register or spill slot operand holds, a no-op for variables and
+        # virtual registers
+        if isinstance(operand, VirtualRegister) and operand.is_physical():
+            self.busy_registers.discard(reg_to_reg64[operand.register_name])
+        elif isinstance(operand, MemoryLocation) and operand.location == self.rbp and operand.offset in self.spill_offsets:
+            self.free_spill_slots.append(MemoryLocation(self.rbp, operand.offset, "long"))
+        elif isinstance(operand, MemoryLocation) and isinstance(operand.location, VirtualRegister):
+            self.free_operand(operand.location)
+
+    def x86_spill(self, reg: VirtualRegister) -> MemoryLocation:
+        if self.free_spill_slots:
+            slot = self.free_spill_slots.pop()
+        else:
+            slot = self.get_stack_slot("long")
+            self.spill_offsets.add(slot.offset)
+
+        slot = MemoryLocation(self.rbp, slot.offset, size_to_type[reg.word_size])
+        self.add_instruction(Move(slot, reg))
+        self.free_operand(reg)
+        return slot
 
     def reset_arg_reg_index(self):
         self.arg_reg_idx = 0
@@ -263,7 +413,78 @@ class X86VirtCodeGen:
         self.ir_code.append(instruction)
         self.instruction_idx += 1
 
-    def assign_variable_to_stack(self, var_node: VarNode, location: MemoryLocation):
+    def x86_register(self, val: Operand) -> VirtualRegister:
+        # virtual temps come whole, the move has to be at val's size
+        temp_reg = self.get_next_temp_register(operand_size(val)).as_size(operand_size(val))
+        self.add_instruction(Move(temp_reg, val))
+        return temp_reg
+
+    def x86_operand(self, val: Operand) -> Operand:
+        # immediates that don't fit in 32 bits can only be moved into a register
+        return val if fits_imm32(val) else self.x86_register(val)
+
+    def x86_load(self, location: MemoryLocation) -> VirtualRegister:
+        # in virtual register mode every value fills a whole register, sign or zero extended
+        temp_reg = self.get_next_temp_register()
+        if size_from_type(location.val_type) < 8:
+            self.add_instruction(MoveExtend(temp_reg, location, not is_unsigned(location.val_type)))
+        else:
+            self.add_instruction(Move(temp_reg, location))
+        return temp_reg
+
+    def x86_store(self, dest: MemoryLocation | VirtualRegister, src: Operand):
+        if isinstance(dest, MemoryLocation):
+            src = self.x86_operand(src)
+            if isinstance(src, VirtualRegister):
+                src = src.as_size(size_from_type(dest.val_type))
+        self.add_instruction(Move(dest, src))
+
+    def x86_setcc(self, code: str, result_reg: VirtualRegister):
+        self.add_instruction(SetCmp(code, result_reg.as_size(1)))
+        # setcc only writes the low byte
+        self.add_instruction(MoveExtend(result_reg, result_reg.as_size(1), signed=False))
+
+    def x86_wrap(self, reg: VirtualRegister, val_type: str | None, written_size: int = 8):
+        # extends the bytes val_type keeps over the rest of reg, so a virtual register holds
+        # its value wrapped like a variable of val_type would. writing 4 bytes of a register
+        # already clears its upper half
+        if val_type is None or not val_type.removeprefix("unsigned ") in integral_types:
+            return
+        size = size_from_type(val_type)
+        if size == 8 or (size == 4 and written_size == 4 and is_unsigned(val_type)):
+            return
+        self.add_instruction(MoveExtend(reg, reg.as_size(size), not is_unsigned(val_type)))
+
+    def x86_resize(self, operand: Operand, val_type: str, size: int) -> Operand:
+        # operand as a value of size bytes. smaller values are extended by val_type's
+        # signedness, memory is loaded for that, and bigger ones are cut to their low bytes.
+        # virtual registers always fill 8 bytes
+        if self.use_virt_regs or isinstance(operand, Immediate):
+            return operand
+
+        from_size = operand_size(operand)
+        if isinstance(operand, MemoryLocation):
+            if from_size >= size:
+                return MemoryLocation(operand.location, operand.offset, size_to_type[size])
+            self.free_operand(operand)
+            temp_reg = self.get_next_temp_register(size)
+            self.add_instruction(MoveExtend(temp_reg, operand, not is_unsigned(val_type)))
+            return temp_reg
+
+        if from_size < size:
+            self.add_instruction(MoveExtend(operand.as_size(size), operand, not is_unsigned(val_type)))
+        return operand.as_size(size)
+
+    def x86_in_register(self, operand: Operand, size: int) -> VirtualRegister:
+        # operand in a pool register the caller owns, reusing the one it already has
+        if self.is_pool_register(operand):
+            return operand
+        self.free_operand(operand)
+        temp_reg = self.get_next_temp_register(size)
+        self.add_instruction(Move(temp_reg, operand))
+        return temp_reg
+
+    def assign_variable_to_stack(self, var_node: VarNode, location: MemoryLocation | VirtualRegister):
         var_ir_name = var_node.get_ir_name()
         self.var_ir_to_location[var_ir_name] = location
 
@@ -272,74 +493,285 @@ class X86VirtCodeGen:
         loc = self.var_ir_to_location[var_ir_name]
         return loc
 
+    def get_register_need(self, expr: TypeableASTNode) -> int:
+        # sethi-ullman number of the default path: how many pool registers evaluating expr
+        # into a register takes, when its subexpressions are evaluated heaviest first
+        if isinstance(expr, OpBinaryNode) and expr.op in ["logical_and", "logical_or"]:
+            # the sides are tested one after the other
+            return max(self.get_register_need(expr.val1), self.get_register_need(expr.val2), 1)
+        elif isinstance(expr, OpBinaryNode):
+            left = self.get_register_need(expr.val1)
+            right = self.get_operand_need(expr.val2, expr.op == "div")
+            return left + 1 if left == right else max(left, right)
+        elif isinstance(expr, OpUnaryNode):
+            return max(self.get_register_need(expr.val), 1)
+        elif isinstance(expr, FunCallNode):
+            return self.get_operands_need(expr.args)
+        elif isinstance(expr, TypeCastNode):
+            return self.get_register_need(expr.val)
+        return 1
+
+    def get_operand_need(self, expr: TypeableASTNode, needs_register=False) -> int:
+        # variables of at least 4 bytes and immediates can be the source operand as they are
+        if isinstance(expr, LiteralNode) and fits_imm32(expr.val) and not needs_register:
+            return 0
+        elif isinstance(expr, VarNode) and size_from_type(expr.get_inferred_type()) >= 4:
+            return 0
+        return self.get_register_need(expr)
+
+    def get_operands_need(self, exprs: List[TypeableASTNode]) -> int:
+        # the ones evaluated earlier each keep a register while the later ones are
+        needs = sorted((self.get_register_need(expr) for expr in exprs), reverse=True)
+        return max([1] + [need + idx for idx, need in enumerate(needs)])
+
+    def x86_hold(self, operand: Operand, later_exprs: List[TypeableASTNode]) -> Operand:
+        # keeps operand while later_exprs are evaluated. values live across a call move to a
+        # callee saved register, and when the registers left don't cover what later_exprs
+        # need they go to a spill slot instead
+        across_calls = any(contains_call(expr) for expr in later_exprs)
+        if isinstance(operand, MemoryLocation) and operand.location != self.rbp:
+            # a deref, its address register is as good as the value
+            base_reg = reg_to_reg64[operand.location.register_name]
+            if not (across_calls and base_reg in scratch_registers) and self.count_free_registers() >= self.get_operands_need(later_exprs):
+                return operand
+            operand = self.x86_in_register(operand, operand_size(operand))
+        if not isinstance(operand, VirtualRegister):
+            return operand
+
+        if self.count_free_registers() < self.get_operands_need(later_exprs):
+            return self.x86_spill(operand)
+        if across_calls and reg_to_reg64[operand.register_name] in scratch_registers:
+            if not self.get_free_register(across_calls=True):
+                return self.x86_spill(operand)
+            self.free_operand(operand)
+            saved_reg = self.get_next_temp_register(operand.word_size, across_calls=True)
+            last_ins = self.ir_code[-1]
+            if isinstance(last_ins, Move) and last_ins.dest == operand.as_size(8) and last_ins.src == self.rax:
+                # a call's (or division's) result, copied out of rax straight to where it stays
+                last_ins.dest = saved_reg.as_size(8)
+            else:
+                self.add_instruction(Move(saved_reg, operand))
+            return saved_reg
+        return operand
+
+    def x86_exprs(self, exprs: List[TypeableASTNode]) -> List[Operand]:
+        # evaluates exprs to operands that are all live at the end. the ones with calls go
+        # first so no other value has to live across them, then the ones that need the most
+        # registers, so the values held while evaluating the rest take as few as possible
+        if self.use_virt_regs:
+            return [self.x86_expr(expr) for expr in exprs]
+
+        order = sorted(range(len(exprs)), key=lambda idx: (not contains_call(exprs[idx]), -self.get_register_need(exprs[idx])))
+        operands: List[Operand] = [None] * len(exprs)
+        for order_idx, expr_idx in enumerate(order):
+            operand = self.x86_expr(exprs[expr_idx])
+            operands[expr_idx] = self.x86_hold(operand, [exprs[idx] for idx in order[order_idx + 1:]])
+        return operands
+
     def x86_binary(self, node: OpBinaryNode) -> VirtualRegister:
-        op = { "add": 'add', "sub": 'sub', "mul": "mul", "div": "div", "equality": "e", 
-              "less_than": 'l', "less_than_equal": "le", "greater_than": 'g', "greater_than_equal": "ge",
-               "bit_and": 'and', "bit_or": 'or' }[node.op]
-        
+        if node.op in ["logical_and", "logical_or"]:
+            return self.x86_logical(node)
+
         node_type = node.get_inferred_type()
+        # values below 4 bytes are worked on as ints, like c promotes them
+        word_size = max(size_from_type(node_type), 4)
+        if node.op in comparison_codes:
+            code = self.x86_compare(node)
+            result_reg = self.get_next_temp_register(word_size)
+            self.x86_setcc(code, result_reg)
+            return result_reg
+
+        op = { "add": 'add', "sub": 'sub', "mul": "mul", "div": "div", "bit_and": 'and', "bit_or": 'or' }[node.op]
         if not is_unsigned(node_type):
-            op = { "mul": "imul", "div": "idiv" }.get(op, op)
+            op = { "div": "idiv" }.get(op, op)
+        # the low bytes of a product are the same signed or not, and mul only takes one operand
+        op = { "mul": "imul" }.get(op, op)
+
+        left, right = self.x86_exprs([node.val1, node.val2])
+        left = self.x86_resize(left, node.val1.get_inferred_type(), word_size)
+        right = self.x86_resize(right, node.val2.get_inferred_type(), word_size)
+        if op in ["div", "idiv"] and self.use_virt_regs:
+            # virtual registers are divided whole, their values are extended by their type
+            result_reg = self.x86_divide(op, left, right)
+            self.x86_wrap(result_reg, node_type)
+            return result_reg
+        elif op in ["div", "idiv"]:
+            return self.x86_divide(op, left, right, word_size)
+
+        if op in ["add", "imul", "and", "or"] and not self.is_pool_register(left) and self.is_pool_register(right):
+            # the register right is in can take the result
+            left, right = right, left
+        elif op == "sub" and not self.is_pool_register(left) and self.is_pool_register(right):
+            # left - right is -right + left, as many instructions without another register
+            self.add_instruction(Arithmetic("imul", right, -1))
+            left, right, op = right, left, "add"
+        right = self.x86_operand(right)
+        result_reg = self.x86_in_register(left, word_size)
+        self.add_instruction(Arithmetic(op, result_reg, right))
+        self.free_operand(right)
+        if self.use_virt_regs:
+            self.x86_wrap(result_reg, node_type)
 
-        word_size = size_from_type(node_type)
+        return result_reg
 
-        comparisons = { "l", "e", "le", "g", "ge" }
+    def x86_divide(self, op: str, left: Operand, right: Operand, word_size=8) -> VirtualRegister:
+        # div and idiv divide rdx:rax by a register or memory operand
+        if isinstance(right, Immediate):
+            right = self.x86_register(right).as_size(word_size)
 
-        left, right = self.x86_expr(node.val1), self.x86_expr(node.val2)
-        if op in comparisons:
-            result_reg = self.get_next_temp_register(word_size)
-            self.add_instruction(Arithmetic("cmp", left, right))
-            self.add_instruction(SetCmp(op, result_reg.as_size(1)))
+        self.add_instruction(Move(self.rax.as_size(word_size), left))
+        self.free_operand(left)
+        if op == "idiv":
+            self.add_instruction(SignExtend(word_size))
         else:
-            result_reg = self.get_next_temp_register(word_size)
-            self.add_instruction(Move(result_reg, left))
-            self.add_instruction(Arithmetic(op, result_reg, right))
+            self.add_instruction(Move(self.rdx, 0))
+        self.add_instruction(Divide(op, right))
+        self.free_operand(right)
 
-        return result_reg
+        return self.x86_register(self.rax.as_size(word_size))
 
-    def x86_unary(self, node: OpUnaryNode) -> VirtualRegister | int:
+    def x86_unary(self, node: OpUnaryNode) -> Operand:
         node_type = node.get_inferred_type()
-        size = size_from_type(node_type)
-        result_reg = self.get_next_temp_register(size)
-        
+        word_size = max(size_from_type(node_type), 4)
+
         if node.op == "neg":
-            self.add_instruction(Move(result_reg, self.x86_expr(node.val)))
+            value = self.x86_resize(self.x86_expr(node.val), node.val.get_inferred_type(), word_size)
+            result_reg = self.x86_in_register(value, word_size)
             self.add_instruction(Arithmetic("imul", result_reg, -1))
+            if self.use_virt_regs:
+                self.x86_wrap(result_reg, node_type)
 
         elif node.op == "ref":
             # assert isinstance(node.val, VarNode), "referencing rvalue"
-            expr_reg = self.x86_expr(node.val)
+            expr_reg = self.x86_lvalue(node.val)
+            result_reg = self.get_next_temp_register()
             self.add_instruction(LoadEffectiveAddress(result_reg, expr_reg))
 
+        elif node.op == "deref" and self.use_virt_regs:
+            return self.x86_load(self.x86_lvalue(node))
+
         elif node.op == "deref":
-            expr_reg = self.x86_expr(node.val)
-            if isinstance(expr_reg, Immediate | VirtualRegister):
-                self.add_instruction(Move(result_reg, MemoryLocation(location=expr_reg, val_type="long")))
-            elif isinstance(expr_reg, MemoryLocation):
-                self.add_instruction(Move(result_reg, expr_reg))
-            else:
-                assert False, f"unknown deref on {expr_reg}" 
+            # a memory operand, loaded by whatever uses it
+            return self.x86_lvalue(node)
+
+        elif node.op == "not":
+            code = self.x86_cmp(self.x86_expr(node.val), 0, "e", size_from_type(node.val.get_inferred_type()))
+            result_reg = self.get_next_temp_register(word_size)
+            self.x86_setcc(code, result_reg)
         
         return result_reg
 
-    def x86_funcall(self, node: FunCallNode) -> VirtualRegister:
-        self.reset_arg_reg_index()
-        i = len(node.args) - 1
-        while i >= 0:
-            arg = self.x86_expr(node.args[i])
-            if i >= len(self.arg_registers):
-                # spill it 
-                self.add_instruction(Push(arg))
+    def x86_cmp(self, left: Operand, right: Operand, code: str, word_size: int) -> str:
+        # emits cmp left, right and returns the condition code that tests code on its flags.
+        # cmp can't take an immediate on the left or two memory operands
+        if isinstance(left, Immediate) and not isinstance(right, Immediate):
+            left, right = right, left
+            code = swapped_codes[code]
+        elif isinstance(left, Immediate) or (isinstance(left, MemoryLocation) and isinstance(right, MemoryLocation)):
+            left = self.x86_in_register(left, word_size)
+
+        right = self.x86_operand(right)
+        self.add_instruction(Arithmetic("cmp", left, right))
+        self.free_operand(left)
+        self.free_operand(right)
+        return code
+
+    def x86_compare(self, node: OpBinaryNode) -> str:
+        # cmp of a comparison's operands, at the size of the bigger one, with the unsigned
+        # condition codes when one of them is unsigned
+        val_types = [node.val1.get_inferred_type(), node.val2.get_inferred_type()]
+        word_size = max(size_from_type(val_types[0]), size_from_type(val_types[1]), 4)
+        code = comparison_codes[node.op]
+        if any(is_unsigned(val_type) for val_type in val_types):
+            code = unsigned_codes[code]
+
+        left, right = self.x86_exprs([node.val1, node.val2])
+        left = self.x86_resize(left, val_types[0], word_size)
+        right = self.x86_resize(right, val_types[1], word_size)
+        return self.x86_cmp(left, right, code, word_size)
+
+    def x86_cond_jump(self, cond: TypeableASTNode, label: str, jump_when: bool):
+        # jumps to label when cond is true (or false, with jump_when False) and falls through
+        # otherwise. comparisons jump straight on the flags, and && and || become chains of
+        # jumps so the right side only runs when the left one doesn't decide the result
+        if isinstance(cond, OpUnaryNode) and cond.op == "not":
+            self.x86_cond_jump(cond.val, label, not jump_when)
+
+        elif isinstance(cond, OpBinaryNode) and cond.op in ["logical_and", "logical_or"]:
+            # && jumps as soon as one side is false, || as soon as one is true
+            decided_by = cond.op == "logical_or"
+            if jump_when == decided_by:
+                self.x86_cond_jump(cond.val1, label, jump_when)
+                self.x86_cond_jump(cond.val2, label, jump_when)
             else:
-                self.add_instruction(Move(self.arg_registers[i], arg))
+                skip_label = self.get_next_label(cond)
+                self.x86_cond_jump(cond.val1, skip_label, decided_by)
+                self.x86_cond_jump(cond.val2, label, jump_when)
+                self.insert_label(skip_label)
+
+        elif isinstance(cond, OpBinaryNode) and cond.op in comparison_codes:
+            code = self.x86_compare(cond)
+            self.add_instruction(JumpCmp(code if jump_when else negated_codes[code], label))
+
+        else:
+            code = self.x86_cmp(self.x86_expr(cond), 0, "ne", size_from_type(cond.get_inferred_type()))
+            self.add_instruction(JumpCmp(code if jump_when else negated_codes[code], label))
+
+    def x86_logical(self, node: OpBinaryNode) -> VirtualRegister:
+        # && and || used as values still branch, then set the result to 0 or 1
+        false_label = self.get_next_label(node)
+        after_label = self.get_next_label(node)
+
+        self.x86_cond_jump(node, false_label, False)
+        result_reg = self.get_next_temp_register(max(size_from_type(node.get_inferred_type()), 4))
+        self.add_instruction(Move(result_reg, 1))
+        self.add_instruction(Jump(after_label))
+
+        self.insert_label(false_label)
+        self.add_instruction(Move(result_reg, 0))
+        self.insert_label(after_label)
+
+        return result_reg
+
+    def x86_funcall(self, node: FunCallNode) -> VirtualRegister:
+        if self.use_virt_regs:
+            return self.x86_virt_funcall(node)
+
+        result_reg = self.x86_call(node.fun_name, self.x86_exprs(node.args))
+        return result_reg.as_size(size_from_type(node.get_inferred_type()))
+
+    def x86_virt_funcall(self, node: FunCallNode) -> VirtualRegister:
+        # every arg is computed before any goes in its register, a call in one of them
+        # would overwrite the ones already there
+        return self.x86_call(node.fun_name, [self.x86_expr(arg) for arg in reversed(node.args)][::-1])
+
+    def x86_call(self, fun_name: str, args: List[Operand]) -> VirtualRegister:
+        stack_args = args[len(self.arg_registers):]
+
+        # rsp has to be 16 byte aligned at the call
+        stack_bytes = 8 * (len(stack_args) + len(stack_args) % 2)
+        if len(stack_args) % 2:
+            self.add_instruction(Arithmetic("sub", self.rsp, 8))
+        for arg in reversed(stack_args):
+            # push always takes 8 bytes, the callee only reads as many as its param has
+            if isinstance(arg, VirtualRegister):
+                arg = arg.as_size(8)
+            elif isinstance(arg, MemoryLocation):
+                arg = MemoryLocation(arg.location, arg.offset, "long")
+            self.add_instruction(Push(self.x86_operand(arg)))
+        for arg_reg, arg in zip(self.arg_registers, args):
+            self.add_instruction(Move(arg_reg.as_size(operand_size(arg)), arg))
+        for arg in args:
+            self.free_operand(arg)
 
-            i -= 1
-        self.reset_arg_reg_index()
-        
         # clear eax by sys V ABI before function call
         self.add_instruction(Move(self.rax.as_size(4), 0))
-        self.add_instruction(Call(node.fun_name))
-        return self.rax
+        self.add_instruction(Call(fun_name, min(len(args), len(self.arg_registers))))
+        if stack_bytes:
+            self.add_instruction(Arithmetic("add", self.rsp, stack_bytes))
+
+        # the next call overwrites rax
+        return self.x86_register(self.rax)
 
     def x86_expr(self, expr: TypeableASTNode) -> Operand:
         # expressions can either return a value that is stored in a register
@@ -355,19 +787,41 @@ class X86VirtCodeGen:
         elif isinstance(expr, LiteralNode):
             return expr.val
         elif isinstance(expr, VarNode):
-            return self.get_variable_stack_loc(expr)
+            location = self.get_variable_stack_loc(expr)
+            if self.use_virt_regs and isinstance(location, MemoryLocation):
+                return self.x86_load(location)
+            return location
+        elif isinstance(expr, TypeCastNode) and self.use_virt_regs:
+            # a copy extended from the bytes the new type keeps, the value may be a variable's register
+            value = self.x86_expr(expr.val)
+            if expr.val.get_inferred_type() == expr.get_inferred_type():
+                return value
+            result_reg = self.x86_register(value)
+            self.x86_wrap(result_reg, expr.get_inferred_type())
+            return result_reg
         elif isinstance(expr, TypeCastNode):
-            # TODO type casting operations
-            return self.x86_expr(expr.val)
+            # TODO type casting operations, the default path only resizes
+            return self.x86_resize(self.x86_expr(expr.val), expr.val.get_inferred_type(), size_from_type(expr.get_inferred_type()))
         else:
             assert False, f"unidentified expr: {expr}"
+
+    def x86_lvalue(self, expr: TypeableASTNode) -> MemoryLocation | VirtualRegister:
+        # where an assignment to expr (or &expr) goes
+        if isinstance(expr, OpUnaryNode) and expr.op == "deref":
+            address = self.x86_expr(expr.val)
+            if not self.use_virt_regs:
+                address = self.x86_in_register(address, 8)
+            return MemoryLocation(location=address, val_type=expr.get_inferred_type())
+        elif isinstance(expr, VarNode):
+            return self.get_variable_stack_loc(expr)
+        else:
+            assert False, f"not an lvalue: {expr}"
     
     def x86_stmt_if_else(self, stmt: StmtIfElseNode):
         if stmt.else_body:
             else_block_label = self.get_next_label(stmt.else_body)
 
-            self.add_instruction(Arithmetic("cmp", self.x86_expr(stmt.condition), 0))
-            self.add_instruction(JumpIfNot(else_block_label))
+            self.x86_cond_jump(stmt.condition, else_block_label, False)
             self.x86_stmt_block(stmt.if_body)
 
             after_if_else_label = self.get_next_label(stmt)
@@ -382,8 +836,7 @@ class X86VirtCodeGen:
             self.insert_label(after_if_else_label)
         else:
             after_if_label = self.get_next_label(stmt)
-            self.add_instruction(Arithmetic("cmp", self.x86_expr(stmt.condition), 0))
-            self.add_instruction(JumpIfNot(after_if_label))
+            self.x86_cond_jump(stmt.condition, after_if_label, False)
             self.x86_stmt_block(stmt.if_body)
 
             # like before, an extra jump to after_if_label is not necessary if dict insertion order is respected
@@ -392,16 +845,38 @@ class X86VirtCodeGen:
             self.insert_label(after_if_label)
     
     def x86_stmt_assign(self, stmt: StmtAssignNode):
-        right_reg = self.x86_expr(stmt.right)
-        left_loc = self.x86_expr(stmt.left)
+        if self.use_virt_regs:
+            right_reg = self.x86_expr(stmt.right)
+            left_loc = self.x86_lvalue(stmt.left)
+            self.x86_store(left_loc, right_reg)
+            if isinstance(left_loc, VirtualRegister) and stmt.right.get_inferred_type() != stmt.left.get_inferred_type():
+                # memory keeps only the bytes of its type, a variable's register has to be cut to them
+                self.x86_wrap(left_loc, stmt.left.get_inferred_type())
+            return
+
+        right, left_loc = self.x86_exprs([stmt.right, stmt.left])
+        size = operand_size(left_loc)
+        right = self.x86_resize(right, stmt.right.get_inferred_type(), size)
+        if isinstance(right, MemoryLocation):
+            # mov takes one memory operand
+            right = self.x86_in_register(right, size)
 
-        # TODO make sure that two memory refs cannot happen
-        self.add_instruction(Move(left_loc, right_reg))
+        self.x86_store(left_loc, right)
+        self.free_operand(left_loc)
+        self.free_operand(right)
 
     def x86_stmt_return(self, stmt: StmtReturnNode):
         result_reg = self.x86_expr(stmt.return_val)
         # TODO, if it's a floating point register, then need to do movd
-        self.add_instruction(Move(self.rax, result_reg))
+        if self.use_virt_regs:
+            self.add_instruction(Move(self.rax, result_reg))
+            if stmt.return_val.get_inferred_type() != self.fun_type:
+                self.x86_wrap(self.rax, self.fun_type)
+        else:
+            size = size_from_type(self.fun_type)
+            self.add_instruction(Move(self.rax.as_size(size), self.x86_resize(result_reg, stmt.return_val.get_inferred_type(), size)))
+            self.free_operand(result_reg)
+        self.add_instruction(Jump(self.return_label))
 
     def x86_stmt_while(self, stmt: StmtWhileNode):
         while_start_label = self.get_next_label(stmt.condition)
@@ -413,8 +888,7 @@ class X86VirtCodeGen:
         self.x86_stmt_block(stmt.body)
 
         self.insert_label(while_after_label)
-        self.add_instruction(Arithmetic("cmp", self.x86_expr(stmt.condition), 0))
-        self.add_instruction(JumpIf(while_start_label))
+        self.x86_cond_jump(stmt.condition, while_start_label, True)
 
     def x86_stmt(self, stmt: ASTNode):
         if isinstance(stmt, StmtAssignNode):
@@ -422,7 +896,7 @@ class X86VirtCodeGen:
         elif isinstance(stmt, StmtBlockNode):
             self.x86_stmt_block(stmt)
         elif isinstance(stmt, StmtExprNode):
-            self.x86_expr(stmt.expr)
+            self.free_operand(self.x86_expr(stmt.expr))
         elif isinstance(stmt, StmtIfElseNode):
             self.x86_stmt_if_else(stmt)
         elif isinstance(stmt, StmtReturnNode):
@@ -437,80 +911,136 @@ class X86VirtCodeGen:
             self.x86_stmt(stmt)
         
     def x86_fun_def(self, fun_def: FunDefNode):
-        current_label = self.get_next_label(name=fun_def.fun_name)
-        self.current_function_name = current_label
-        self.insert_label(current_label)
-
-        self.add_instruction(Push(self.rbp))
-        self.add_instruction(Move(self.rbp, self.rsp))
+        if self.use_virt_regs:
+            self.x86_virt_fun_def(fun_def)
+            return
 
-        # rbx is callee saved
-        rbx_loc = MemoryLocation(self.rbp, -8, val_type="long")
-        self.add_instruction(Move(rbx_loc, self.rbx)) # sometimes not used, but do it anyways for simplicity
-        next_alloc_bp = -8 # from rbx 
-        
-        # allocate enough space for all the locals. TODO properly stack-align this
-        self.add_instruction(Arithmetic("sub", self.rsp, 16*len(fun_def.fun_locals)))
+        self.x86_prologue(fun_def.fun_name, self.get_next_label(fun_def))
+        frame_alloc_idx = self.instruction_idx - 1
+        self.fun_type = fun_def.fun_type
+        self.busy_registers, self.spill_offsets, self.free_spill_slots = set(), set(), []
 
-        # read in the parameters that are passed in as registers and move to stack
-        self.reset_arg_reg_index()
-        cumu_bytes_for_locals = 0
-        cumu_bytes_for_stack_spill = 0
         for idx, param in enumerate(fun_def.params):
             node_type = param.param_var.get_inferred_type()
-            cumu_bytes_for_locals += size_from_type(node_type)
-
-            loc = MemoryLocation(location=self.rbp, offset=-cumu_bytes_for_locals + next_alloc_bp, val_type=node_type)
-            if self.arg_reg_idx < len(self.arg_registers):
-                self.add_instruction(Move(loc, self.arg_registers[self.arg_reg_idx]))
+            if idx < len(self.arg_registers):
+                loc = self.get_stack_slot(node_type)
+                self.x86_read_param(loc, idx, node_type)
             else:
-                # +8 to skip old rbp; another +8 skips return address then 
-                stack_arg_loc = MemoryLocation(location=self.rbp, offset=cumu_bytes_for_stack_spill + 16, val_type=node_type)
-                cumu_bytes_for_stack_spill += size_from_type(node_type)
-                # move arg on stack to rbx or rax, then move it to current frame's stack
-                # this emulates pass by value and complies with gnu assembler rule of only having one mem ref per mov
-                self.add_instruction(Move(self.rbx, stack_arg_loc))  
-                self.add_instruction(Move(loc, self.rbx))
-
+                # the ones the caller pushed are used where they are
+                loc = self.get_stack_param(idx, node_type)
             self.assign_variable_to_stack(param.param_var, loc)
-            self.arg_reg_idx += 1
-
-        self.reset_arg_reg_index()
 
-        # assign all the locals to the stack
-        for idx, local_var in enumerate(fun_def.fun_locals):
+        for local_var in fun_def.fun_locals:
             # skip the params which are already assigned
-            if local_var.get_ir_name() in self.var_ir_to_location: 
-                continue
+            if not local_var.get_ir_name() in self.var_ir_to_location:
+                self.assign_variable_to_stack(local_var, self.get_stack_slot(local_var.get_inferred_type()))
 
-            node_type = local_var.get_inferred_type()
-            cumu_bytes_for_locals += size_from_type(node_type)
-
-            loc = MemoryLocation(location=self.rbp, offset=-cumu_bytes_for_locals + next_alloc_bp, val_type=node_type)
-            self.assign_variable_to_stack(local_var, loc)
-        
         self.x86_stmt_block(fun_def.body)
-    
-        # because rbx is callee saved
-        self.add_instruction(Move(self.rbx, rbx_loc))
-        
+
+        # the callee saved registers the expressions took are saved below the spill slots,
+        # right after the frame is made
+        for reg_name in self.register_saves:
+            self.register_saves[reg_name] = self.get_stack_slot("long")
+        # push rbp left rsp 16 byte aligned
+        frame_bytes = (self.frame_bytes + 15) // 16 * 16
+        frame_instructions = [Arithmetic("sub", self.rsp, frame_bytes)] if frame_bytes else []
+        frame_instructions += [Move(loc, VirtualRegister(reg_name)) for reg_name, loc in self.register_saves.items()]
+        self.replace_instructions(frame_alloc_idx, 1, frame_instructions)
+
+        self.x86_epilogue()
+
+    def replace_instructions(self, ins_idx: int, count: int, instructions: List[X86Instruction]):
+        # swaps the count instructions at ins_idx for instructions, the labels after them move along
+        self.ir_code[ins_idx:ins_idx + count] = instructions
+        shift = len(instructions) - count
+        self.instruction_idx += shift
+        for label, label_idx in self.label_to_ins_idx.items():
+            if label_idx > ins_idx:
+                self.label_to_ins_idx[label] = label_idx + shift
+
+    def x86_prologue(self, fun_name: str, return_label: str):
+        current_label = self.get_next_label(name=fun_name)
+        self.current_function_name = current_label
+        self.insert_label(current_label)
+        self.return_label = return_label
+        self.frame_bytes = 0
+        self.register_saves = {}
+
+        self.add_instruction(Push(self.rbp))
+        self.add_instruction(Move(self.rbp, self.rsp))
+        # sized once the function's spill slots and saved registers are known, by the
+        # allocator in virtual register mode
+        self.add_instruction(Arithmetic("sub", self.rsp, 0))
+
+    def get_stack_slot(self, val_type: str) -> MemoryLocation:
+        # a new slot in the current frame, aligned to its size
+        size = size_from_type(val_type)
+        self.frame_bytes = (self.frame_bytes + 2 * size - 1) // size * size
+        return MemoryLocation(location=self.rbp, offset=-self.frame_bytes, val_type=val_type)
+
+    def get_stack_param(self, idx: int, val_type: str) -> MemoryLocation:
+        # the caller pushed the params after the sixth 8 bytes each, +16 skips the old rbp and
+        # the return address
+        return MemoryLocation(location=self.rbp, offset=16 + 8 * (idx - len(self.arg_registers)), val_type=val_type)
+
+    def x86_read_param(self, dest: MemoryLocation | VirtualRegister, idx: int, val_type: str):
+        if idx < len(self.arg_registers):
+            self.x86_store(dest, self.arg_registers[idx])
+        else:
+            self.x86_store(dest, self.x86_load(self.get_stack_param(idx, val_type)))
+
+    def x86_epilogue(self):
+        # a return at the very end doesn't need to jump
+        if self.ir_code[-1] == Jump(self.return_label):
+            self.ir_code.pop()
+            self.instruction_idx -= 1
+            for label, ins_idx in self.label_to_ins_idx.items():
+                self.label_to_ins_idx[label] = min(ins_idx, self.instruction_idx)
+
+        self.insert_label(self.return_label)
+        for reg_name, loc in self.register_saves.items():
+            self.add_instruction(Move(VirtualRegister(reg_name), loc))
         self.add_instruction(Leave())
         self.add_instruction(Return())
 
+    def x86_virt_fun_def(self, fun_def: FunDefNode):
+        self.x86_prologue(fun_def.fun_name, self.get_next_label(fun_def))
+        self.fun_type = fun_def.fun_type
+        address_taken = get_address_taken(fun_def.body)
+
+        def assign_variable(var_node: VarNode) -> MemoryLocation | VirtualRegister:
+            if var_node.get_ir_name() in address_taken:
+                loc = self.get_stack_slot(var_node.get_inferred_type())
+            else:
+                loc = self.get_next_temp_register()
+            self.assign_variable_to_stack(var_node, loc)
+            return loc
+
+        for idx, param in enumerate(fun_def.params):
+            self.x86_read_param(assign_variable(param.param_var), idx, param.param_var.get_inferred_type())
+
+        for local_var in fun_def.fun_locals:
+            if not local_var.get_ir_name() in self.var_ir_to_location:
+                assign_variable(local_var)
+
+        self.x86_stmt_block(fun_def.body)
+        self.x86_epilogue()
+
     def x86_source_file(self, src_file: SourceFileNode):
         for fun_def in src_file.fun_defs:
             self.x86_fun_def(fun_def)
         
     def pretty_x86(self) -> str:
-        labels = [*self.label_to_ins_idx.keys()]
-        label_idx = 0
+        # several labels can point at the same instruction, like the ends of nested ifs
+        ins_idx_to_labels: Dict[int, List[str]] = {}
+        for label, ins_idx in self.label_to_ins_idx.items():
+            ins_idx_to_labels.setdefault(ins_idx, []).append(label)
 
         ins_strs = []
 
         for i in range(self.instruction_idx):
-            if label_idx < len(labels) and i == self.label_to_ins_idx[labels[label_idx]]:
-                ins_strs.append(labels[label_idx] + ":")
-                label_idx += 1
+            for label in ins_idx_to_labels.get(i, []):
+                ins_strs.append(label + ":")
 
             ins_strs.append(f"\t{self.ir_code[i]}")
         
@@ -0,0 +1,256 @@
+from cgen.x86_cgen import *
+from ir import ir_tac
+from ir.ir_cfg import get_defs, get_uses, get_function_ranges
+from ir.ir_tacvm_memory import is_integer_type, wrap_value
+
+# x86 selected from the TAC, so the tac passes show up in the native code
+#
+# every tac instruction becomes the x86 for it over virtual registers named like the tac
+# ones, and x86_regalloc gives them physical registers afterwards. two instructions
+# where the first one's result is only read by the second become one tile: a comparison
+# feeding a branch is a cmp and a jcc, and arithmetic moved straight into a variable
+# computes in the variable's register. tac stack slots, the variables & is applied to,
+# get slots in the frame and everything else in memory goes through pointers
+#
+# like in the default path every virtual register holds its value extended to 8 bytes.
+# operations run at the size of their c type, ints and up, and what they write is
+# extended again from the bytes the type keeps, so values wrap the way the vm wraps them
+
+comparison_codes = { "eq": "e", "lt": "l", "lte": "le", "gt": "g", "gte": "ge" }
+# tac ops that x86 does in place as op dest, src
+two_operand_ops = { "add": "add", "sub": "sub", "mul": "imul", "imul": "imul", "and": "and", "or": "or" }
+commutative_ops = { "add", "mul", "imul", "and", "or" }
+
+class X86InstructionSelector(X86VirtCodeGen):
+    def __init__(self, tac: ir_tac.TAC) -> None:
+        super().__init__(use_virt_regs=True)
+        self.tac = tac
+        # tac registers keep their names, new ones are numbered after them
+        self.temp_reg_idx = tac.variable_idx
+        self.current_label_idx = tac.current_label_idx
+
+        # id of a tac StackSlot -> its slot in the frame
+        self.stack_slots: Dict[int, MemoryLocation] = {}
+
+    def get_register(self, reg: ir_tac.VirtualRegister) -> VirtualRegister:
+        return VirtualRegister(reg.register_name)
+
+    def get_memory(self, mem: ir_tac.MemoryLocation) -> MemoryLocation:
+        if isinstance(mem.location, ir_tac.StackSlot):
+            slot = self.stack_slots[id(mem.location)]
+            return MemoryLocation(slot.location, slot.offset + mem.offset, slot.val_type)
+
+        assert isinstance(mem.location, ir_tac.VirtualRegister), f"no native address for {mem}"
+        pointer_type = mem.location.val_type or ""
+        val_type = pointer_type[:-1] if pointer_type.endswith("*") else "long"
+        return MemoryLocation(self.get_register(mem.location), mem.offset, val_type)
+
+    def get_val_type(self, operand: object) -> str | None:
+        # the c type of a tac operand's value, None for immediates and addresses
+        if isinstance(operand, ir_tac.VirtualRegister):
+            return operand.val_type
+        elif isinstance(operand, ir_tac.MemoryLocation):
+            return self.get_memory(operand).val_type
+        return None
+
+    def get_val_size(self, val_type: str | None) -> int:
+        # pointers and values of unknown type fill the whole register
+        return size_from_type(val_type) if is_integer_type(val_type) else 8
+
+    def get_op_size(self, val_type: str | None) -> int:
+        # values below 4 bytes are worked on as ints, like c promotes them
+        return max(self.get_val_size(val_type), 4)
+
+    def get_sized(self, operand: Operand, size: int) -> Operand:
+        # the low size bytes of a register are its value at that size, immediates are wrapped to it
+        if isinstance(operand, VirtualRegister):
+            return operand.as_size(size)
+        return wrap_value(operand, size_to_type[size])
+
+    def get_operand(self, operand: object) -> Operand:
+        # a register or an immediate for operand, loads and addresses are computed first
+        if isinstance(operand, ir_tac.VirtualRegister):
+            return self.get_register(operand)
+        elif isinstance(operand, ir_tac.StackSlot):
+            address = self.get_next_temp_register()
+            self.add_instruction(LoadEffectiveAddress(address, self.stack_slots[id(operand)]))
+            return address
+        elif isinstance(operand, ir_tac.MemoryLocation):
+            return self.x86_load(self.get_memory(operand))
+
+        assert isinstance(operand, int), f"no x86 for {operand}, floats aren't supported yet"
+        return operand
+
+    def x86_two_operand(self, op: str, dest: VirtualRegister, left: object, right: object, val_type: str | None):
+        # dest = left op right, computed at the size of val_type
+        size = self.get_op_size(val_type)
+        left, right = self.get_operand(left), self.get_operand(right)
+        if dest == right and left != right:
+            # dest = left op dest, moving left into dest first would lose the old dest
+            if op in commutative_ops:
+                left, right = right, left
+            else:
+                right = self.x86_register(right)
+
+        right = self.x86_operand(self.get_sized(right, size))
+        self.add_instruction(Move(dest.as_size(size), self.get_sized(left, size)))
+        self.add_instruction(Arithmetic(two_operand_ops[op], dest.as_size(size), right))
+        self.x86_wrap(dest, val_type, size)
+
+    def x86_tac_cmp(self, ins: ir_tac.Arithmetic) -> str:
+        # cmp at the size of the wider operand, with the unsigned condition codes when one
+        # of them is unsigned, like c converts them
+        val_types = [self.get_val_type(operand) for operand in [ins.left, ins.right] if not isinstance(operand, Immediate)]
+        size = max((self.get_op_size(val_type) for val_type in val_types), default=8)
+        code = comparison_codes[ins.op]
+        if any(val_type and is_unsigned(val_type) for val_type in val_types):
+            code = unsigned_codes[code]
+
+        left, right = self.get_operand(ins.left), self.get_operand(ins.right)
+        return self.x86_cmp(self.get_sized(left, size), self.get_sized(right, size), code, size)
+
+    def x86_arithmetic(self, ins: ir_tac.Arithmetic):
+        # results for memory are computed in a register and stored after
+        dest = self.get_register(ins.dest) if isinstance(ins.dest, ir_tac.VirtualRegister) else self.get_next_temp_register()
+        dest_type = self.get_val_type(ins.dest)
+        if ins.op in comparison_codes:
+            self.x86_setcc(self.x86_tac_cmp(ins), dest)
+        elif ins.op == "div":
+            size = self.get_op_size(dest_type)
+            left, right = self.get_sized(self.get_operand(ins.left), size), self.get_sized(self.get_operand(ins.right), size)
+            result = self.x86_divide("div" if dest_type and is_unsigned(dest_type) else "idiv", left, right, size)
+            self.add_instruction(Move(dest.as_size(size), result.as_size(size)))
+            self.x86_wrap(dest, dest_type, size)
+        else:
+            assert ins.op in two_operand_ops, f"unknown operation {ins.op}"
+            self.x86_two_operand(ins.op, dest, ins.left, ins.right, dest_type)
+
+        if isinstance(ins.dest, ir_tac.MemoryLocation):
+            self.x86_store(self.get_memory(ins.dest), dest)
+
+    def x86_move(self, ins: ir_tac.Move):
+        if isinstance(ins.dest, ir_tac.MemoryLocation):
+            self.x86_store(self.get_memory(ins.dest), self.get_operand(ins.src))
+        elif isinstance(ins.src, ir_tac.MemoryLocation):
+            # loads straight into the dest
+            dest, src = self.get_register(ins.dest), self.get_memory(ins.src)
+            if size_from_type(src.val_type) < 8:
+                self.add_instruction(MoveExtend(dest, src, not is_unsigned(src.val_type)))
+            else:
+                self.add_instruction(Move(dest, src))
+            if src.val_type != ins.dest.val_type:
+                self.x86_wrap(dest, ins.dest.val_type)
+        else:
+            dest, src = self.get_register(ins.dest), self.get_operand(ins.src)
+            if isinstance(src, Immediate):
+                self.add_instruction(Move(dest, wrap_value(src, ins.dest.val_type)))
+            else:
+                self.add_instruction(Move(dest, src))
+                if self.get_val_type(ins.src) != ins.dest.val_type:
+                    # a cast, or a value of another type moved into a variable
+                    self.x86_wrap(dest, ins.dest.val_type)
+
+    def x86_tac_instruction(self, ins: ir_tac.TACInstruction):
+        if isinstance(ins, ir_tac.Params):
+            for idx, reg in enumerate(ins.params_regs):
+                self.x86_read_param(self.get_register(reg), idx, reg.val_type or "long")
+
+        elif isinstance(ins, ir_tac.Move):
+            self.x86_move(ins)
+
+        elif isinstance(ins, ir_tac.Arithmetic):
+            self.x86_arithmetic(ins)
+
+        elif isinstance(ins, ir_tac.Jump):
+            assert isinstance(ins.dest, ir_tac.Label | str), f"no x86 for {ins}"
+            self.add_instruction(Jump(str(ins.dest)))
+
+        elif isinstance(ins, ir_tac.JumpIf | ir_tac.JumpIfNot):
+            jump_when = isinstance(ins, ir_tac.JumpIf)
+            cond = self.get_operand(ins.cond)
+            if isinstance(cond, Immediate):
+                if (cond != 0) == jump_when:
+                    self.add_instruction(Jump(str(ins.dest)))
+            else:
+                self.add_instruction(Arithmetic("cmp", cond, 0))
+                self.add_instruction(JumpCmp("ne" if jump_when else "e", str(ins.dest)))
+
+        elif isinstance(ins, ir_tac.Call):
+            result = self.x86_call(str(ins.target), [self.get_operand(arg) for arg in ins.args])
+            if isinstance(ins.out_register, ir_tac.VirtualRegister):
+                self.add_instruction(Move(self.get_register(ins.out_register), result))
+
+        elif isinstance(ins, ir_tac.Return):
+            if ins.src is not None:
+                self.add_instruction(Move(self.rax, self.get_operand(ins.src)))
+            self.add_instruction(Jump(self.return_label))
+
+        else:
+            assert False, f"no x86 for {ins}"
+
+    def x86_fused(self, ins: ir_tac.TACInstruction, next_ins: ir_tac.TACInstruction | None, reg_counts: Dict[str, int]) -> bool:
+        # emits ins and next_ins as one tile if they make one, the result of ins has to be
+        # written once and read only by next_ins
+        if next_ins is None or not isinstance(ins, ir_tac.Arithmetic) or not isinstance(ins.dest, ir_tac.VirtualRegister) \
+            or reg_counts[ins.dest.register_name] != 2:
+            return False
+        result_name = ins.dest.register_name
+
+        if ins.op in comparison_codes and isinstance(next_ins, ir_tac.JumpIf | ir_tac.JumpIfNot) \
+            and isinstance(next_ins.cond, ir_tac.VirtualRegister) and next_ins.cond.register_name == result_name:
+            code = self.x86_tac_cmp(ins)
+            self.add_instruction(JumpCmp(code if isinstance(next_ins, ir_tac.JumpIf) else negated_codes[code], str(next_ins.dest)))
+            return True
+
+        if ins.op in two_operand_ops and isinstance(next_ins, ir_tac.Move) and isinstance(next_ins.dest, ir_tac.VirtualRegister) \
+            and isinstance(next_ins.src, ir_tac.VirtualRegister) and next_ins.src.register_name == result_name:
+            dest = self.get_register(next_ins.dest)
+            self.x86_two_operand(ins.op, dest, ins.left, ins.right, ins.dest.val_type)
+            if ins.dest.val_type != next_ins.dest.val_type:
+                self.x86_wrap(dest, next_ins.dest.val_type)
+            return True
+
+        return False
+
+    def x86_tac_function(self, fun_name: str, start: int, end: int, ins_idx_to_labels: Dict[int, List[str]]):
+        code = self.tac.ir_code
+        self.x86_prologue(fun_name, f".L{self.current_label_idx}_ret")
+        self.advance_label_idx()
+
+        self.stack_slots = {}
+        for ins in code[start:end]:
+            for slot in ir_tac.instruction_stack_slots(ins):
+                if not id(slot) in self.stack_slots:
+                    self.stack_slots[id(slot)] = self.get_stack_slot(slot.val_type or "long")
+
+        reg_counts: Dict[str, int] = {}
+        for ins in code[start:end]:
+            for reg in get_defs(ins) + get_uses(ins):
+                if isinstance(reg, ir_tac.VirtualRegister):
+                    reg_counts[reg.register_name] = reg_counts.get(reg.register_name, 0) + 1
+
+        # labels where a function starts belong to the function before it, the one that
+        # runs into it. in x86 it returns instead
+        ins_idx = start
+        while ins_idx < end:
+            if ins_idx > start:
+                for label in ins_idx_to_labels.get(ins_idx, []):
+                    self.insert_label(label)
+
+            next_idx = ins_idx + 1
+            next_ins = code[next_idx] if next_idx < end and not next_idx in ins_idx_to_labels else None
+            if self.x86_fused(code[ins_idx], next_ins, reg_counts):
+                ins_idx += 2
+            else:
+                self.x86_tac_instruction(code[ins_idx])
+                ins_idx += 1
+
+        for label in ins_idx_to_labels.get(end, []):
+            if not label in self.tac.fun_name_to_locals:
+                self.insert_label(label)
+        self.x86_epilogue()
+
+    def x86_tac(self):
+        ins_idx_to_labels = self.tac.get_ins_idx_to_labels()
+        for fun_name, (start, end) in get_function_ranges(self.tac).items():
+            self.x86_tac_function(fun_name, start, end, ins_idx_to_labels)
@@ -0,0 +1,378 @@
+from cgen.x86_cgen import *
+from typing import Callable, Tuple
+import copy
+
+# linear scan register allocation for X86VirtCodeGen's virtual register mode
+#
+# works on one function at a time, found through the function labels. liveness runs
+# backwards over the instructions until nothing changes, for the t<n> registers and for
+# the physical ones the code names (args, rax after a call, rdx:rax around a division),
+# with calls reading their arg registers and clobbering every caller saved one. every
+# t<n> gets the interval from its first to its last live instruction, and intervals are
+# handed registers in the order they start (Poletto & Sarkar). a register can't be
+# given to an interval while the code has it live or writes it in there, which keeps
+# intervals that live across a call in callee saved registers. when none is free the
+# interval that ends last is spilled to an rbp relative slot, and spills that don't
+# overlap share a slot. r10 and r11 are never handed out, they carry spilled values
+# through instructions that need a register. callee saved registers the function gets
+# are saved below the spill slots
+
+callee_saved = ["rbx", "r12", "r13", "r14", "r15"]
+# in the order they are picked, rax and rdx are busy the most
+caller_saved = ["rcx", "rsi", "rdi", "r8", "r9", "rdx", "rax"]
+scratch_registers = ["r11", "r10"]
+call_clobbered = caller_saved + scratch_registers
+
+arg_registers = ["rdi", "rsi", "rdx", "rcx", "r8", "r9"]
+
+@dataclass
+class LiveInterval:
+    register_name: str
+    start: int
+    end: int
+    # a physical register name, or None when spilled
+    physical: str = None
+    spill_offset: int = None
+
+@dataclass
+class AllocationStats:
+    intervals: int = 0
+    spilled: int = 0
+    spill_slots: int = 0
+    saved_registers: int = 0
+    dead_instructions: int = 0
+
+@dataclass
+class Liveness:
+    uses_and_defs: List[Tuple[Set[str], Set[str]]]
+    live_in: List[Set[str]]
+    live_out: List[Set[str]]
+
+def is_virtual(operand: Operand) -> bool:
+    return isinstance(operand, VirtualRegister) and not operand.is_physical()
+
+def get_operand_fields(ins: X86Instruction) -> List[Tuple[str, bool, bool]]:
+    # (field, read, written) for every operand of ins
+    if isinstance(ins, Arithmetic):
+        return [("dest", True, ins.op != "cmp"), ("src", True, False)]
+    elif isinstance(ins, Move | MoveExtend):
+        return [("dest", False, True), ("src", True, False)]
+    elif isinstance(ins, SetCmp | Pop):
+        return [("dest", False, True)]
+    elif isinstance(ins, Push):
+        return [("val", True, False)]
+    elif isinstance(ins, Divide):
+        return [("src", True, False)]
+    elif isinstance(ins, LoadEffectiveAddress):
+        return [("dest", False, True), ("base_reg", True, False), ("idx_reg", True, False)]
+    return []
+
+def get_register_name(reg: VirtualRegister) -> str | None:
+    # what liveness tracks reg as, physical registers by their 64 bit name. None for the
+    # ones never handed out
+    if not reg.is_physical():
+        return reg.register_name
+    name = reg_to_reg64[reg.register_name]
+    return name if name in caller_saved or name in callee_saved else None
+
+def get_uses_and_defs(ins: X86Instruction) -> Tuple[Set[str], Set[str]]:
+    # setcc only writes the low byte, but what it writes is always widened right after,
+    # so it counts as a whole def
+    uses, defs = set(), set()
+    for field, read, written in get_operand_fields(ins):
+        operand = getattr(ins, field)
+        if isinstance(operand, MemoryLocation):
+            if isinstance(operand.location, VirtualRegister) and get_register_name(operand.location):
+                uses.add(get_register_name(operand.location))
+        elif isinstance(operand, VirtualRegister) and get_register_name(operand):
+            if read:
+                uses.add(get_register_name(operand))
+            if written:
+                defs.add(get_register_name(operand))
+
+    # what reads and writes physical registers without naming them
+    if isinstance(ins, Call):
+        # eax holds the number of vector registers used by varargs
+        uses |= { *arg_registers[:ins.register_args], "rax" }
+        defs |= set(call_clobbered)
+    elif isinstance(ins, Divide):
+        uses |= { "rax", "rdx" }
+        defs |= { "rax", "rdx" }
+    elif isinstance(ins, SignExtend):
+        uses.add("rax")
+        defs.add("rdx")
+    elif isinstance(ins, Return):
+        uses.add("rax")
+
+    return uses, defs
+
+def get_successors(code: List[X86Instruction], labels: Dict[str, int], ins_idx: int) -> List[int]:
+    ins = code[ins_idx]
+    if isinstance(ins, Jump):
+        return [labels[ins.dest]]
+    elif isinstance(ins, JumpCmp | JumpIf | JumpIfNot):
+        return [labels[ins.dest], ins_idx + 1]
+    elif isinstance(ins, Return):
+        return []
+    return [ins_idx + 1] if ins_idx + 1 < len(code) else []
+
+def get_liveness(code: List[X86Instruction], labels: Dict[str, int]) -> Liveness:
+    uses_and_defs = [get_uses_and_defs(ins) for ins in code]
+    successors = [get_successors(code, labels, ins_idx) for ins_idx in range(len(code))]
+    live_in: List[Set[str]] = [set() for _ in code]
+    live_out: List[Set[str]] = [set() for _ in code]
+
+    changed = True
+    while changed:
+        changed = False
+        for ins_idx in reversed(range(len(code))):
+            out = set().union(*(live_in[succ] for succ in successors[ins_idx]))
+            uses, defs = uses_and_defs[ins_idx]
+            new_in = uses | (out - defs)
+            if new_in != live_in[ins_idx] or out != live_out[ins_idx]:
+                live_in[ins_idx], live_out[ins_idx] = new_in, out
+                changed = True
+
+    return Liveness(uses_and_defs, live_in, live_out)
+
+def is_dead(ins: X86Instruction, live_out: Set[str]) -> bool:
+    # writes nothing but a t<n> nobody reads
+    return isinstance(ins, Move | MoveExtend | SetCmp | LoadEffectiveAddress) and is_virtual(ins.dest) \
+        and not ins.dest.register_name in live_out
+
+def get_live_intervals(liveness: Liveness) -> List[LiveInterval]:
+    intervals: Dict[str, LiveInterval] = {}
+    for ins_idx, (uses, defs) in enumerate(liveness.uses_and_defs):
+        for name in uses | defs | liveness.live_in[ins_idx] | liveness.live_out[ins_idx]:
+            if name in reg_to_reg64:
+                continue
+            if not name in intervals:
+                intervals[name] = LiveInterval(name, ins_idx, ins_idx)
+            intervals[name].end = ins_idx
+
+    return sorted(intervals.values(), key=lambda interval: interval.start)
+
+def get_physical_conflicts(liveness: Liveness) -> Callable[[LiveInterval, str], bool]:
+    # whether the code needs the physical register while the interval is live. it can
+    # read it where the interval starts and write it where the interval ends, that's
+    # just a move between the two
+    busy: Dict[str, List[int]] = { name: [] for name in caller_saved + callee_saved }
+    written: Dict[str, List[int]] = { name: [] for name in caller_saved + callee_saved }
+    for ins_idx, (_, defs) in enumerate(liveness.uses_and_defs):
+        for name in liveness.live_in[ins_idx]:
+            if name in busy:
+                busy[name].append(ins_idx)
+        for name in defs:
+            if name in written:
+                written[name].append(ins_idx)
+
+    def conflicts(interval: LiveInterval, name: str) -> bool:
+        return any(interval.start < ins_idx <= interval.end for ins_idx in busy[name]) or \
+            any(interval.start <= ins_idx < interval.end for ins_idx in written[name])
+    return conflicts
+
+def get_hints(code: List[X86Instruction]) -> Dict[str, List[str]]:
+    # physical registers a t<n> is moved from or to, getting the same one saves the move
+    hints: Dict[str, List[str]] = {}
+    for ins in code:
+        if isinstance(ins, Move) and isinstance(ins.dest, VirtualRegister) and isinstance(ins.src, VirtualRegister):
+            for virtual, physical in [(ins.dest, ins.src), (ins.src, ins.dest)]:
+                if is_virtual(virtual) and physical.is_physical() and get_register_name(physical):
+                    hints.setdefault(virtual.register_name, []).append(get_register_name(physical))
+    return hints
+
+def linear_scan(intervals: List[LiveInterval], conflicts: Callable[[LiveInterval, str], bool],
+                hints: Dict[str, List[str]]) -> List[LiveInterval]:
+    # gives every interval a physical register or nothing, returns the spilled ones
+    active: List[LiveInterval] = []
+    spilled: List[LiveInterval] = []
+
+    for interval in intervals:
+        # an interval that ends where this one starts was last read by the instruction
+        # that writes this one, they can share a register
+        active = [other for other in active if other.end > interval.start]
+        in_use = { other.physical for other in active }
+
+        candidates = hints.get(interval.register_name, []) + caller_saved + callee_saved
+        free = [name for name in candidates if not name in in_use and not conflicts(interval, name)]
+        if free:
+            interval.physical = free[0]
+            active.append(interval)
+            continue
+
+        victims = [other for other in active if not conflicts(interval, other.physical)]
+        victim = max(victims, key=lambda other: other.end, default=None)
+        if victim is not None and victim.end > interval.end:
+            interval.physical, victim.physical = victim.physical, None
+            active.remove(victim)
+            active.append(interval)
+            spilled.append(victim)
+        else:
+            spilled.append(interval)
+
+    return spilled
+
+def assign_spill_slots(spilled: List[LiveInterval], frame_bytes: int) -> int:
+    # returns the number of slots
+    slots: List[List[LiveInterval]] = []
+    for interval in sorted(spilled, key=lambda interval: interval.start):
+        for slot_idx, owners in enumerate(slots):
+            if all(other.end <= interval.start or interval.end <= other.start for other in owners):
+                break
+        else:
+            slot_idx = len(slots)
+            slots.append([])
+
+        slots[slot_idx].append(interval)
+        interval.spill_offset = -(frame_bytes + 8 * (slot_idx + 1))
+
+    return len(slots)
+
+class Rewriter:
+    # replaces the virtual registers of one instruction, loading spilled values into the
+    # scratch registers where x86 needs a register
+    def __init__(self, intervals: Dict[str, LiveInterval], rbp: VirtualRegister) -> None:
+        self.intervals = intervals
+        self.rbp = rbp
+
+    def map_register(self, reg: VirtualRegister) -> VirtualRegister | MemoryLocation:
+        interval = self.intervals[reg.register_name]
+        if interval.physical:
+            return VirtualRegister(interval.physical).as_size(reg.word_size)
+        # little endian, the low bytes of a slot are at its address
+        return MemoryLocation(self.rbp, interval.spill_offset, size_to_type[reg.word_size])
+
+    def rewrite(self, ins: X86Instruction) -> List[X86Instruction]:
+        before, after = [], []
+        scratch = [VirtualRegister(name) for name in scratch_registers]
+
+        def as_register(operand: VirtualRegister | MemoryLocation) -> VirtualRegister:
+            # addresses have to come from a register
+            if isinstance(operand, VirtualRegister):
+                return operand
+            reg = scratch.pop()
+            before.append(Move(reg, operand))
+            return reg
+
+        operands: Dict[str, Operand] = {}
+        for field, _, _ in get_operand_fields(ins):
+            operand = getattr(ins, field)
+            if isinstance(operand, MemoryLocation) and is_virtual(operand.location):
+                location = as_register(self.map_register(operand.location.as_size(8)))
+                operand = MemoryLocation(location, operand.offset, operand.val_type)
+            elif is_virtual(operand):
+                operand = self.map_register(operand)
+                if field in ["base_reg", "idx_reg"]:
+                    operand = as_register(operand)
+            operands[field] = operand
+
+        if all(operand is getattr(ins, field) for field, operand in operands.items()):
+            return [ins]
+
+        ins = copy.copy(ins)
+        for field, operand in operands.items():
+            setattr(ins, field, operand)
+
+        # imul, movsx and lea only write registers
+        dest = operands.get("dest")
+        if isinstance(dest, MemoryLocation) and (isinstance(ins, MoveExtend | LoadEffectiveAddress) or (isinstance(ins, Arithmetic) and ins.op == "imul")):
+            reg = scratch.pop().as_size(operand_size(dest))
+            if isinstance(ins, Arithmetic):
+                before.append(Move(reg, dest))
+            after.append(Move(dest, reg))
+            ins.dest = dest = reg
+
+        # only one memory operand, and no 64 bit immediates going to memory
+        src = operands.get("src")
+        if isinstance(dest, MemoryLocation) and (isinstance(src, MemoryLocation) or not fits_imm32(src)):
+            reg = scratch.pop().as_size(operand_size(src) if isinstance(src, MemoryLocation) else 8)
+            before.append(Move(reg, src))
+            ins.src = reg
+
+        return [*before, ins, *after]
+
+def remove_dead_code(code: List[X86Instruction], labels: Dict[str, int], stats: AllocationStats) -> Tuple[List[X86Instruction], Dict[str, int], Liveness]:
+    # codegen moves every param into its variable and copies every call's result, used
+    # or not. removing a write can make the ones feeding it dead, so it repeats
+    while True:
+        liveness = get_liveness(code, labels)
+        dead = [is_dead(ins, live_out) for ins, live_out in zip(code, liveness.live_out)]
+        if not any(dead):
+            return code, labels, liveness
+
+        new_idx, kept = [], 0
+        for is_dead_ins in dead:
+            new_idx.append(kept)
+            kept += not is_dead_ins
+        new_idx.append(kept)
+
+        stats.dead_instructions += sum(dead)
+        labels = { label: new_idx[ins_idx] for label, ins_idx in labels.items() }
+        code = [ins for ins, is_dead_ins in zip(code, dead) if not is_dead_ins]
+
+def allocate_function(code: List[X86Instruction], labels: Dict[str, int], stats: AllocationStats) -> Tuple[List[X86Instruction], Dict[str, int]]:
+    # code is one function, labels are relative to its start. returns both rewritten
+    rbp = VirtualRegister("rbp")
+    code, labels, liveness = remove_dead_code(code, labels, stats)
+    intervals = get_live_intervals(liveness)
+
+    # below rbp codegen only put the variables that have their address taken, the first
+    # sub rsp is the frame's
+    frame_bytes = max([-operand.offset for ins in code for field, _, _ in get_operand_fields(ins)
+                       if isinstance(operand := getattr(ins, field), MemoryLocation) and operand.location == rbp and operand.offset < 0], default=0)
+    frame_alloc = next(ins for ins in code if isinstance(ins, Arithmetic) and ins.op == "sub" and ins.dest == VirtualRegister("rsp"))
+
+    spilled = linear_scan(intervals, get_physical_conflicts(liveness), get_hints(code))
+    spill_slots = assign_spill_slots(spilled, frame_bytes)
+
+    saved = [name for name in callee_saved if any(interval.physical == name for interval in intervals)]
+    save_locations = [MemoryLocation(rbp, -(frame_bytes + 8 * (spill_slots + i + 1)), "long") for i in range(len(saved))]
+    # push rbp left rsp 16 byte aligned
+    frame_alloc.src = (frame_bytes + 8 * (spill_slots + len(saved)) + 15) // 16 * 16
+
+    stats.intervals += len(intervals)
+    stats.spilled += len(spilled)
+    stats.spill_slots += spill_slots
+    stats.saved_registers += len(saved)
+
+    rewriter = Rewriter({ interval.register_name: interval for interval in intervals }, rbp)
+    new_code: List[X86Instruction] = []
+    new_idx: List[int] = []
+    for ins in code:
+        new_idx.append(len(new_code))
+        if ins is frame_alloc and frame_alloc.src == 0:
+            continue
+        elif isinstance(ins, Leave):
+            new_code.extend(Move(VirtualRegister(name), loc) for name, loc in zip(saved, save_locations))
+
+        # registers that ended up the same make moves between them useless
+        new_code.extend(new_ins for new_ins in rewriter.rewrite(ins) if not (isinstance(new_ins, Move) and new_ins.dest == new_ins.src))
+
+        if ins is frame_alloc:
+            new_code.extend(Move(loc, VirtualRegister(name)) for name, loc in zip(saved, save_locations))
+    new_idx.append(len(new_code))
+
+    return new_code, { label: new_idx[ins_idx] for label, ins_idx in labels.items() }
+
+def allocate_registers(x86: X86VirtCodeGen) -> AllocationStats:
+    # allocates every function of code generated with use_virt_regs, in place
+    stats = AllocationStats()
+    fun_starts = sorted(ins_idx for label, ins_idx in x86.label_to_ins_idx.items() if not label.startswith(".L"))
+    ends = fun_starts[1:] + [x86.instruction_idx]
+
+    new_code: List[X86Instruction] = []
+    new_labels: Dict[str, int] = {}
+    for start, end in zip(fun_starts, ends):
+        # a label at end belongs to the next function, unless there is none
+        labels = { label: ins_idx - start for label, ins_idx in x86.label_to_ins_idx.items()
+                   if start <= ins_idx < end or ins_idx == end == x86.instruction_idx }
+        code, labels = allocate_function(x86.ir_code[start:end], labels, stats)
+
+        for label, ins_idx in labels.items():
+            new_labels[label] = ins_idx + len(new_code)
+        new_code.extend(code)
+
+    x86.ir_code = new_code
+    x86.instruction_idx = len(new_code)
+    x86.label_to_ins_idx = new_labels
+    return stats
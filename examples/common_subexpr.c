@@ -0,0 +1,21 @@
+int g(int a, int b) {
+    int x = a * b + 1;
+    int y = 0;
+    if (a > b) {
+        y = b * a + 1;
+    } else {
+        y = a * b - 1;
+    }
+    int i = 0;
+    int s = 0;
+    while (i < 10) {
+        s = s + (a * b) + (i + a);
+        i = i + 1;
+        s = s + (i + a);
+    }
+    return x + y + s;
+}
+
+int main() {
+    return g(3, 4) + g(5, 2);
+}
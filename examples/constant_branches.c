@@ -0,0 +1,28 @@
+int g(int n) {
+    int k = 4;
+    int m = k * 3 + 1;
+    if (m > 10) {
+        n = n + m;
+    } else {
+        n = n - m;
+    }
+    int i = 0;
+    while (i < n) {
+        i = i + k;
+    }
+    if (k == 5) {
+        return 99;
+    }
+    return i + m;
+}
+
+int main() {
+    int a = 10;
+    int b = 0;
+    if (a > 5) {
+        b = 1;
+    } else {
+        b = 3;
+    }
+    return g(b) + b;
+}
@@ -0,0 +1,13 @@
+int sq(int x) {
+    return x*x;
+}
+
+int main() {
+    int i = 0;
+    int s = 0;
+    while (i < 100) {
+        s = s + sq(i);
+        i = i + 1;
+    }
+    return s;
+}
@@ -0,0 +1,12 @@
+int main() {
+    int i = 0;
+    int s = 0;
+    int a = 3;
+    int b = 4;
+    while (i < 1000) {
+        s = s + i*8 + a*b;
+        i = i + 1;
+    }
+
+    return s;
+}
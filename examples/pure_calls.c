@@ -0,0 +1,26 @@
+int square(int x) {
+    return x * x;
+}
+
+int sum_squares(int n) {
+    int total = 0;
+    int i = 1;
+    while (i <= n) {
+        total = total + square(i);
+        i = i + 1;
+    }
+    return total;
+}
+
+int fact(int n) {
+    if (n <= 1) {
+        return 1;
+    }
+    return n * fact(n - 1);
+}
+
+int main() {
+    int a = sum_squares(10) + square(3);
+    int b = fact(5) + square(3);
+    return a + b - square(a);
+}
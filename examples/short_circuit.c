@@ -0,0 +1,27 @@
+int expensive(int x) {
+    int i = 0;
+    int s = 0;
+    while (i < 100) {
+        s = s + x;
+        i = i + 1;
+    }
+    return s;
+}
+
+int main() {
+    int a = 0;
+    int b = 7;
+    int r = 0;
+    if (a && expensive(1)) {
+        r = r + 1;
+    }
+    if (b || expensive(2)) {
+        r = r + 2;
+    }
+    if (!a && b > 5) {
+        r = r + 4;
+    }
+    int both = a && b;
+    int either = a || b;
+    return r + both + either * 8 + !b;
+}
@@ -0,0 +1,21 @@
+int count(int i, int n) {
+    int c = 0;
+    while (i < n) {
+        c = c + 1;
+        i = i + 1;
+    }
+    return c;
+}
+
+int upto(int i) {
+    int c = 0;
+    while (i < 2147483647) {
+        c = c + 1;
+        i = i + 1;
+    }
+    return c;
+}
+
+int main() {
+    return count(2147483645, 2147483647) + upto(2147483640);
+}
@@ -0,0 +1,13 @@
+int main() {
+    unsigned int u = (unsigned int)4000000000;
+    unsigned int five = (unsigned int)5;
+    unsigned int r = u > five;
+    int n = (int)r;
+    if ((int)(five < u)) {
+        n = n + 2;
+    }
+    if ((int)(u <= five)) {
+        n = n + 4;
+    }
+    return n;
+}
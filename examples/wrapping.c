@@ -0,0 +1,26 @@
+int main() {
+    char c = 100;
+    char d = c + c;
+    int x = (int)d;
+
+    unsigned int u = (unsigned int)4000000000;
+    unsigned int v = u + u;
+    unsigned int scale = (unsigned int)16777216;
+    unsigned int w = v / scale;
+    unsigned int limit = (unsigned int)300;
+
+    int a = 2147483647;
+    int b = a + 1;
+
+    int r = 0;
+    if (x < 0) {
+        r = r + 1;
+    }
+    if ((int)(w > limit)) {
+        r = r + 2;
+    }
+    if (b < 0) {
+        r = r + 4;
+    }
+    return r;
+}
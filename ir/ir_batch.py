@@ -0,0 +1,260 @@
+from ir.ir_cfg import get_call_graph, get_function_ranges, get_reachable_functions
+from ir.ir_tac import *
+from ir.ir_tacvm import get_register_slots
+from ir.ir_tacvm_memory import get_value_format, is_integer_type
+from typing import Callable, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# batched TAC execution over many lanes with numpy
+#
+# runs one function of the tac for N argument sets at once. every register holds an array
+# with one value per lane, so an instruction is one numpy operation over all of them.
+# lanes that branch differently split into groups, each a bool mask over the frame's
+# lanes and the pc it's at. the group with the lowest pc runs next and groups at the same
+# pc merge, which for tac laid out in source order is where the branches join again. a
+# call runs the callee for the lanes that made it, packed into shorter arrays.
+#
+# lanes have no memory, so code that pops, takes an address or goes through a pointer
+# can't run batched. integers are int64 instead of python ints and registers of smaller
+# types wrap to them like the vm's. dividing by zero gives inf or nan in that lane, or 0
+# for integers, instead of raising
+
+class NotBatchable(Exception):
+    pass
+
+def divide(left: object, right: object) -> object:
+    # c division like the vm's, integers truncate toward zero
+    if not np.issubdtype(np.result_type(left, right), np.integer):
+        return np.true_divide(left, right)
+    return np.where(right == 0, 0, (left - np.fmod(left, right)) // np.where(right == 0, 1, right))
+
+def wrap_lanes(val: "np.ndarray", c_type: str | None) -> "np.ndarray":
+    # what the lanes of a register of c_type hold, int64 already wraps like a long
+    if not is_integer_type(c_type) or not np.issubdtype(val.dtype, np.integer):
+        return val
+    value_format = get_value_format(c_type)
+    if value_format.size == 8:
+        return val
+    if value_format.sign_bit is None:
+        return val & value_format.mask
+    return ((val + value_format.sign_bit) & value_format.mask) - value_format.sign_bit
+
+def compare(compare_function: Callable) -> Callable:
+    # comparisons give 0 / 1 like the ints the vm's bools act as, numpy bools don't add up
+    return lambda left, right: compare_function(left, right).astype(np.int64)
+
+numpy_functions: Dict[str, Callable] = {} if np is None else {
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "imul": np.multiply,
+    "div": divide,
+    "eq": compare(np.equal),
+    "lt": compare(np.less),
+    "lte": compare(np.less_equal),
+    "gt": compare(np.greater),
+    "gte": compare(np.greater_equal),
+    "and": np.bitwise_and,
+    "or": np.bitwise_or,
+}
+
+# None means every lane of the frame
+LaneMask = Union["np.ndarray", None]
+
+def merge_masks(a: LaneMask, b: LaneMask) -> LaneMask:
+    return None if a is None or b is None else a | b
+
+def count_lanes(mask: LaneMask, lanes: int) -> int:
+    return lanes if mask is None else int(np.count_nonzero(mask))
+
+def as_lanes(val: object, lanes: int) -> "np.ndarray":
+    if isinstance(val, np.ndarray) and val.shape == (lanes,):
+        return val
+    return np.full(lanes, val, dtype=object if val is None else None)
+
+class BatchedVM:
+    def __init__(self, tac: TAC) -> None:
+        assert np is not None, "batched execution needs numpy"
+        self.tac = tac
+        self.ranges = get_function_ranges(tac)
+        self.register_slots, self.frame_sizes = get_register_slots(tac)
+
+        # instructions dispatched, and instructions run summed over the lanes that ran them
+        self.steps = 0
+        self.lane_steps = 0
+        self.max_call_depth = 0
+        # the entry function's result for every lane
+        self.return_vals: "np.ndarray" = None
+
+    def read(self, regs: List[object], operand: object) -> object:
+        if isinstance(operand, VirtualRegister):
+            return regs[self.register_slots[operand.register_idx]]
+        return operand
+
+    def write(self, regs: List[object], dest: VirtualRegister, val: object, mask: LaneMask, lanes: int):
+        slot = self.register_slots[dest.register_idx]
+        val = wrap_lanes(as_lanes(val, lanes), dest.val_type)
+        # lanes outside the mask keep their value, unless the register has none yet
+        regs[slot] = val if mask is None or regs[slot] is None else np.where(mask, val, regs[slot])
+
+    def get_params(self, fun_name: str) -> List[VirtualRegister]:
+        start, end = self.ranges[fun_name]
+        params = [ins for ins in self.tac.ir_code[start:end] if isinstance(ins, Params)]
+        return params[0].params_regs if params else []
+
+    def check_function(self, fun_name: str, is_entry: bool):
+        start, end = self.ranges[fun_name]
+        code = self.tac.ir_code
+
+        def check_operand(operand: object):
+            if not isinstance(operand, VirtualRegister) and not (operand is None or type(operand) in (int, float, bool)):
+                raise NotBatchable(f"{fun_name} uses {operand}, lanes have no memory")
+
+        for ins in code[start:end]:
+            if isinstance(ins, Pop):
+                raise NotBatchable(f"{fun_name} pops, lanes have no memory")
+            elif isinstance(ins, Move):
+                check_operand(ins.dest)
+                check_operand(ins.src)
+            elif isinstance(ins, Arithmetic):
+                assert ins.op in numpy_functions, "unknown operation"
+                for operand in (ins.dest, ins.left, ins.right):
+                    check_operand(operand)
+            elif isinstance(ins, Jump | JumpIf | JumpIfNot):
+                if not isinstance(ins.dest, Label) or not start <= ins.dest.ins_idx <= end:
+                    raise NotBatchable(f"{fun_name} jumps out of itself")
+                if ins.dest.ins_idx == end and not (is_entry and end == len(code)):
+                    raise NotBatchable(f"{fun_name} jumps into the function after it")
+                if not isinstance(ins, Jump):
+                    check_operand(ins.cond)
+            elif isinstance(ins, Call):
+                callee = str(ins.target)
+                if not callee in self.ranges or len(ins.args) != len(self.get_params(callee)):
+                    raise NotBatchable(f"{fun_name} calls {callee} with {len(ins.args)} args")
+                for operand in (ins.out_register, *ins.args):
+                    check_operand(operand)
+            elif isinstance(ins, Return):
+                check_operand(ins.src)
+
+        # only the entry can run off the end of the code, which halts its lanes
+        if (start == end or not isinstance(code[end - 1], Jump | Return)) and not (is_entry and end == len(code)):
+            raise NotBatchable(f"{fun_name} runs into the function after it")
+
+    def run_function(self, fun_name: str, args: List["np.ndarray"], lanes: int, depth: int) -> "np.ndarray":
+        # runs fun_name for lanes lanes and returns what each one returned
+        self.max_call_depth = max(self.max_call_depth, depth)
+        code = self.tac.ir_code
+        start, end = self.ranges[fun_name]
+        regs: List[object] = [None] * self.frame_sizes[fun_name]
+        result = None
+
+        # groups waiting to run, pc -> mask
+        pending: Dict[int, LaneMask] = {}
+        pc, mask, active = start, None, lanes
+        while True:
+            if pc == end:
+                # the entry ran off the end of the code, its lanes halt without a value
+                result = self.merge_result(result, None, mask, lanes)
+                pc = None
+            else:
+                ins = code[pc]
+                self.steps += 1
+                self.lane_steps += active
+
+                if isinstance(ins, Move):
+                    if isinstance(ins.dest, VirtualRegister):
+                        self.write(regs, ins.dest, self.read(regs, ins.src), mask, lanes)
+                    pc += 1
+
+                elif isinstance(ins, Arithmetic):
+                    left, right = self.read(regs, ins.left), self.read(regs, ins.right)
+                    if isinstance(ins.dest, VirtualRegister):
+                        self.write(regs, ins.dest, numpy_functions[ins.op](left, right), mask, lanes)
+                    pc += 1
+
+                elif isinstance(ins, Jump):
+                    pc = ins.dest.ins_idx
+
+                elif isinstance(ins, JumpIf | JumpIfNot):
+                    cond = self.read(regs, ins.cond)
+                    taken = cond != 0 if isinstance(ins, JumpIf) else cond == 0
+                    if np.ndim(taken) == 0:
+                        pc = ins.dest.ins_idx if taken else pc + 1
+                    else:
+                        if mask is not None:
+                            taken = taken & mask
+                        taken_count = int(np.count_nonzero(taken))
+                        if taken_count == active:
+                            pc = ins.dest.ins_idx
+                        elif taken_count == 0:
+                            pc += 1
+                        else:
+                            # the group splits, the lanes that jump wait at the target
+                            target = ins.dest.ins_idx
+                            pending[target] = merge_masks(pending[target], taken) if target in pending else taken
+                            mask = ~taken if mask is None else mask & ~taken
+                            active -= taken_count
+                            pc += 1
+
+                elif isinstance(ins, Call):
+                    args_vals = [as_lanes(self.read(regs, arg), lanes) for arg in ins.args]
+                    callee = str(ins.target)
+                    if mask is None:
+                        ret = self.run_function(callee, args_vals, lanes, depth + 1)
+                    else:
+                        # the callee only sees the lanes that called it
+                        lane_ids = np.flatnonzero(mask)
+                        packed = self.run_function(callee, [val[lane_ids] for val in args_vals], len(lane_ids), depth + 1)
+                        ret = np.empty(lanes, dtype=packed.dtype)
+                        ret[lane_ids] = packed
+                    if isinstance(ins.out_register, VirtualRegister):
+                        self.write(regs, ins.out_register, ret, mask, lanes)
+                    pc += 1
+
+                elif isinstance(ins, Params):
+                    for reg, val in zip(ins.params_regs, args):
+                        self.write(regs, reg, val, mask, lanes)
+                    pc += 1
+
+                elif isinstance(ins, Return):
+                    result = self.merge_result(result, self.read(regs, ins.src), mask, lanes)
+                    pc = None
+
+                else:
+                    pc += 1
+
+            # the lowest waiting pc runs next, whoever else is there joins it
+            if pending:
+                if pc is not None:
+                    pending[pc] = merge_masks(pending[pc], mask) if pc in pending else mask
+                pc = min(pending)
+                mask = pending.pop(pc)
+                active = count_lanes(mask, lanes)
+            elif pc is None:
+                return result
+
+    def merge_result(self, result: "np.ndarray", val: object, mask: LaneMask, lanes: int) -> "np.ndarray":
+        val = as_lanes(val, lanes)
+        return val if result is None or mask is None else np.where(mask, val, result)
+
+    def run(self, args: Sequence[Sequence[object]] = (), lanes: int = None, entry: str = "main") -> "np.ndarray":
+        # args holds one sequence per param of entry, with a value for every lane. lanes
+        # is only needed when entry has no params
+        params = self.get_params(entry)
+        assert len(args) == len(params), f"{entry} takes {len(params)} args"
+        arg_vals = [np.asarray(arg) for arg in args]
+        lanes = lanes if lanes is not None else len(arg_vals[0])
+        assert all(val.shape == (lanes,) for val in arg_vals), "every arg needs a value per lane"
+
+        self.check_function(entry, True)
+        for fun_name in get_reachable_functions(get_call_graph(self.tac), entry) - { entry }:
+            self.check_function(fun_name, False)
+
+        # lanes that aren't running still get computed on, whatever they hold
+        with np.errstate(all="ignore"):
+            self.return_vals = self.run_function(entry, arg_vals, lanes, 0)
+        return self.return_vals
@@ -0,0 +1,442 @@
+from ir.ir_tac import *
+from typing import Callable, Set, Tuple
+
+# control flow graphs over TAC functions
+#
+# a function's code is split into basic blocks kept in layout order. an unconditional
+# jump at the end of a block isn't stored as an instruction, it becomes the block's
+# next_block (same as falling through). write_back_cfgs lays the blocks out again and
+# only emits a jump when next_block isn't the block that follows in the layout
+
+def get_defs(ins: TACInstruction) -> List[VirtualRegister]:
+    if isinstance(ins, Move | Arithmetic | Pop):
+        return [ins.dest] if isinstance(ins.dest, VirtualRegister) else []
+    elif isinstance(ins, Call):
+        return [ins.out_register]
+    elif isinstance(ins, Params):
+        return list(ins.params_regs)
+
+    return []
+
+def get_operand_uses(operand: object) -> List[VirtualRegister]:
+    if isinstance(operand, VirtualRegister):
+        return [operand]
+    elif isinstance(operand, MemoryLocation):
+        return get_operand_uses(operand.location)
+
+    # stack slot addresses and udvals read no register
+    return []
+
+def get_uses(ins: TACInstruction) -> List[VirtualRegister]:
+    if isinstance(ins, Move):
+        # storing to memory reads the address register
+        dest_uses = get_operand_uses(ins.dest) if isinstance(ins.dest, MemoryLocation) else []
+        return get_operand_uses(ins.src) + dest_uses
+    elif isinstance(ins, Arithmetic):
+        return get_operand_uses(ins.left) + get_operand_uses(ins.right)
+    elif isinstance(ins, JumpIf | JumpIfNot):
+        return get_operand_uses(ins.cond)
+    elif isinstance(ins, Call):
+        return [reg for arg in ins.args for reg in get_operand_uses(arg)]
+    elif isinstance(ins, Return):
+        return get_operand_uses(ins.src)
+
+    return []
+
+def map_uses(ins: TACInstruction, fn: Callable[[object], object]) -> bool:
+    # replaces every operand the instruction reads with fn(operand). returns whether anything changed
+    def mapped(operand):
+        if isinstance(operand, MemoryLocation) and isinstance(operand.location, VirtualRegister):
+            location = fn(operand.location)
+            if location is operand.location:
+                return operand
+            return MemoryLocation(location, operand.offset)
+        elif isinstance(operand, VirtualRegister):
+            return fn(operand)
+        return operand
+
+    changed = False
+    def update(obj, field):
+        nonlocal changed
+        old = getattr(obj, field)
+        new = mapped(old)
+        if new is not old:
+            setattr(obj, field, new)
+            changed = True
+
+    if isinstance(ins, Move):
+        update(ins, "src")
+        if isinstance(ins.dest, MemoryLocation):
+            update(ins, "dest")
+    elif isinstance(ins, Arithmetic):
+        update(ins, "left")
+        update(ins, "right")
+    elif isinstance(ins, JumpIf | JumpIfNot):
+        update(ins, "cond")
+    elif isinstance(ins, Call):
+        new_args = [mapped(arg) for arg in ins.args]
+        if any(new is not old for new, old in zip(new_args, ins.args)):
+            ins.args = new_args
+            changed = True
+    elif isinstance(ins, Return):
+        update(ins, "src")
+
+    return changed
+
+def find_instruction(instructions: List[TACInstruction], ins: TACInstruction) -> int:
+    # instructions are dataclasses, so list.index would match equal but different instructions
+    return next(i for i, other in enumerate(instructions) if other is ins)
+
+def remove_instruction(instructions: List[TACInstruction], ins: TACInstruction):
+    del instructions[find_instruction(instructions, ins)]
+
+def is_integral_register(operand: object) -> bool:
+    if not isinstance(operand, VirtualRegister) or operand.val_type is None:
+        return False
+
+    return operand.val_type.removeprefix("unsigned ") in integral_types
+
+class BasicBlock:
+    def __init__(self, labels: List[str], instructions: List[TACInstruction]) -> None:
+        self.labels = labels
+        self.instructions = instructions
+
+        # successor when the block doesn't take its conditional branch. None after a return
+        # or when control falls off the end of the function
+        self.next_block: BasicBlock = None
+        self.branch_block: BasicBlock = None
+
+        self.succs: List[BasicBlock] = []
+        self.preds: List[BasicBlock] = []
+        self.layout_idx = 0
+
+    def get_branch(self) -> JumpIf | JumpIfNot | None:
+        if self.instructions and isinstance(self.instructions[-1], JumpIf | JumpIfNot):
+            return self.instructions[-1]
+        return None
+
+    def __repr__(self) -> str:
+        return f"BasicBlock({self.labels}, {len(self.instructions)} ins)"
+
+@dataclass
+class Loop:
+    header: BasicBlock
+    blocks: Set[BasicBlock]
+    latches: List[BasicBlock]
+
+    def get_exits(self) -> List[Tuple[BasicBlock, BasicBlock]]:
+        return [(b, s) for b in self.blocks for s in b.succs if not s in self.blocks]
+
+class FunctionCFG:
+    def __init__(self, tac: TAC, fun_name: str, start: int, end: int, labels: List[Tuple[str, int]]) -> None:
+        self.tac = tac
+        self.fun_name = fun_name
+        self.blocks: List[BasicBlock] = []
+
+        self.idom: Dict[BasicBlock, BasicBlock] = {}
+        self.reverse_postorder: List[BasicBlock] = []
+
+        self.split_blocks(start, end, labels)
+        self.compute_edges()
+
+    def split_blocks(self, start: int, end: int, labels: List[Tuple[str, int]]):
+        ins_idx_to_labels: Dict[int, List[str]] = {}
+        for label, ins_idx in labels:
+            ins_idx_to_labels.setdefault(ins_idx, []).append(label)
+
+        label_to_block: Dict[str, BasicBlock] = {}
+        # jumps are resolved to blocks after every block exists
+        pending_jumps: List[Tuple[BasicBlock, str]] = []
+
+        current: BasicBlock = None
+        is_terminated = False
+        falls_through = False
+
+        for i in range(start, end + 1):
+            labels_here = ins_idx_to_labels.get(i, [])
+
+            # labels past the last instruction still get an (empty) block
+            if i == end and not labels_here:
+                break
+
+            if current is None or labels_here or is_terminated:
+                block = BasicBlock(labels_here, [])
+                for label in labels_here:
+                    label_to_block[label] = block
+
+                if current is not None and falls_through:
+                    current.next_block = block
+
+                self.blocks.append(block)
+                current = block
+                is_terminated = False
+                falls_through = True
+
+            if i == end:
+                break
+
+            ins = self.tac.ir_code[i]
+            if isinstance(ins, Jump) and isinstance(ins.dest, Label | str):
+                pending_jumps.append((current, str(ins.dest)))
+                is_terminated = True
+                falls_through = False
+                continue
+
+            current.instructions.append(ins)
+            if isinstance(ins, JumpIf | JumpIfNot):
+                is_terminated = True
+            elif isinstance(ins, Return | Jump):
+                is_terminated = True
+                falls_through = False
+
+        for block, label in pending_jumps:
+            block.next_block = label_to_block[label]
+
+        self.label_to_block = label_to_block
+        for block in self.blocks:
+            branch = block.get_branch()
+            if branch:
+                block.branch_block = label_to_block[str(branch.dest)]
+
+    def compute_edges(self):
+        for i, block in enumerate(self.blocks):
+            block.layout_idx = i
+            block.preds = []
+            block.succs = []
+
+        for block in self.blocks:
+            for succ in [block.branch_block, block.next_block]:
+                if succ is not None and not succ in block.succs:
+                    block.succs.append(succ)
+                    succ.preds.append(block)
+
+        self.compute_dominators()
+
+    def compute_dominators(self):
+        # cooper, harvey, kennedy: iterate idoms over reverse postorder
+        visited = set()
+        postorder = []
+        stack = [(self.blocks[0], iter(self.blocks[0].succs))]
+        visited.add(self.blocks[0])
+        while stack:
+            block, succs = stack[-1]
+            for succ in succs:
+                if not succ in visited:
+                    visited.add(succ)
+                    stack.append((succ, iter(succ.succs)))
+                    break
+            else:
+                stack.pop()
+                postorder.append(block)
+
+        self.reverse_postorder = postorder[::-1]
+        rpo_idx = { b: i for i, b in enumerate(self.reverse_postorder) }
+
+        entry = self.blocks[0]
+        idom = { entry: entry }
+        changed = True
+        while changed:
+            changed = False
+            for block in self.reverse_postorder[1:]:
+                new_idom = None
+                for pred in block.preds:
+                    if not pred in idom:
+                        continue
+                    if new_idom is None:
+                        new_idom = pred
+                        continue
+
+                    a, b = pred, new_idom
+                    while a is not b:
+                        while rpo_idx[a] > rpo_idx[b]:
+                            a = idom[a]
+                        while rpo_idx[b] > rpo_idx[a]:
+                            b = idom[b]
+                    new_idom = a
+
+                if idom.get(block) is not new_idom:
+                    idom[block] = new_idom
+                    changed = True
+
+        self.idom = idom
+
+    def is_reachable(self, block: BasicBlock) -> bool:
+        return block in self.idom
+
+    def dominates(self, a: BasicBlock, b: BasicBlock) -> bool:
+        if not b in self.idom:
+            return False
+
+        while b is not a:
+            if self.idom[b] is b:
+                return False
+            b = self.idom[b]
+
+        return True
+
+    def get_dom_tree_children(self) -> Dict[BasicBlock, List[BasicBlock]]:
+        children = { b: [] for b in self.reverse_postorder }
+        for block in self.reverse_postorder[1:]:
+            children[self.idom[block]].append(block)
+
+        return children
+
+    def find_loops(self) -> List[Loop]:
+        # natural loops, one per header. innermost (smallest) loops come first
+        header_to_loop: Dict[BasicBlock, Loop] = {}
+
+        for block in self.reverse_postorder:
+            for succ in block.succs:
+                if not self.dominates(succ, block):
+                    continue
+
+                loop = header_to_loop.setdefault(succ, Loop(succ, { succ }, []))
+                loop.latches.append(block)
+
+                worklist = [block]
+                while worklist:
+                    b = worklist.pop()
+                    if b in loop.blocks:
+                        continue
+                    loop.blocks.add(b)
+                    worklist.extend(b.preds)
+
+        return sorted(header_to_loop.values(), key=lambda loop: len(loop.blocks))
+
+    def get_block_label(self, block: BasicBlock) -> Label:
+        if not block.labels:
+            block.labels.append(self.tac.get_next_pass_label("bb"))
+
+        return self.tac.get_label(block.labels[0])
+
+    def insert_block_before(self, block: BasicBlock, new_block: BasicBlock, preds: List[BasicBlock], layout_after: BasicBlock = None):
+        # redirects the edges from preds into block to go through new_block instead.
+        # new_block is placed after layout_after, or right before block
+        new_block.next_block = block
+
+        for pred in preds:
+            if pred.next_block is block:
+                pred.next_block = new_block
+            if pred.branch_block is block:
+                pred.branch_block = new_block
+                pred.get_branch().dest = self.get_block_label(new_block)
+
+        layout_idx = layout_after.layout_idx + 1 if layout_after else block.layout_idx
+        self.blocks.insert(layout_idx, new_block)
+
+        self.compute_edges()
+
+    def insert_preheader(self, loop: Loop) -> BasicBlock | None:
+        outside_preds = [p for p in loop.header.preds if not p in loop.blocks]
+        if not outside_preds or loop.header is self.blocks[0]:
+            return None
+
+        preheader = BasicBlock([], [])
+        # a single entering block lets the preheader sit right after it so no extra jump is needed
+        layout_after = outside_preds[0] if len(outside_preds) == 1 else None
+        self.insert_block_before(loop.header, preheader, outside_preds, layout_after)
+
+        return preheader
+
+    def remove_blocks(self, removed: Set[BasicBlock]):
+        self.blocks = [b for b in self.blocks if not b in removed]
+        self.compute_edges()
+
+    def remove_dead_labels(self):
+        # keeps labels that a branch names, and the first label of blocks that linearize
+        # will have to jump to. the function's own label always stays
+        referenced = { str(block.get_branch().dest) for block in self.blocks if block.get_branch() }
+        for i, block in enumerate(self.blocks):
+            next_in_layout = self.blocks[i + 1] if i + 1 < len(self.blocks) else None
+            if block.next_block is not None and block.next_block is not next_in_layout and block.next_block.labels:
+                referenced.add(block.next_block.labels[0])
+
+        for block in self.blocks[1:]:
+            block.labels = [label for label in block.labels if label in referenced]
+
+    def linearize(self) -> Tuple[List[TACInstruction], List[Tuple[str, int]]]:
+        # labels have to exist before code is emitted since jumps can go backwards
+        needs_jump = []
+        for i, block in enumerate(self.blocks):
+            next_in_layout = self.blocks[i + 1] if i + 1 < len(self.blocks) else None
+            needs_jump.append(block.next_block is not None and block.next_block is not next_in_layout)
+            if needs_jump[-1]:
+                self.get_block_label(block.next_block)
+
+        code = []
+        labels = []
+        for block, jump in zip(self.blocks, needs_jump):
+            for label in block.labels:
+                labels.append((label, len(code)))
+
+            code.extend(block.instructions)
+            if jump:
+                code.append(Jump(self.get_block_label(block.next_block)))
+
+        return code, labels
+
+    def get_instructions(self) -> List[TACInstruction]:
+        return [ins for block in self.blocks for ins in block.instructions]
+
+def get_function_labels(tac: TAC) -> Dict[str, List[Tuple[str, int]]]:
+    # labels in insertion order belong to the function whose label came before them.
+    # a label at the end of a function shares its index with the next function's label
+    fun_labels: Dict[str, List[Tuple[str, int]]] = {}
+    current = None
+    for label, ins_idx in tac.label_to_ins_idx.items():
+        if label in tac.fun_name_to_locals:
+            current = label
+            fun_labels[current] = []
+
+        fun_labels[current].append((label, ins_idx))
+
+    return fun_labels
+
+def get_function_ranges(tac: TAC) -> Dict[str, Tuple[int, int]]:
+    fun_names = [*get_function_labels(tac).keys()]
+    ranges = {}
+    for i, fun_name in enumerate(fun_names):
+        end = tac.label_to_ins_idx[fun_names[i + 1]] if i + 1 < len(fun_names) else len(tac.ir_code)
+        ranges[fun_name] = (tac.label_to_ins_idx[fun_name], end)
+
+    return ranges
+
+def build_cfgs(tac: TAC) -> Dict[str, FunctionCFG]:
+    fun_labels = get_function_labels(tac)
+    ranges = get_function_ranges(tac)
+
+    return { fun_name: FunctionCFG(tac, fun_name, *ranges[fun_name], fun_labels[fun_name]) for fun_name in fun_labels }
+
+def write_back_cfgs(tac: TAC, cfgs: Dict[str, FunctionCFG]):
+    code = []
+    label_to_ins_idx = {}
+    for cfg in cfgs.values():
+        fun_code, fun_labels = cfg.linearize()
+        for label, ins_idx in fun_labels:
+            label_to_ins_idx[label] = ins_idx + len(code)
+        code.extend(fun_code)
+
+    tac.ir_code = code
+    tac.instruction_idx = len(code)
+    tac.label_to_ins_idx = label_to_ins_idx
+    tac.resolve_labels()
+
+def get_call_graph(tac: TAC) -> Dict[str, Set[str]]:
+    call_graph = {}
+    for fun_name, (start, end) in get_function_ranges(tac).items():
+        call_graph[fun_name] = { str(ins.target) for ins in tac.ir_code[start:end] if isinstance(ins, Call) }
+
+    return call_graph
+
+def get_reachable_functions(call_graph: Dict[str, Set[str]], fun_name: str) -> Set[str]:
+    # every function that can be on the call stack above fun_name
+    reachable = set()
+    worklist = [*call_graph.get(fun_name, [])]
+    while worklist:
+        callee = worklist.pop()
+        if callee in reachable:
+            continue
+        reachable.add(callee)
+        worklist.extend(call_graph.get(callee, []))
+
+    return reachable
@@ -0,0 +1,192 @@
+from ir.ir_tac import *
+from array import array
+
+# compact encoding of TAC IR
+#
+# every instruction is an opcode byte plus a run of operands in a flat int array.
+# an operand is either a register number (reg_idx << 1) or an index into the
+# constant pool ((pool_idx << 1) | 1). immediates, labels, memory locations and
+# call targets all live in the constant pool
+#
+# arithmetic ops get their own opcode, so nothing has to compare op strings
+
+OP_MOVE = 0
+OP_JUMP = 1
+OP_JUMP_IF = 2
+OP_JUMP_IFNOT = 3
+OP_PARAMS = 4
+OP_CALL = 5
+OP_RETURN = 6
+OP_POP = 7
+
+alu_ops = ["add", "sub", "mul", "imul", "div", "eq", "lt", "lte", "gt", "gte", "and", "or"]
+OP_ALU_BASE = 16
+alu_op_to_opcode = { op: OP_ALU_BASE + i for i, op in enumerate(alu_ops) }
+
+def is_reg_operand(operand: int) -> bool:
+    return not operand & 1
+
+def operand_value(operand: int) -> int:
+    # register number or constant pool index
+    return operand >> 1
+
+class CompactTAC:
+    def __init__(self) -> None:
+        self.opcodes = array('B')
+        # operands of instruction i are operands[operand_starts[i]:operand_starts[i+1]]
+        self.operand_starts = array('I', [0])
+        self.operands = array('q')
+        self.const_pool: List[object] = []
+
+        # register number -> bound ir var (None for temporaries) and c type. names are always t<n>
+        self.reg_bound_vars: List[str] = []
+        self.reg_val_types: List[str] = []
+
+        self.label_to_ins_idx: Dict[str, int] = {}
+        self.fun_name_to_locals: Dict[str, List[str]] = {}
+        # ir var name -> encoded operand
+        self.variable_to_operand: Dict[str, int] = {}
+
+        # dedupes pool entries. immediates by value, objects by identity
+        self._const_to_pool_idx: Dict[object, int] = {}
+
+    @property
+    def reg_count(self) -> int:
+        return len(self.reg_bound_vars)
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def get_operands(self, ins_idx: int) -> array:
+        return self.operands[self.operand_starts[ins_idx]:self.operand_starts[ins_idx + 1]]
+
+    def nbytes(self) -> int:
+        # size of the instruction stream itself, excluding the constant pool objects
+        return sum(a.itemsize * len(a) for a in [self.opcodes, self.operand_starts, self.operands])
+
+    def encode_operand(self, operand: object) -> int:
+        if isinstance(operand, VirtualRegister):
+            return operand.register_idx << 1
+
+        if isinstance(operand, int | float | str | None):
+            # type is part of the key so 1, 1.0 and True stay different
+            key = (type(operand), operand)
+        else:
+            key = id(operand)
+
+        if not key in self._const_to_pool_idx:
+            self._const_to_pool_idx[key] = len(self.const_pool)
+            self.const_pool.append(operand)
+
+        return (self._const_to_pool_idx[key] << 1) | 1
+
+    def add_instruction(self, opcode: int, operands: List[object]):
+        self.opcodes.append(opcode)
+        self.operands.extend(self.encode_operand(operand) for operand in operands)
+        self.operand_starts.append(len(self.operands))
+
+    @staticmethod
+    def from_tac(tac: TAC) -> "CompactTAC":
+        result = CompactTAC()
+        result.reg_bound_vars = [None] * tac.variable_idx
+        result.reg_val_types = [None] * tac.variable_idx
+
+        for ins in tac.ir_code:
+            for reg in instruction_registers(ins):
+                result.reg_bound_vars[reg.register_idx] = reg.bound_ir_var
+                result.reg_val_types[reg.register_idx] = reg.val_type
+
+            if isinstance(ins, Move):
+                result.add_instruction(OP_MOVE, [ins.dest, ins.src, ins.ins_type])
+            elif isinstance(ins, Jump):
+                result.add_instruction(OP_JUMP, [ins.dest])
+            elif isinstance(ins, JumpIf):
+                result.add_instruction(OP_JUMP_IF, [ins.dest, ins.cond])
+            elif isinstance(ins, JumpIfNot):
+                result.add_instruction(OP_JUMP_IFNOT, [ins.dest, ins.cond])
+            elif isinstance(ins, Params):
+                result.add_instruction(OP_PARAMS, ins.params_regs)
+            elif isinstance(ins, Call):
+                result.add_instruction(OP_CALL, [ins.target, ins.out_register, *ins.args])
+            elif isinstance(ins, Return):
+                result.add_instruction(OP_RETURN, [ins.src])
+            elif isinstance(ins, Pop):
+                result.add_instruction(OP_POP, [ins.dest])
+            elif isinstance(ins, Arithmetic):
+                result.add_instruction(alu_op_to_opcode[ins.op], [ins.dest, ins.left, ins.right])
+            else:
+                assert False, f"cannot encode {ins}"
+
+        for var_ir_name, location in tac.variable_to_location.items():
+            if isinstance(location, VirtualRegister):
+                result.reg_bound_vars[location.register_idx] = location.bound_ir_var
+                result.reg_val_types[location.register_idx] = location.val_type
+            result.variable_to_operand[var_ir_name] = result.encode_operand(location)
+
+        result.label_to_ins_idx = dict(tac.label_to_ins_idx)
+        result.fun_name_to_locals = { k: list(v) for k, v in tac.fun_name_to_locals.items() }
+
+        return result
+
+    def to_tac(self) -> TAC:
+        tac = TAC()
+        regs = [VirtualRegister(f"t{i}", bound_ir_var, i, val_type)
+                for i, (bound_ir_var, val_type) in enumerate(zip(self.reg_bound_vars, self.reg_val_types))]
+        # memory locations can be shared between instructions, keep that sharing. stack slots
+        # carry no registers and are kept as they are
+        memo: Dict[int, object] = {}
+
+        def decode(operand: int) -> object:
+            if is_reg_operand(operand):
+                return regs[operand_value(operand)]
+            return copy_operand(self.const_pool[operand_value(operand)], regs, tac.labels, memo)
+
+        for i, opcode in enumerate(self.opcodes):
+            ops = [decode(operand) for operand in self.get_operands(i)]
+
+            if opcode == OP_MOVE:
+                tac.ir_code.append(Move(ops[2], ops[0], ops[1]))
+            elif opcode == OP_JUMP:
+                tac.ir_code.append(Jump(*ops))
+            elif opcode == OP_JUMP_IF:
+                tac.ir_code.append(JumpIf(*ops))
+            elif opcode == OP_JUMP_IFNOT:
+                tac.ir_code.append(JumpIfNot(*ops))
+            elif opcode == OP_PARAMS:
+                tac.ir_code.append(Params(ops))
+            elif opcode == OP_CALL:
+                tac.ir_code.append(Call(ops[0], ops[1], ops[2:]))
+            elif opcode == OP_RETURN:
+                tac.ir_code.append(Return(*ops))
+            elif opcode == OP_POP:
+                tac.ir_code.append(Pop(*ops))
+            else:
+                tac.ir_code.append(Arithmetic(ops[0], alu_ops[opcode - OP_ALU_BASE], ops[1], ops[2]))
+
+        tac.instruction_idx = len(tac.ir_code)
+        tac.variable_idx = self.reg_count
+        tac.variable_to_location = { k: decode(v) for k, v in self.variable_to_operand.items() }
+        tac.label_to_ins_idx = dict(self.label_to_ins_idx)
+        tac.fun_name_to_locals = { k: list(v) for k, v in self.fun_name_to_locals.items() }
+        tac.resolve_labels()
+
+        return tac
+
+def copy_operand(operand: object, regs: List[VirtualRegister], labels: Dict[str, Label], memo: Dict[int, object]) -> object:
+    # rebuilds pooled memory locations so they point at the new register objects
+    if isinstance(operand, VirtualRegister):
+        return regs[operand.register_idx]
+
+    if isinstance(operand, Label):
+        return labels.setdefault(operand.name, Label(operand.name))
+
+    if not isinstance(operand, MemoryLocation | UDVal):
+        return operand
+
+    if not id(operand) in memo:
+        if isinstance(operand, MemoryLocation):
+            memo[id(operand)] = MemoryLocation(copy_operand(operand.location, regs, labels, memo), operand.offset)
+        else:
+            memo[id(operand)] = UDVal(operand.annotation, copy_operand(operand.val, regs, labels, memo))
+
+    return memo[id(operand)]
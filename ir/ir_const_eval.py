@@ -0,0 +1,160 @@
+from ir.ir_cfg import *
+from ir.ir_tacvm import TACVM, divide, run_typed_alu
+from ir.ir_tacvm_memory import is_integer_type, wrap_value
+from dataclasses import fields
+
+# compile-time evaluation of pure calls
+#
+# a call whose arguments are all literals and whose function is pure is run on a TACVM
+# while compiling, and the FunCallNode is replaced by a LiteralNode with the result. a
+# function is pure when it never touches memory and only calls pure functions, so its
+# result depends on nothing but its arguments. every run has a step budget, and anything
+# that goes wrong in the vm just leaves the call alone
+#
+# the vm computes like native code: every value put in a register wraps to its c type,
+# so an overflow along the way gives what it would at runtime, and division truncates. a
+# division that traps natively, by zero or like INT_MIN / -1, leaves the call to runtime.
+# only integer results are folded, wrapped to the type of the call
+
+def is_pure_instruction(ins: TACInstruction) -> bool:
+    if isinstance(ins, Pop):
+        return False
+
+    operands = []
+    for f in fields(ins):
+        operand = getattr(ins, f.name)
+        operands.extend(operand if isinstance(operand, list) else [operand])
+
+    return not any(isinstance(operand, MemoryLocation | UDVal) for operand in operands)
+
+def get_pure_functions(tac: TAC) -> Set[str]:
+    # starts from the functions that are pure on their own, then drops callers of impure
+    # functions until nothing changes. recursion is fine
+    call_graph = get_call_graph(tac)
+    pure = set()
+    for fun_name, (start, end) in get_function_ranges(tac).items():
+        if all(is_pure_instruction(ins) for ins in tac.ir_code[start:end]):
+            pure.add(fun_name)
+
+    changed = True
+    while changed:
+        changed = False
+        for fun_name in list(pure):
+            if any(not callee in pure for callee in call_graph[fun_name]):
+                pure.discard(fun_name)
+                changed = True
+
+    return pure
+
+class PureCallEvaluator:
+    def __init__(self, ast: SourceFileNode, max_steps: int = 100000) -> None:
+        self.ast = ast
+        self.max_steps = max_steps
+
+        # the ast is lowered once up front, every evaluation runs on this code
+        self.tac = TAC()
+        self.tac.tac_source_file(ast)
+
+        self.pure_functions = get_pure_functions(self.tac)
+
+        # one vm for every evaluation, each starts from the snapshot of the fresh one
+        self.vm = TACVM(self.tac)
+        self.vm.snapshot()
+
+        # (function, args) -> result, None when it couldn't be evaluated
+        self.memo: Dict[Tuple[str, Tuple[object, ...]], object] = {}
+
+        self.folded_count = 0
+        self.memo_hits = 0
+        self.failed_count = 0
+
+    def can_evaluate(self, fun_name: str) -> bool:
+        return fun_name in self.pure_functions
+
+    def run_call(self, fun_name: str, args: List[object]) -> object:
+        vm = self.vm
+        vm.reset()
+        vm.start_function(fun_name, args)
+
+        code = self.tac.ir_code
+        # with an empty caller stack, the function's return halts the vm
+        while vm.pc < len(code):
+            if vm.steps >= self.max_steps or self.traps(code[vm.pc]):
+                return None
+            vm.run_instruction()
+            vm.steps += 1
+
+        return vm.return_val
+
+    def traps(self, ins: TACInstruction) -> bool:
+        # whether ins is a division native code would trap on
+        if not isinstance(ins, Arithmetic) or ins.op != "div":
+            return False
+        left, right = self.vm.get_src_val(ins.left), self.vm.get_src_val(ins.right)
+        if right == 0:
+            return True
+        dest_type = ins.dest.val_type if isinstance(ins.dest, VirtualRegister) else None
+        return run_typed_alu("div", left, right, dest_type) != divide(left, right)
+
+    def evaluate(self, fun_name: str, args: List[object], result_type: str) -> object:
+        key = (fun_name, tuple((type(arg), arg) for arg in args))
+        if key in self.memo:
+            self.memo_hits += 1
+            return self.memo[key]
+
+        try:
+            result = self.run_call(fun_name, args)
+        except Exception:
+            # the sandbox gives up on anything going wrong, the call happens at runtime instead
+            result = None
+
+        if not isinstance(result, int) or not is_integer_type(result_type):
+            result = None
+        else:
+            # a returned constant hasn't been through a register of the return type
+            result = wrap_value(result, result_type)
+
+        self.memo[key] = result
+        if result is None:
+            self.failed_count += 1
+
+        return result
+
+    def fold_expr(self, expr: object) -> object:
+        # returns the node to put in place of expr
+        if isinstance(expr, list):
+            return [self.fold_expr(x) for x in expr]
+        if not isinstance(expr, ASTNode):
+            return expr
+
+        for f in fields(expr):
+            child = getattr(expr, f.name)
+            if isinstance(child, ASTNode | list):
+                setattr(expr, f.name, self.fold_expr(child))
+
+        if not isinstance(expr, FunCallNode) or not self.can_evaluate(expr.fun_name):
+            return expr
+        if not all(isinstance(arg, LiteralNode) and isinstance(arg.val, int | float) for arg in expr.args):
+            return expr
+
+        result = self.evaluate(expr.fun_name, [arg.val for arg in expr.args], expr.get_inferred_type())
+        if result is None:
+            return expr
+
+        literal = LiteralNode(result, line_number=expr.line_number, char_number=expr.char_number)
+        literal.set_inferred_type(expr.get_inferred_type())
+        self.folded_count += 1
+
+        return literal
+
+    def run(self):
+        for fun_def in self.ast.fun_defs:
+            fun_def.body = self.fold_expr(fun_def.body)
+
+def evaluate_pure_calls(ast: SourceFileNode, max_steps: int = 100000) -> Tuple[int, int, int]:
+    # returns how many calls were replaced, how many were answered from the memo and how
+    # many evaluations gave up
+    evaluator = PureCallEvaluator(ast, max_steps)
+    evaluator.run()
+
+    return evaluator.folded_count, evaluator.memo_hits, evaluator.failed_count
@@ -0,0 +1,216 @@
+from ir.ir_cfg import *
+from ir.ir_loops import get_def_sites, get_use_sites, is_single_def_temp
+
+# dominator scoped global value numbering over TAC
+#
+# blocks are visited down the dominator tree. every register and constant gets a value
+# number, and an arithmetic instruction gets the value number of (op, left vn, right vn).
+# when a dominating block already computed that value into a single-def temporary (the
+# leader), the instruction is dropped and its uses read the leader instead. a move of a
+# value the destination already holds is dropped too. results wrap to the type of the
+# register they go to, so the type is part of an expression's key and a move into a
+# register of another type makes a new value
+#
+# registers can be assigned more than once, so a value number only flows from a block into
+# the dominator tree child if no block on a path between the two redefines the register
+
+commutative_ops = {"add", "mul", "imul", "and", "or", "eq"}
+
+class GlobalValueNumbering:
+    def __init__(self, cfg: FunctionCFG) -> None:
+        self.cfg = cfg
+        self.tac = cfg.tac
+        self.removed_count = 0
+
+        self.next_vn = 0
+        # register idx -> value number it holds at the current point
+        self.reg_vn: Dict[int, int] = {}
+        # (op, vn, vn) -> value number
+        self.expr_vn: Dict[Tuple[str, int, int], int] = {}
+        # value number -> single-def temporary holding it
+        self.vn_leader: Dict[int, VirtualRegister] = {}
+        self.const_vn: Dict[Tuple[type, object], int] = {}
+        # (table, key, old value) so leaving a block undoes what it added
+        self.undo_log: List[Tuple[dict, object, object]] = []
+
+        self.def_sites = get_def_sites(cfg.blocks)
+        self.use_sites = get_use_sites(cfg.blocks)
+        self.block_defs = { block: { reg.register_idx for ins in block.instructions for reg in get_defs(ins) } for block in cfg.blocks }
+
+    def new_vn(self) -> int:
+        self.next_vn += 1
+        return self.next_vn
+
+    def set_scoped(self, table: dict, key: object, value: object):
+        self.undo_log.append((table, key, table.get(key, None)))
+        table[key] = value
+
+    def undo_to(self, log_len: int):
+        while len(self.undo_log) > log_len:
+            table, key, old = self.undo_log.pop()
+            if old is None:
+                del table[key]
+            else:
+                table[key] = old
+
+    def get_vn(self, operand: object) -> int | None:
+        # None for memory and stack addresses, whose values aren't tracked
+        if isinstance(operand, VirtualRegister):
+            if not operand.register_idx in self.reg_vn:
+                self.set_scoped(self.reg_vn, operand.register_idx, self.new_vn())
+            return self.reg_vn[operand.register_idx]
+
+        if isinstance(operand, int | float):
+            key = (type(operand), operand)
+            if not key in self.const_vn:
+                self.const_vn[key] = self.new_vn()
+            return self.const_vn[key]
+
+        return None
+
+    def get_killed_registers(self, dom: BasicBlock, block: BasicBlock) -> Set[int]:
+        # registers defined on a path from dom to block that doesn't pass through dom again.
+        # block itself counts when it's on a cycle that avoids dom, like a loop header
+        if block.preds == [dom]:
+            return set()
+
+        forward = set()
+        worklist = list(dom.succs)
+        while worklist:
+            b = worklist.pop()
+            if b is dom or b in forward:
+                continue
+            forward.add(b)
+            worklist.extend(b.succs)
+
+        backward = set()
+        worklist = list(block.preds)
+        while worklist:
+            b = worklist.pop()
+            if b is dom or b in backward:
+                continue
+            backward.add(b)
+            worklist.extend(b.preds)
+
+        killed = set()
+        for b in forward & backward:
+            killed |= self.block_defs[b]
+
+        return killed
+
+    def can_replace(self, reg: VirtualRegister, def_block: BasicBlock) -> bool:
+        if not is_single_def_temp(reg, self.def_sites):
+            return False
+
+        return all(self.cfg.dominates(def_block, use_block)
+                   for use_block, use_ins in self.use_sites.get(reg.register_idx, []))
+
+    def replace_with_leader(self, reg: VirtualRegister, leader: VirtualRegister):
+        for _, use_ins in self.use_sites.get(reg.register_idx, []):
+            map_uses(use_ins, lambda use: leader if use.register_idx == reg.register_idx else use)
+
+        self.removed_count += 1
+
+    def define(self, reg: VirtualRegister, vn: int):
+        self.set_scoped(self.reg_vn, reg.register_idx, vn)
+        if is_single_def_temp(reg, self.def_sites) and not vn in self.vn_leader:
+            self.set_scoped(self.vn_leader, vn, reg)
+
+    def number_arithmetic(self, block: BasicBlock, ins: Arithmetic) -> bool:
+        # returns whether the instruction is redundant and was removed
+        left, right = self.get_vn(ins.left), self.get_vn(ins.right)
+        if left is None or right is None:
+            self.define(ins.dest, self.new_vn())
+            return False
+
+        if ins.op in commutative_ops and right < left:
+            left, right = right, left
+        key = (ins.op, left, right, ins.dest.val_type)
+
+        vn = self.expr_vn.get(key)
+        if vn is None:
+            vn = self.new_vn()
+            self.set_scoped(self.expr_vn, key, vn)
+
+        leader = self.vn_leader.get(vn)
+        if leader is not None and self.can_replace(ins.dest, block):
+            self.replace_with_leader(ins.dest, leader)
+            self.set_scoped(self.reg_vn, ins.dest.register_idx, vn)
+            return True
+
+        self.define(ins.dest, vn)
+        return False
+
+    def number_move(self, block: BasicBlock, ins: Move) -> bool:
+        vn = self.get_vn(ins.src)
+        if vn is None or getattr(ins.src, "val_type", ins.dest.val_type) != ins.dest.val_type:
+            self.define(ins.dest, self.new_vn())
+            return False
+
+        if self.reg_vn.get(ins.dest.register_idx) == vn:
+            self.removed_count += 1
+            return True
+
+        leader = self.vn_leader.get(vn)
+        if leader is not None and leader is not ins.dest and self.can_replace(ins.dest, block):
+            self.replace_with_leader(ins.dest, leader)
+            self.set_scoped(self.reg_vn, ins.dest.register_idx, vn)
+            return True
+
+        self.define(ins.dest, vn)
+        return False
+
+    def number_block(self, block: BasicBlock):
+        new_instructions = []
+        for ins in block.instructions:
+            removed = False
+            if isinstance(ins, Arithmetic) and isinstance(ins.dest, VirtualRegister):
+                removed = self.number_arithmetic(block, ins)
+            elif isinstance(ins, Move) and isinstance(ins.dest, VirtualRegister):
+                removed = self.number_move(block, ins)
+            else:
+                # loads, calls, params and pops produce values nothing else is known to equal
+                for reg in get_defs(ins):
+                    self.define(reg, self.new_vn())
+
+            if not removed:
+                new_instructions.append(ins)
+
+        block.instructions = new_instructions
+
+    def run(self):
+        children = self.cfg.get_dom_tree_children()
+        entry = self.cfg.blocks[0]
+
+        # (block, undo log length before entering it). a None block marks leaving one
+        stack: List[Tuple[BasicBlock | None, int]] = [(entry, 0)]
+        while stack:
+            block, log_len = stack.pop()
+            if block is None:
+                self.undo_to(log_len)
+                continue
+
+            dom = self.cfg.idom[block]
+            if dom is not block:
+                for reg_idx in self.get_killed_registers(dom, block):
+                    self.set_scoped(self.reg_vn, reg_idx, self.new_vn())
+
+            self.number_block(block)
+
+            # undo this block's scope after all of its dominator tree children are done
+            stack.append((None, log_len))
+            for child in reversed(children[block]):
+                stack.append((child, len(self.undo_log)))
+
+def value_number(tac: TAC, cfgs: Dict[str, FunctionCFG] = None) -> int:
+    # returns how many instructions were removed
+    cfgs = cfgs if cfgs is not None else build_cfgs(tac)
+    removed = 0
+    for cfg in cfgs.values():
+        gvn = GlobalValueNumbering(cfg)
+        gvn.run()
+        removed += gvn.removed_count
+
+    write_back_cfgs(tac, cfgs)
+
+    return removed
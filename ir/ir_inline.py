@@ -0,0 +1,231 @@
+from ir.ir_cfg import *
+from dataclasses import fields
+import copy
+
+# function inlining over TAC
+#
+# a call to a small enough function is replaced with a copy of the callee's body:
+# parameters become moves of the arguments, returns become a move to the call's out
+# register plus a jump past the copy. every register and label of the callee gets a
+# fresh copy per call site and the callee's locals are renamed and become locals of
+# the caller
+
+@dataclass
+class InlineReport:
+    inlined: List[Tuple[str, str]] # (caller, callee)
+    skipped_recursive: List[Tuple[str, str]]
+    skipped_too_large: List[Tuple[str, str]]
+    skipped_growth: List[Tuple[str, str]]
+    size_before: int = 0
+    size_after: int = 0
+
+    def __str__(self) -> str:
+        lines = [f"inlined {len(self.inlined)} call sites, ir size {self.size_before} -> {self.size_after}"]
+        for reason, sites in [("recursive", self.skipped_recursive), ("callee too large", self.skipped_too_large),
+                              ("growth limit", self.skipped_growth)]:
+            if sites:
+                lines.append(f"  skipped ({reason}): " + ', '.join(f"{caller}->{callee}" for caller, callee in sites))
+
+        return '\n'.join(lines)
+
+class Inliner:
+    def __init__(self, tac: TAC, call_graph: Dict[str, Set[str]] = None, max_callee_size: int = 16, max_caller_growth: float = 2.0,
+                 max_total_growth: float = 1.5) -> None:
+        self.tac = tac
+        # callees with more instructions than this are never inlined
+        self.max_callee_size = max_callee_size
+        # a caller may grow to this many times its original size
+        self.max_caller_growth = max_caller_growth
+        # the whole program may grow to this many times its original size
+        self.max_total_growth = max_total_growth
+
+        self.call_graph = call_graph if call_graph is not None else get_call_graph(tac)
+        self.inline_count = 0
+
+        self.report = InlineReport([], [], [], [])
+
+        # function name -> (code, labels relative to the function start)
+        self.fun_code: Dict[str, Tuple[List[TACInstruction], List[Tuple[str, int]]]] = {}
+        ranges = get_function_ranges(tac)
+        for fun_name, labels in get_function_labels(tac).items():
+            start, end = ranges[fun_name]
+            self.fun_code[fun_name] = (tac.ir_code[start:end], [(label, idx - start) for label, idx in labels])
+
+    def is_recursive(self, fun_name: str) -> bool:
+        return fun_name in get_reachable_functions(self.call_graph, fun_name)
+
+    def get_inline_order(self) -> List[str]:
+        # callees before their callers, so a callee's own inlined calls come along with it
+        order = []
+        visited = set()
+        def visit(fun_name):
+            if fun_name in visited or not fun_name in self.fun_code:
+                return
+            visited.add(fun_name)
+            for callee in sorted(self.call_graph.get(fun_name, [])):
+                visit(callee)
+            order.append(fun_name)
+
+        for fun_name in self.fun_code:
+            visit(fun_name)
+
+        return order
+
+    def get_callee_size(self, callee: str) -> int:
+        # params become one move per argument
+        code, _ = self.fun_code[callee]
+        return sum(len(ins.params_regs) if isinstance(ins, Params) else 1 for ins in code)
+
+    def run(self) -> InlineReport:
+        total_size = len(self.tac.ir_code)
+        self.report.size_before = total_size
+        # tiny functions may always take at least one callee's worth of growth
+        max_total_size = max(total_size * self.max_total_growth, total_size + self.max_callee_size)
+
+        for caller in self.get_inline_order():
+            code, labels = self.fun_code[caller]
+            max_caller_size = max(len(code) * self.max_caller_growth, len(code) + self.max_callee_size)
+            caller_size = len(code)
+
+            new_code = []
+            new_labels = []
+            ins_idx_to_labels: Dict[int, List[str]] = {}
+            for label, idx in labels:
+                ins_idx_to_labels.setdefault(idx, []).append(label)
+
+            for i in range(len(code) + 1):
+                for label in ins_idx_to_labels.get(i, []):
+                    new_labels.append((label, len(new_code)))
+
+                if i == len(code):
+                    break
+
+                ins = code[i]
+                if not isinstance(ins, Call) or not str(ins.target) in self.fun_code:
+                    new_code.append(ins)
+                    continue
+
+                callee = str(ins.target)
+                site = (caller, callee)
+                growth = self.get_callee_size(callee) - 1
+
+                if self.is_recursive(callee):
+                    self.report.skipped_recursive.append(site)
+                elif self.get_callee_size(callee) > self.max_callee_size:
+                    self.report.skipped_too_large.append(site)
+                elif caller_size + growth > max_caller_size or total_size + growth > max_total_size:
+                    self.report.skipped_growth.append(site)
+                else:
+                    inlined_code, inlined_labels = self.inline_call(caller, ins)
+                    new_labels.extend((label, idx + len(new_code)) for label, idx in inlined_labels)
+                    new_code.extend(inlined_code)
+
+                    caller_size += growth
+                    total_size += growth
+                    self.report.inlined.append(site)
+                    continue
+
+                new_code.append(ins)
+
+            self.fun_code[caller] = (new_code, new_labels)
+
+        self.write_back()
+        self.report.size_after = len(self.tac.ir_code)
+
+        return self.report
+
+    def write_back(self):
+        code = []
+        label_to_ins_idx = {}
+        for fun_code, fun_labels in self.fun_code.values():
+            for label, idx in fun_labels:
+                label_to_ins_idx[label] = idx + len(code)
+            code.extend(fun_code)
+
+        self.tac.ir_code = code
+        self.tac.instruction_idx = len(code)
+        self.tac.label_to_ins_idx = label_to_ins_idx
+        self.tac.resolve_labels()
+
+    def inline_call(self, caller: str, call: Call) -> Tuple[List[TACInstruction], List[Tuple[str, int]]]:
+        callee = str(call.target)
+        code, labels = self.fun_code[callee]
+        self.inline_count += 1
+        suffix = f"inl{self.inline_count}"
+
+        reg_map: Dict[int, VirtualRegister] = {}
+        # memory locations, udvals and stack slots can be shared between instructions
+        memo: Dict[int, object] = {}
+
+        def clone_reg(reg: VirtualRegister) -> VirtualRegister:
+            if not reg.register_idx in reg_map:
+                new_reg = self.tac.get_next_virt_register(val_type=reg.val_type)
+                if reg.bound_ir_var:
+                    self.tac.bind_local(caller, new_reg, f"{reg.bound_ir_var}_{suffix}")
+                reg_map[reg.register_idx] = new_reg
+
+            return reg_map[reg.register_idx]
+
+        def clone_operand(operand: object) -> object:
+            if isinstance(operand, VirtualRegister):
+                return clone_reg(operand)
+            elif isinstance(operand, Label):
+                # calls keep pointing at the real function
+                return self.tac.get_label(label_map.get(operand.name, operand.name))
+            elif isinstance(operand, list):
+                return [clone_operand(x) for x in operand]
+            elif not isinstance(operand, MemoryLocation | UDVal | StackSlot):
+                return operand
+
+            if not id(operand) in memo:
+                new_operand = copy.copy(operand)
+                memo[id(operand)] = new_operand
+                if isinstance(operand, StackSlot):
+                    # every inlined copy gets its own slot in the caller's frame
+                    new_operand.name = f"{operand.name}_{suffix}"
+                    self.tac.bind_local(caller, MemoryLocation(new_operand), new_operand.name)
+                elif isinstance(operand, MemoryLocation):
+                    new_operand.location = clone_operand(operand.location)
+                else:
+                    new_operand.val = clone_operand(operand.val)
+
+            return memo[id(operand)]
+
+        label_map = { label: self.tac.get_next_pass_label(suffix) for label, _ in labels if label != callee }
+        end_label = self.tac.get_next_pass_label(suffix)
+
+        new_code = []
+        new_labels = []
+        ins_idx_to_labels: Dict[int, List[str]] = {}
+        for label, idx in labels:
+            if label in label_map:
+                ins_idx_to_labels.setdefault(idx, []).append(label_map[label])
+
+        last_idx = len(code) - 1
+        for i, ins in enumerate(code):
+            for label in ins_idx_to_labels.get(i, []):
+                new_labels.append((label, len(new_code)))
+
+            if isinstance(ins, Params):
+                for param_reg, arg in zip(ins.params_regs, call.args):
+                    new_code.append(Move(None, clone_reg(param_reg), arg))
+            elif isinstance(ins, Return):
+                new_code.append(Move(None, call.out_register, clone_operand(ins.src)))
+                if i != last_idx:
+                    new_code.append(Jump(self.tac.get_label(end_label)))
+            else:
+                new_ins = copy.copy(ins)
+                for field in fields(ins):
+                    setattr(new_ins, field.name, clone_operand(getattr(ins, field.name)))
+                new_code.append(new_ins)
+
+        # labels past the callee's last instruction land on the end label too
+        for label in ins_idx_to_labels.get(len(code), []):
+            new_labels.append((label, len(new_code)))
+        new_labels.append((end_label, len(new_code)))
+
+        return new_code, new_labels
+
+def inline_functions(tac: TAC, call_graph: Dict[str, Set[str]] = None, max_callee_size: int = 16, max_caller_growth: float = 2.0,
+                     max_total_growth: float = 1.5) -> InlineReport:
+    return Inliner(tac, call_graph, max_callee_size, max_caller_growth, max_total_growth).run()
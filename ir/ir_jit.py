@@ -0,0 +1,343 @@
+from ir.ir_cfg import get_call_graph, get_function_ranges, get_reachable_functions
+from ir.ir_tac import *
+from ir.ir_tacvm import TACVM, divide, get_wrapped_type, is_integer_operand, word_size
+from ir.ir_tacvm_memory import get_value_format, wrap_value
+from types import CodeType
+from typing import Callable, Sequence
+import math
+import sys
+
+# translates TAC functions into python functions for the TACVM
+#
+# every TAC function becomes one generated python function. registers are its locals,
+# params are its arguments and calls are python calls, so the python frame plays the
+# part of the vm's Frame. code a jump can land on gets an "if pc == <ins idx>:" arm in a
+# dispatch while loop, and everything else runs straight through the arm before it.
+# stack slots are at fixed offsets from fp, the sp the function's frame starts at.
+# memory, sp and the steps, branches and max_call_depth counters are the vm's own, so a
+# run leaves the vm with the same results as TACVM.run. steps are added once per
+# straight run of instructions and flushed to the vm on return, so they aren't exact
+# after a MemoryFault.
+#
+# the source only names the objects it uses, never their ids, so functions that come out
+# the same share one compile() across vms and tacs. code the translation doesn't handle,
+# like computed jumps or functions running off into the next one, makes the whole run
+# fall back to TACVM.run
+
+python_operators: Dict[str, str] = {
+    "add": "+",
+    "sub": "-",
+    "mul": "*",
+    "imul": "*",
+    "eq": "==",
+    "lt": "<",
+    "lte": "<=",
+    "gt": ">",
+    "gte": ">=",
+    "and": "&",
+    "or": "|",
+}
+
+class NotCompilable(Exception):
+    pass
+
+class JITHalt(Exception):
+    # control ran off the end of the code, which halts the vm wherever it happens
+    pass
+
+# generated source -> its code object
+code_cache: Dict[str, CodeType] = {}
+
+def get_function_name(fun_name: str) -> str:
+    return f"F_{fun_name}"
+
+class FunctionSource:
+    # the source of one generated function, with the objects it names
+    def __init__(self, fun_name: str) -> None:
+        self.fun_name = fun_name
+        self.lines: List[str] = []
+        self.constants: Dict[str, object] = {}
+        self.constant_names: Dict[int, str] = {}
+
+    def emit(self, line: str, indent: int):
+        self.lines.append("    " * indent + line)
+
+    def get_constant(self, val: object) -> str:
+        if val is None or type(val) in (int, bool) or (type(val) is float and math.isfinite(val)):
+            return repr(val)
+
+        if not id(val) in self.constant_names:
+            name = f"{self.fun_name}_k{len(self.constants)}"
+            self.constant_names[id(val)] = name
+            self.constants[name] = val
+        return self.constant_names[id(val)]
+
+    def get_source(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+class TACJIT:
+    def __init__(self, vm: TACVM) -> None:
+        self.vm = vm
+        self.tac = vm.tac
+        self.ranges = get_function_ranges(self.tac)
+
+        memory = vm.memory
+        # what the generated functions see as globals, they find each other here too
+        self.namespace: Dict[str, object] = {
+            "vm": vm,
+            "load": memory.load,
+            "store": memory.store,
+            "divide": divide,
+            "wrap_value": wrap_value,
+            "check_stack": memory.check_stack,
+            "guard_size": memory.guard_size,
+            "JITHalt": JITHalt,
+        }
+        self.functions: Dict[str, Callable] = {}
+        self.sources: Dict[str, str] = {}
+        # why the last run fell back to TACVM.run, if it did
+        self.fallback_reason: str = None
+
+    def get_operand(self, source: FunctionSource, operand: object) -> str:
+        # python expression for get_src_val(operand)
+        if isinstance(operand, VirtualRegister):
+            return operand.register_name
+        elif isinstance(operand, StackSlot):
+            return f"(fp - {-self.vm.slot_offsets[id(operand)]})"
+        elif isinstance(operand, UDVal):
+            return self.get_operand(source, operand.val)
+        elif isinstance(operand, MemoryLocation):
+            return f"load({self.get_address(source, operand)}, {self.vm.get_memory_type(operand)!r})"
+
+        return source.get_constant(operand)
+
+    def get_stored_operand(self, source: FunctionSource, operand: object) -> str:
+        # python expression for get_stored_val(operand)
+        if not isinstance(operand, VirtualRegister | MemoryLocation | StackSlot):
+            return source.get_constant(operand)
+        return self.get_operand(source, operand)
+
+    def get_address(self, source: FunctionSource, mem_loc: MemoryLocation) -> str:
+        if isinstance(mem_loc.location, StackSlot):
+            return f"fp - {-(self.vm.slot_offsets[id(mem_loc.location)] + mem_loc.offset)}"
+        elif isinstance(mem_loc.location, VirtualRegister | UDVal):
+            address = self.get_operand(source, mem_loc.location)
+            return f"{address} + {mem_loc.offset}" if mem_loc.offset else address
+
+        return source.get_constant(mem_loc.location + mem_loc.offset)
+
+    def get_store(self, source: FunctionSource, dest: object, val: str, is_wrapped: bool = False) -> List[str]:
+        # values going into a register wrap to its type, unless is_wrapped says they did
+        if isinstance(dest, VirtualRegister):
+            if dest.val_type is not None and not is_wrapped:
+                val = f"wrap_value({val}, {dest.val_type!r})"
+            return [f"{dest.register_name} = {val}"]
+        elif isinstance(dest, MemoryLocation):
+            return [f"store({self.get_address(source, dest)}, {self.vm.get_memory_type(dest)!r}, {val})"]
+        return []
+
+    def get_params(self, fun_name: str) -> List[VirtualRegister]:
+        start, end = self.ranges[fun_name]
+        params = [ins for ins in self.tac.ir_code[start:end] if isinstance(ins, Params)]
+        if len(params) > 1:
+            raise NotCompilable(f"{fun_name} takes its params more than once")
+        return params[0].params_regs if params else []
+
+    def get_jump(self, fun_name: str, target: object, flush: List[str]) -> List[str]:
+        if not isinstance(target, Label):
+            raise NotCompilable(f"{fun_name} has a computed jump")
+
+        start, end = self.ranges[fun_name]
+        if start <= target.ins_idx < end:
+            return [f"pc = {target.ins_idx}", "continue"]
+        return self.get_fall_off(fun_name, flush)
+
+    def get_fall_off(self, fun_name: str, flush: List[str]) -> List[str]:
+        # running past the last function's code halts the vm, past any other function's it
+        # would run the next one in the same frame
+        if self.ranges[fun_name][1] != len(self.tac.ir_code):
+            raise NotCompilable(f"{fun_name} runs into the function after it")
+        return [*flush, "raise JITHalt()"]
+
+    def get_arithmetic(self, source: FunctionSource, ins: Arithmetic) -> str:
+        # python expression for the value the vm writes to ins.dest
+        assert ins.op in python_operators or ins.op == "div", "unknown operation"
+        left, right = self.get_operand(source, ins.left), self.get_operand(source, ins.right)
+        result = f"divide({left}, {right})" if ins.op == "div" else f"{left} {python_operators[ins.op]} {right}"
+
+        wrapped_type = get_wrapped_type(ins)
+        if wrapped_type is None:
+            return result
+        elif not is_integer_operand(ins.left) or not is_integer_operand(ins.right):
+            return f"wrap_value({result}, {wrapped_type!r})"
+
+        value_format = get_value_format(wrapped_type)
+        if value_format.sign_bit is None:
+            return f"({result}) & {value_format.mask}"
+        return f"(({result}) + {value_format.sign_bit} & {value_format.mask}) - {value_format.sign_bit}"
+
+    def translate_instruction(self, source: FunctionSource, ins: TACInstruction, flush: List[str]) -> List[str]:
+        fun_name = source.fun_name
+        if isinstance(ins, Move):
+            # copies between registers of the same type have nothing to wrap
+            is_wrapped = isinstance(ins.src, VirtualRegister) and getattr(ins.dest, "val_type", None) in (None, ins.src.val_type)
+            return self.get_store(source, ins.dest, self.get_stored_operand(source, ins.src), is_wrapped)
+
+        elif isinstance(ins, Arithmetic):
+            return self.get_store(source, ins.dest, self.get_arithmetic(source, ins), True)
+
+        elif isinstance(ins, Jump):
+            return ["branches += 1", *self.get_jump(fun_name, ins.dest, flush)]
+
+        elif isinstance(ins, JumpIf | JumpIfNot):
+            compare = "!=" if isinstance(ins, JumpIf) else "=="
+            jump = self.get_jump(fun_name, ins.dest, flush)
+            return ["branches += 1", f"if {self.get_operand(source, ins.cond)} {compare} 0:", *["    " + line for line in jump]]
+
+        elif isinstance(ins, Call):
+            callee = str(ins.target)
+            if not isinstance(ins.target, Label) or not callee in self.ranges:
+                raise NotCompilable(f"{fun_name} calls {callee}, which isn't a function")
+            if len(ins.args) != len(self.get_params(callee)):
+                raise NotCompilable(f"{fun_name} calls {callee} with {len(ins.args)} args")
+
+            args = ''.join(f", {self.get_operand(source, arg)}" for arg in ins.args)
+            frame_size = self.vm.frame_bytes[callee]
+            lines = ["if depth >= vm.max_call_depth:", "    vm.max_call_depth = depth + 1",
+                     "sp = vm.sp", f"vm.sp = sp - {frame_size}", "if vm.sp < guard_size:", "    check_stack(vm.sp)"]
+            return [*lines, f"ret = {get_function_name(callee)}(depth + 1{args})", "vm.sp = sp", *self.get_store(source, ins.out_register, "ret")]
+
+        elif isinstance(ins, Params):
+            return [line for i, reg in enumerate(ins.params_regs) for line in self.get_store(source, reg, f"p{i}")]
+
+        elif isinstance(ins, Return):
+            # the entry function returns get_src_val and a callee get_stored_val, they only
+            # differ for udvals
+            if isinstance(ins.src, UDVal):
+                raise NotCompilable(f"{fun_name} returns an address")
+            return [*flush, f"return {self.get_stored_operand(source, ins.src)}"]
+
+        elif isinstance(ins, Pop):
+            pop_type = ins.dest.val_type if isinstance(ins.dest, VirtualRegister) else None
+            return [*self.get_store(source, ins.dest, f"load(vm.sp, {pop_type!r})"),
+                    f"vm.sp += {get_value_format(pop_type).size}"]
+
+        return []
+
+    def translate(self, fun_name: str) -> FunctionSource:
+        start, end = self.ranges[fun_name]
+        code = self.tac.ir_code
+        source = FunctionSource(fun_name)
+
+        registers: Dict[int, VirtualRegister] = {}
+        has_stack_slots = False
+        for ins in code[start:end]:
+            for reg in instruction_registers(ins):
+                registers[reg.register_idx] = reg
+            has_stack_slots = has_stack_slots or bool(instruction_stack_slots(ins))
+
+        # where jumps land, and where the straight runs of instructions start
+        targets = { ins.dest.ins_idx for ins in code[start:end]
+                    if isinstance(ins, Jump | JumpIf | JumpIfNot) and isinstance(ins.dest, Label) and start <= ins.dest.ins_idx < end }
+        leaders = sorted({ start, *targets, *(i + 1 for i in range(start, end) if isinstance(code[i], Jump | JumpIf | JumpIfNot | Return)) })
+        leaders = [i for i in leaders if i < end] + [end]
+        has_branches = any(isinstance(ins, Jump | JumpIf | JumpIfNot) for ins in code[start:end])
+        flush = ["vm.steps += steps", *(["vm.branches += branches"] if has_branches else [])]
+
+        params = ''.join(f", p{i}" for i in range(len(self.get_params(fun_name))))
+        source.emit(f"def {get_function_name(fun_name)}(depth{params}):", 0)
+        if registers:
+            source.emit(f"{' = '.join(registers[idx].register_name for idx in sorted(registers))} = None", 1)
+        if has_stack_slots:
+            # the caller took the frame off the stack right before the call
+            source.emit(f"fp = vm.sp + {self.vm.frame_bytes[fun_name]}", 1)
+        source.emit("steps = 0", 1)
+        if has_branches:
+            source.emit("branches = 0", 1)
+
+        indent = 1
+        if targets:
+            source.emit(f"pc = {start}", 1)
+            source.emit("while True:", 1)
+            indent = 3
+
+        for leader, next_leader in zip(leaders, leaders[1:]):
+            if targets and (leader == start or leader in targets):
+                # falling into the next arm
+                if leader != start and not isinstance(code[leader - 1], Jump | Return):
+                    source.emit(f"pc = {leader}", indent)
+                source.emit(f"if pc == {leader}:", 2)
+
+            source.emit(f"steps += {next_leader - leader}", indent)
+            for ins in code[leader:next_leader]:
+                for line in self.translate_instruction(source, ins, flush):
+                    source.emit(line, indent)
+
+        if start == end or not isinstance(code[end - 1], Jump | Return):
+            for line in self.get_fall_off(fun_name, flush):
+                source.emit(line, 2 if targets else 1)
+
+        return source
+
+    def compile_function(self, fun_name: str) -> Callable:
+        source = self.translate(fun_name)
+        text = source.get_source()
+        if not text in code_cache:
+            code_cache[text] = compile(text, f"<jit {fun_name}>", "exec")
+
+        self.namespace.update(source.constants)
+        exec(code_cache[text], self.namespace)
+        self.sources[fun_name] = text
+        self.functions[fun_name] = self.namespace[get_function_name(fun_name)]
+        return self.functions[fun_name]
+
+    def compile_functions(self, entry: str, arg_count: int):
+        # every function the entry can call has to exist before the first call
+        if len(self.get_params(entry)) != arg_count:
+            raise NotCompilable(f"{entry} doesn't take {arg_count} args")
+
+        for fun_name in [entry, *sorted(get_reachable_functions(get_call_graph(self.tac), entry) - { entry })]:
+            if not fun_name in self.functions:
+                self.compile_function(fun_name)
+
+    def call(self, entry: str, args: Sequence[object] = ()) -> object:
+        # TACVM.call for the jit, compiled functions are kept between calls
+        vm = self.vm
+        if vm.saved is None:
+            vm.snapshot()
+        else:
+            vm.reset()
+
+        self.run(entry, args)
+        return vm.return_val
+
+    def run(self, entry: str = "main", args: Sequence[object] = ()):
+        vm = self.vm
+        self.fallback_reason = None
+        try:
+            self.compile_functions(entry, len(args))
+        except NotCompilable as e:
+            self.fallback_reason = str(e)
+
+        if self.fallback_reason:
+            vm.run(entry=entry, args=args)
+            return
+
+        vm.set_current_function(entry)
+
+        # python frames stand in for the vm's, the stack overflows before this many of them
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, vm.memory.size // (2 * word_size) + 100))
+        # the entry's frame, like TACVM.start_function
+        sp = vm.sp
+        vm.sp -= vm.frame_bytes[entry]
+        try:
+            vm.memory.check_stack(vm.sp)
+            vm.return_val = self.functions[entry](0, *args)
+        except JITHalt:
+            pass
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            vm.sp = sp
+
+        vm.pc = len(self.tac.ir_code)
@@ -0,0 +1,241 @@
+from ir.ir_cfg import *
+
+# loop optimizations over TAC
+#
+# loop-invariant code motion moves arithmetic whose operands don't change inside a loop
+# into a preheader block. strength reduction replaces multiplications of an induction
+# variable by a constant with a register that is bumped alongside the induction variable.
+#
+# both only touch temporaries that have a single definition, which is what tac_binary
+# produces, so a definition dominates all of its uses like it would in ssa form
+
+def get_def_sites(blocks: List[BasicBlock]) -> Dict[int, List[Tuple[BasicBlock, TACInstruction]]]:
+    def_sites = {}
+    for block in blocks:
+        for ins in block.instructions:
+            for reg in get_defs(ins):
+                def_sites.setdefault(reg.register_idx, []).append((block, ins))
+
+    return def_sites
+
+def get_use_sites(blocks: List[BasicBlock]) -> Dict[int, List[Tuple[BasicBlock, TACInstruction]]]:
+    use_sites = {}
+    for block in blocks:
+        for ins in block.instructions:
+            for reg in get_uses(ins):
+                use_sites.setdefault(reg.register_idx, []).append((block, ins))
+
+    return use_sites
+
+def is_single_def_temp(reg: object, fun_def_sites: Dict[int, list]) -> bool:
+    return isinstance(reg, VirtualRegister) and reg.bound_ir_var is None and \
+        len(fun_def_sites.get(reg.register_idx, [])) == 1
+
+def find_basic_induction_variables(loop_def_sites: Dict[int, list]) -> Dict[int, Tuple[VirtualRegister, int, TACInstruction]]:
+    # register idx -> (register, step per update, the instruction that updates it)
+    # an induction variable is defined once in the loop as i = i +/- c, either directly
+    # or through a temporary like tac_binary + tac_stmt_assign produce
+    ivs = {}
+    for reg_idx, sites in loop_def_sites.items():
+        if len(sites) != 1:
+            continue
+
+        _, update_ins = sites[0]
+        add_ins = update_ins
+        if isinstance(update_ins, Move) and isinstance(update_ins.src, VirtualRegister):
+            src_sites = loop_def_sites.get(update_ins.src.register_idx, [])
+            if len(src_sites) != 1:
+                continue
+            add_ins = src_sites[0][1]
+
+        if not isinstance(add_ins, Arithmetic) or not add_ins.op in ["add", "sub"]:
+            continue
+
+        iv = get_defs(update_ins)[0]
+        if not is_integral_register(iv):
+            continue
+
+        left, right = add_ins.left, add_ins.right
+        if add_ins.op == "add" and isinstance(left, int) and right == iv:
+            left, right = right, left
+
+        if left == iv and isinstance(right, int) and not isinstance(right, bool):
+            step = right if add_ins.op == "add" else -right
+            ivs[reg_idx] = (iv, step, update_ins)
+
+    return ivs
+
+class LoopOptimizer:
+    def __init__(self, cfg: FunctionCFG) -> None:
+        self.cfg = cfg
+        self.tac = cfg.tac
+
+        self.hoisted_count = 0
+        self.reduced_count = 0
+
+    def optimize(self, do_licm: bool = True, do_strength_reduction: bool = True):
+        # loops are found again after every preheader insertion, since the preheader
+        # of an inner loop becomes part of the outer one
+        done_headers = set()
+        while True:
+            loops = [loop for loop in self.cfg.find_loops() if not loop.header in done_headers]
+            if not loops:
+                break
+
+            loop = loops[0]
+            done_headers.add(loop.header)
+
+            preheader = None
+            if do_licm:
+                preheader = self.hoist_invariants(loop)
+            if do_strength_reduction:
+                self.reduce_induction_variables(loop, preheader)
+
+    def get_preheader(self, loop: Loop, preheader: BasicBlock | None) -> BasicBlock | None:
+        return preheader if preheader else self.cfg.insert_preheader(loop)
+
+    def is_invariant_operand(self, operand: object, loop_def_sites: Dict[int, list], invariant_regs: Set[int]) -> bool:
+        if isinstance(operand, int | float):
+            return True
+
+        if isinstance(operand, VirtualRegister):
+            return not operand.register_idx in loop_def_sites or operand.register_idx in invariant_regs
+
+        # memory can change under us
+        return False
+
+    def uses_dominated_by(self, reg: VirtualRegister, block: BasicBlock, ins: TACInstruction, use_sites: Dict[int, list]) -> bool:
+        for use_block, use_ins in use_sites.get(reg.register_idx, []):
+            if use_block is block:
+                if find_instruction(block.instructions, use_ins) < find_instruction(block.instructions, ins):
+                    return False
+            elif not self.cfg.dominates(block, use_block):
+                return False
+
+        return True
+
+    def hoist_invariants(self, loop: Loop) -> BasicBlock | None:
+        fun_def_sites = get_def_sites(self.cfg.blocks)
+        fun_use_sites = get_use_sites(self.cfg.blocks)
+        loop_blocks = sorted(loop.blocks, key=lambda b: b.layout_idx)
+        loop_def_sites = get_def_sites(loop_blocks)
+
+        invariant_regs: Set[int] = set()
+        hoisted: List[Tuple[BasicBlock, Arithmetic]] = []
+
+        changed = True
+        while changed:
+            changed = False
+            for block in loop_blocks:
+                for ins in block.instructions:
+                    # division can trap, so it stays where it is in case the loop doesn't run
+                    if not isinstance(ins, Arithmetic) or ins.op == "div":
+                        continue
+                    if not is_single_def_temp(ins.dest, fun_def_sites) or ins.dest.register_idx in invariant_regs:
+                        continue
+                    if not all(self.is_invariant_operand(op, loop_def_sites, invariant_regs) for op in [ins.left, ins.right]):
+                        continue
+                    if not self.uses_dominated_by(ins.dest, block, ins, fun_use_sites):
+                        continue
+
+                    invariant_regs.add(ins.dest.register_idx)
+                    hoisted.append((block, ins))
+                    changed = True
+
+        if not hoisted:
+            return None
+
+        preheader = self.cfg.insert_preheader(loop)
+        if not preheader:
+            return None
+
+        for block, ins in hoisted:
+            remove_instruction(block.instructions, ins)
+            preheader.instructions.append(ins)
+
+        self.hoisted_count += len(hoisted)
+
+        return preheader
+
+    def reduce_induction_variables(self, loop: Loop, preheader: BasicBlock | None):
+        fun_def_sites = get_def_sites(self.cfg.blocks)
+        fun_use_sites = get_use_sites(self.cfg.blocks)
+        loop_blocks = sorted(loop.blocks, key=lambda b: b.layout_idx)
+        loop_def_sites = get_def_sites(loop_blocks)
+
+        ivs = find_basic_induction_variables(loop_def_sites)
+        if not ivs:
+            return
+
+        # (iv register idx, factor) -> register holding iv * factor
+        reduced_regs: Dict[Tuple[int, int], VirtualRegister] = {}
+
+        for block in loop_blocks:
+            for ins in list(block.instructions):
+                if not isinstance(ins, Arithmetic) or not ins.op in ["mul", "imul"]:
+                    continue
+
+                iv_operand, factor = ins.left, ins.right
+                if not isinstance(iv_operand, VirtualRegister) or not iv_operand.register_idx in ivs:
+                    iv_operand, factor = factor, iv_operand
+
+                if not isinstance(iv_operand, VirtualRegister) or not iv_operand.register_idx in ivs:
+                    continue
+
+                # the factor is a constant or an integer register that the loop never writes
+                if isinstance(factor, VirtualRegister):
+                    if factor.register_idx in loop_def_sites or not is_integral_register(factor):
+                        continue
+                elif not isinstance(factor, int) or isinstance(factor, bool):
+                    continue
+                if not is_single_def_temp(ins.dest, fun_def_sites) or not is_integral_register(ins.dest):
+                    continue
+
+                uses = fun_use_sites.get(ins.dest.register_idx, [])
+                if any(not use_block in loop.blocks for use_block, _ in uses):
+                    continue
+
+                preheader = self.get_preheader(loop, preheader)
+                if not preheader:
+                    return
+
+                iv, step, update_ins = ivs[iv_operand.register_idx]
+                key = (iv.register_idx, factor if isinstance(factor, int) else f"t{factor.register_idx}")
+                if not key in reduced_regs:
+                    reduced = self.tac.get_next_virt_register(val_type=ins.dest.val_type)
+                    preheader.instructions.append(Arithmetic(reduced, ins.op, iv, factor))
+
+                    if isinstance(factor, int):
+                        increment = step * factor
+                    else:
+                        increment = self.tac.get_next_virt_register(val_type=ins.dest.val_type)
+                        preheader.instructions.append(Arithmetic(increment, ins.op, factor, step))
+
+                    # keep reduced == iv * factor right after every update of iv
+                    update_block = next(b for b, site_ins in loop_def_sites[iv.register_idx] if site_ins is update_ins)
+                    update_idx = find_instruction(update_block.instructions, update_ins)
+                    update_block.instructions.insert(update_idx + 1, Arithmetic(reduced, "add", reduced, increment))
+
+                    reduced_regs[key] = reduced
+
+                reduced = reduced_regs[key]
+                remove_instruction(block.instructions, ins)
+                for use_block, use_ins in uses:
+                    map_uses(use_ins, lambda reg: reduced if reg is ins.dest else reg)
+
+                self.reduced_count += 1
+
+def optimize_loops(tac: TAC, cfgs: Dict[str, FunctionCFG] = None, do_licm: bool = True, do_strength_reduction: bool = True) -> Tuple[int, int]:
+    # returns how many instructions were hoisted and how many multiplications were reduced.
+    # cfgs are the pass manager's, kept in sync with the tac
+    cfgs = cfgs if cfgs is not None else build_cfgs(tac)
+    hoisted, reduced = 0, 0
+    for cfg in cfgs.values():
+        optimizer = LoopOptimizer(cfg)
+        optimizer.optimize(do_licm, do_strength_reduction)
+        hoisted += optimizer.hoisted_count
+        reduced += optimizer.reduced_count
+
+    write_back_cfgs(tac, cfgs)
+
+    return hoisted, reduced
@@ -0,0 +1,209 @@
+from ir.ir_passes import *
+from ir.ir_compact import CompactTAC
+from cgen.x86_cgen import X86VirtCodeGen, Jump as X86Jump, JumpIf as X86JumpIf, JumpIfNot as X86JumpIfNot, JumpCmp as X86JumpCmp
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_right
+import re
+
+# per function lowering and optimization in a process pool
+#
+# after checking, every function only needs its own FunDefNode to be lowered, and the
+# per_function passes only look at one function. each function is compiled on its own
+# with every counter starting at 0, so its registers and .L labels live in their own
+# namespace. serially, lowering numbers every function before the first pass runs, and
+# each pass numbers the new registers and labels of every function before the next one
+# starts. workers remember their counters after lowering and after each pass, and
+# stitching gives every (function, phase) range of numbers the place it has in that
+# order, so the output is the same as a serial run over the whole file.
+#
+# jobs=1 runs the same thing in this process, so the output doesn't depend on the number
+# of jobs or on which worker finishes first
+#
+# workers send their tac back as a CompactTAC. its flat arrays pickle into about half the
+# bytes of the instruction objects
+
+label_number = re.compile(r"^\.L(\d+)_(.*)$")
+
+# one function's number -> the whole file's number
+Renumbering = Callable[[int], int]
+
+@dataclass
+class FunctionResult:
+    fun_name: str
+    tac: CompactTAC | None
+    x86: X86VirtCodeGen | None
+    stats: List[PassStats]
+    # (variable_idx, current_label_idx) of the tac before lowering, after it and after each pass
+    counters: List[Tuple[int, int]]
+
+def compile_function(fun_def: FunDefNode, passes: List[str], emit_tac: bool, emit_x86: bool, use_virt_regs: bool = False) -> FunctionResult:
+    # runs in a worker, everything it needs comes in through the pickled arguments
+    pass_manager = get_default_pass_manager(verify=False, track_memory=False)
+
+    counters = [(0, 0)]
+    if emit_tac:
+        tac = TAC()
+        pass_manager.tac = tac
+        pass_manager.timed("tac_gen", lambda: tac.tac_fun_def(fun_def))
+        tac.resolve_labels()
+        counters.append((tac.variable_idx, tac.current_label_idx))
+
+        for name in passes:
+            pass_manager.run_pass(name)
+            counters.append((pass_manager.tac.variable_idx, pass_manager.tac.current_label_idx))
+
+    x86 = None
+    if emit_x86:
+        x86 = X86VirtCodeGen(use_virt_regs)
+        pass_manager.timed("x86_gen", lambda: x86.x86_fun_def(fun_def), "ast")
+
+    compact_tac = CompactTAC.from_tac(pass_manager.tac) if emit_tac else None
+    return FunctionResult(fun_def.fun_name, compact_tac, x86, pass_manager.stats, counters)
+
+def renumber_label(name: str, renumber: Renumbering) -> str:
+    # function labels aren't numbered
+    match = label_number.match(name)
+    if not match:
+        return name
+    return f".L{renumber(int(match.group(1)))}_{match.group(2)}"
+
+def get_renumberings(marks: List[List[int]]) -> Tuple[List[Renumbering], int]:
+    # marks[f] holds function f's counter at the start of every phase and at the end.
+    # phase by phase, each function's range follows the same phase of the functions before
+    # it. returns a renumbering per function and the total
+    phase_count = len(marks[0]) - 1
+    bases = [[0] * phase_count for _ in marks]
+    total = 0
+    for phase in range(phase_count):
+        for fun_idx, fun_marks in enumerate(marks):
+            bases[fun_idx][phase] = total
+            total += fun_marks[phase + 1] - fun_marks[phase]
+
+    def get_renumbering(fun_marks: List[int], fun_bases: List[int]) -> Renumbering:
+        def renumber(idx: int) -> int:
+            phase = min(bisect_right(fun_marks, idx) - 1, phase_count - 1)
+            return fun_bases[phase] + idx - fun_marks[phase]
+        return renumber
+
+    return [get_renumbering(fun_marks, fun_bases) for fun_marks, fun_bases in zip(marks, bases)], total
+
+def stitch_tac(results: List[FunctionResult]) -> TAC:
+    tac = TAC()
+    renumber_regs, tac.variable_idx = get_renumberings([[reg_idx for reg_idx, _ in result.counters] for result in results])
+    renumber_labels, tac.current_label_idx = get_renumberings([[label_idx for _, label_idx in result.counters] for result in results])
+
+    for result, renumber_reg, renumber_label_idx in zip(results, renumber_regs, renumber_labels):
+        fun_tac = result.tac.to_tac()
+        ins_offset = len(tac.ir_code)
+
+        # registers are shared objects, each one is renumbered once
+        registers: Dict[int, VirtualRegister] = {}
+        for ins in fun_tac.ir_code:
+            for reg in instruction_registers(ins):
+                registers[id(reg)] = reg
+        for location in fun_tac.variable_to_location.values():
+            if isinstance(location, VirtualRegister):
+                registers[id(location)] = location
+
+        for reg in registers.values():
+            reg.register_idx = renumber_reg(reg.register_idx)
+            reg.register_name = f"t{reg.register_idx}"
+
+        tac.variable_to_location.update(fun_tac.variable_to_location)
+        for fun_name, local_names in fun_tac.fun_name_to_locals.items():
+            tac.fun_name_to_locals[fun_name] = list(local_names)
+
+        for label, ins_idx in fun_tac.label_to_ins_idx.items():
+            tac.label_to_ins_idx[renumber_label(label, renumber_label_idx)] = ins_idx + ins_offset
+
+        # jumps and calls point at the labels of the stitched tac
+        for ins in fun_tac.ir_code:
+            if isinstance(ins, Jump | JumpIf | JumpIfNot):
+                ins.dest = tac.get_label(renumber_label(str(ins.dest), renumber_label_idx))
+            elif isinstance(ins, Call):
+                ins.target = tac.get_label(str(ins.target))
+            tac.ir_code.append(ins)
+
+    tac.instruction_idx = len(tac.ir_code)
+    tac.resolve_labels()
+
+    return tac
+
+def stitch_x86(results: List[FunctionResult]) -> X86VirtCodeGen:
+    x86 = X86VirtCodeGen()
+    for result in results:
+        fun_x86 = result.x86
+        # x86 only has the one phase, every function's labels follow the ones before it
+        label_offset, ins_offset = x86.current_label_idx, x86.instruction_idx
+        offset = lambda idx: idx + label_offset
+
+        for label, ins_idx in fun_x86.label_to_ins_idx.items():
+            x86.label_to_ins_idx[renumber_label(label, offset)] = ins_idx + ins_offset
+
+        for ins in fun_x86.ir_code:
+            if isinstance(ins, X86Jump | X86JumpIf | X86JumpIfNot | X86JumpCmp):
+                ins.dest = renumber_label(ins.dest, offset)
+            x86.ir_code.append(ins)
+
+        x86.instruction_idx += fun_x86.instruction_idx
+        x86.current_label_idx += fun_x86.current_label_idx
+
+    return x86
+
+def merge_stats(results: List[FunctionResult]) -> List[PassStats]:
+    # one row per pass with the time summed over every function, in first seen order. the
+    # rows are indented under the one timing the whole pool
+    merged: Dict[str, PassStats] = {}
+    for result in results:
+        for stats in result.stats:
+            if not stats.name in merged:
+                merged[stats.name] = PassStats(f"  {stats.name}", 0, None, None, None)
+            row = merged[stats.name]
+            row.seconds += stats.seconds
+            if stats.size_after is not None:
+                row.size_before = (row.size_before or 0) + (stats.size_before or 0)
+                row.size_after = (row.size_after or 0) + stats.size_after
+
+    return [*merged.values()]
+
+def split_per_function_passes(pass_manager: PassManager, passes: List[str]) -> Tuple[List[str], List[str]]:
+    # the leading per function passes run in the workers, the rest on the stitched tac
+    i = 0
+    while i < len(passes) and pass_manager.passes[passes[i]].per_function:
+        i += 1
+
+    return passes[:i], passes[i:]
+
+def compile_functions(pass_manager: PassManager, passes: List[str], jobs: int,
+                      emit_tac: bool = True, emit_x86: bool = False, use_virt_regs: bool = False) -> X86VirtCodeGen | None:
+    # lowers (and emits x86 for) every function of the checked ast, running the per
+    # function passes among passes in the workers and the rest after stitching. the
+    # stitched tac ends up in pass_manager.tac
+    ast = pass_manager.get_ir("ast")
+    per_function, rest = split_per_function_passes(pass_manager, passes)
+    args = [(fun_def, per_function, emit_tac, emit_x86, use_virt_regs) for fun_def in ast.fun_defs]
+
+    def run_functions():
+        if jobs == 1:
+            return [compile_function(*arg) for arg in args]
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # map keeps the source order no matter which worker finishes first
+            return list(pool.map(compile_function, *zip(*args), chunksize=max(1, len(args) // (jobs * 4))))
+
+    results = pass_manager.timed(f"functions -j{jobs}", run_functions, "ast")
+    pass_manager.stats.extend(merge_stats(results))
+
+    x86 = stitch_x86(results) if emit_x86 else None
+    if emit_tac:
+        def stitch():
+            pass_manager.tac = stitch_tac(results)
+
+        pass_manager.timed("stitch", stitch)
+        pass_manager.invalidate("tac")
+        if pass_manager.verify:
+            pass_manager.verify_ir("stitch")
+
+        pass_manager.run(rest)
+
+    return x86
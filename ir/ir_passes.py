@@ -0,0 +1,225 @@
+from c_ast.semantics import Checker
+from ir.ir_cfg import *
+from ir.ir_verify import verify_tac, verify_cfgs, verify_call_graph
+from ir.ir_inline import inline_functions
+from ir.ir_tailcall import eliminate_tail_recursion
+from ir.ir_loops import optimize_loops
+from ir.ir_unroll import unroll_loops
+from ir.ir_gvn import value_number
+from ir.ir_sccp import propagate_constants
+from ir.ir_const_eval import evaluate_pure_calls
+from dataclasses import field
+import time
+import tracemalloc
+
+# pass manager over the AST and TAC
+#
+# analyses compute something about the ir and get cached until a transform of the same
+# ir runs that doesn't list them in preserves. transforms change the ir in place, and get
+# the analyses they list in requires passed after the ir, in that order. a transform that
+# preserves an analysis it was given keeps that result up to date with its changes.
+# every pass that actually runs gets a PassStats entry with its wall time, peak
+# allocation (through tracemalloc) and how the TAC instruction count changed
+
+@dataclass
+class PassInfo:
+    name: str
+    run: Callable[[object], object]
+    ir: str # "ast" or "tac"
+    is_analysis: bool
+    # analyses still valid after this transform runs
+    preserves: List[str] = field(default_factory=list)
+    # analyses this transform takes
+    requires: List[str] = field(default_factory=list)
+    # only looks at one function at a time, so it can run on each function on its own
+    per_function: bool = False
+    # for analyses, raises AssertionError when a cached result no longer matches the ir
+    verify: Callable[[object, object], None] = None
+
+@dataclass
+class PassStats:
+    name: str
+    seconds: float
+    peak_bytes: int | None # None when memory tracking is off
+    size_before: int | None # TAC instruction counts, None for AST passes
+    size_after: int | None
+    result: object = None
+
+    def __str__(self) -> str:
+        if self.size_after is None:
+            size = ""
+        elif self.size_before is None:
+            size = f"{'':>6} -> {self.size_after}"
+        else:
+            size = f"{self.size_before:>6} -> {self.size_after:<6} ({self.size_after - self.size_before:+})"
+        peak = "" if self.peak_bytes is None else f"{self.peak_bytes / 1024:>9.1f}KiB"
+        return f"{self.name:<16} {self.seconds * 1000:>9.3f}ms {peak:>12} {size}"
+
+class PassManager:
+    def __init__(self, verify: bool = False, track_memory: bool = True) -> None:
+        # run verify_tac after every TAC pass and after lowering
+        self.verify = verify
+        self.track_memory = track_memory
+
+        self.passes: Dict[str, PassInfo] = {}
+        self.analysis_cache: Dict[str, object] = {}
+        self.stats: List[PassStats] = []
+
+        self.ast: SourceFileNode = None
+        self.tac: TAC = None
+
+    def register_analysis(self, name: str, run: Callable[[object], object], ir: str = "tac",
+                          verify: Callable[[object, object], None] = None):
+        assert ir in ["ast", "tac"], f"unknown ir {ir}"
+        self.passes[name] = PassInfo(name, run, ir, True, verify=verify)
+
+    def register_transform(self, name: str, run: Callable[..., object], ir: str = "tac", preserves: List[str] = [],
+                           requires: List[str] = [], per_function: bool = False):
+        assert ir in ["ast", "tac"], f"unknown ir {ir}"
+        for analysis in [*preserves, *requires]:
+            assert self.passes.get(analysis) and self.passes[analysis].is_analysis, f"{name}: unknown analysis {analysis}"
+        self.passes[name] = PassInfo(name, run, ir, False, list(preserves), list(requires), per_function)
+
+    def get_transform_names(self, ir: str = "tac") -> List[str]:
+        return [name for name, info in self.passes.items() if not info.is_analysis and info.ir == ir]
+
+    def get_optimization_names(self) -> List[str]:
+        # transforms that can be picked on the command line. ast ones run before lowering
+        return [name for name in self.get_transform_names("ast") if name != "check"] + self.get_transform_names("tac")
+
+    def get_ir(self, ir: str) -> object:
+        ir_obj = self.ast if ir == "ast" else self.tac
+        assert ir_obj is not None, f"no {ir} to run passes on"
+        return ir_obj
+
+    def get_tac_size(self) -> int | None:
+        return len(self.tac.ir_code) if self.tac else None
+
+    def timed(self, name: str, run: Callable[[], object], ir: str = "tac") -> object:
+        size_before = self.get_tac_size() if ir == "tac" else None
+
+        started_tracing = False
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - start
+
+        peak_bytes = None
+        if self.track_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+
+        size_after = self.get_tac_size() if ir == "tac" else None
+        self.stats.append(PassStats(name, seconds, peak_bytes, size_before, size_after, result))
+
+        return result
+
+    def get_analysis(self, name: str) -> object:
+        info = self.passes[name]
+        assert info.is_analysis, f"{name} is a transform"
+
+        if not name in self.analysis_cache:
+            ir_obj = self.get_ir(info.ir)
+            self.analysis_cache[name] = self.timed(name, lambda: info.run(ir_obj), info.ir)
+
+        return self.analysis_cache[name]
+
+    def invalidate(self, ir: str, preserves: List[str] = []):
+        for name in list(self.analysis_cache):
+            if self.passes[name].ir == ir and not name in preserves:
+                del self.analysis_cache[name]
+
+    def run_pass(self, name: str) -> object:
+        assert name in self.passes, f"unknown pass {name}"
+        info = self.passes[name]
+        if info.is_analysis:
+            return self.get_analysis(name)
+
+        ir_obj = self.get_ir(info.ir)
+        analyses = [self.get_analysis(analysis) for analysis in info.requires]
+        # what a preserved analysis was before, checked against the cache afterwards
+        preserved = { analysis: self.analysis_cache[analysis] for analysis in info.preserves if analysis in self.analysis_cache }
+
+        result = self.timed(name, lambda: info.run(ir_obj, *analyses), info.ir)
+        self.invalidate(info.ir, info.preserves)
+
+        if self.verify and info.ir == "tac":
+            self.verify_ir(name)
+            self.verify_analyses(name, preserved)
+
+        return result
+
+    def run(self, names: List[str]):
+        for name in names:
+            self.run_pass(name)
+
+    def lower_to_tac(self) -> TAC:
+        ast = self.get_ir("ast")
+        def lower():
+            self.tac = TAC()
+            self.tac.tac_source_file(ast)
+
+        self.tac = None
+        self.timed("tac_gen", lower)
+        self.invalidate("tac")
+
+        if self.verify:
+            self.verify_ir("tac_gen")
+
+        return self.tac
+
+    def verify_ir(self, after_pass: str):
+        try:
+            verify_tac(self.tac)
+        except AssertionError as e:
+            raise AssertionError(f"ir broken after {after_pass}: {e}") from e
+
+    def verify_analyses(self, after_pass: str, preserved: Dict[str, object]):
+        # a preserved analysis must still be the cached one, not rebuilt, and still match the ir
+        for name, result in preserved.items():
+            assert self.analysis_cache.get(name) is result, f"{name} rebuilt after {after_pass}, which preserves it"
+            info = self.passes[name]
+            if info.verify is None:
+                continue
+            try:
+                info.verify(self.get_ir(info.ir), result)
+            except AssertionError as e:
+                raise AssertionError(f"{name} out of date after {after_pass}: {e}") from e
+
+    def pretty_stats(self) -> str:
+        lines = [f"{'pass':<16} {'time':>11} {'peak':>12} {'ir size':>10}"]
+        lines.extend(str(stats) for stats in self.stats)
+        # indented rows break down the time of the row above them
+        total = sum(stats.seconds for stats in self.stats if not stats.name.startswith(' '))
+        lines.append(f"{'total':<16} {total * 1000:>9.3f}ms")
+
+        return '\n'.join(lines)
+
+def get_default_pass_manager(verify: bool = False, track_memory: bool = True) -> PassManager:
+    pass_manager = PassManager(verify, track_memory)
+
+    # the checker annotates the ast with types, nothing after it works without that
+    pass_manager.register_transform("check", lambda ast: Checker().check_source_file(ast), ir="ast")
+
+    pass_manager.register_transform("const_eval", evaluate_pure_calls, ir="ast")
+
+    pass_manager.register_analysis("cfg", build_cfgs, verify=verify_cfgs)
+    pass_manager.register_analysis("call_graph", get_call_graph, verify=verify_call_graph)
+
+    # the cfg passes write their cfgs back, which leaves them describing the new code.
+    # sccp and unroll can delete calls, and tailcall turns self calls into jumps
+    pass_manager.register_transform("inline", inline_functions, requires=["call_graph"])
+    pass_manager.register_transform("tailcall", eliminate_tail_recursion, preserves=["cfg"], requires=["cfg"], per_function=True)
+    pass_manager.register_transform("sccp", propagate_constants, preserves=["cfg"], requires=["cfg"], per_function=True)
+    pass_manager.register_transform("gvn", value_number, preserves=["cfg", "call_graph"], requires=["cfg"], per_function=True)
+    pass_manager.register_transform("loops", optimize_loops, preserves=["cfg", "call_graph"], requires=["cfg"], per_function=True)
+    # after licm, which empties loop headers of everything but the comparison
+    pass_manager.register_transform("unroll", unroll_loops, preserves=["cfg"], requires=["cfg"], per_function=True)
+
+    return pass_manager
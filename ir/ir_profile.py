@@ -0,0 +1,171 @@
+from ir.ir_cfg import *
+from ir.ir_tacvm import TACVM
+
+# execution profiling for the TACVM
+#
+# VMProfiler.run executes the program with its own copy of TACVM.run's loop that also
+# counts every instruction it executes and, whenever a call or return switches frames,
+# how many instructions ran under the call stack it leaves. TACVM.run is untouched, so
+# nothing is paid when not profiling. blocks, loops and functions are summed from the
+# instruction counts afterwards, and the stack counts give inclusive function counts and
+# collapsed stacks for flamegraph.pl / speedscope
+
+@dataclass
+class FunctionProfile:
+    fun_name: str
+    calls: int
+    # instructions executed in the function itself, and in it or anything it called
+    exclusive: int
+    inclusive: int
+
+@dataclass
+class BlockProfile:
+    fun_name: str
+    label: str
+    entries: int
+    instructions: int
+
+@dataclass
+class LoopProfile:
+    fun_name: str
+    header_label: str
+    # times the header ran, one more than the iterations for loops tested at the top
+    header_entries: int
+    instructions: int
+
+def get_block_name(fun_name: str, block: BasicBlock, ins_idx: int, fun_start: int) -> str:
+    # blocks after a jump or branch don't always have a label
+    return block.labels[0] if block.labels else f"{fun_name}+{ins_idx - fun_start}"
+
+class VMProfiler:
+    def __init__(self, vm: TACVM) -> None:
+        self.vm = vm
+        self.tac = vm.tac
+
+        self.instruction_counts: List[int] = [0] * len(self.tac.ir_code)
+        # call stack, outermost function first -> instructions executed with it on top
+        self.stack_counts: Dict[Tuple[str, ...], int] = {}
+
+    def run(self, entry: str = "main"):
+        vm = self.vm
+        vm.start_function(entry)
+        handlers = vm.handlers if vm.handlers is not None else vm.prepare()
+        counts, stack_counts = self.instruction_counts, self.stack_counts
+
+        code_len, pc, steps = len(handlers), vm.pc, 0
+        frame, stack, stack_steps = vm.frame, (entry,), 0
+        while pc < code_len:
+            counts[pc] += 1
+            pc = handlers[pc](pc, vm.regs)
+            stack_steps += 1
+
+            # a call or return ran, the instruction that did it belongs to the old stack
+            if vm.frame is not frame:
+                stack_counts[stack] = stack_counts.get(stack, 0) + stack_steps
+                steps += stack_steps
+                stack_steps = 0
+
+                depth = len(vm.frames)
+                stack = stack + (vm.frame.fun_name,) if depth >= len(stack) else stack[:depth + 1]
+                frame = vm.frame
+
+        stack_counts[stack] = stack_counts.get(stack, 0) + stack_steps
+        vm.pc = pc
+        vm.steps += steps + stack_steps
+
+    def get_total(self) -> int:
+        return sum(self.instruction_counts)
+
+    def get_function_profiles(self) -> List[FunctionProfile]:
+        # hottest (by inclusive count) first
+        ranges = get_function_ranges(self.tac)
+        calls = { fun_name: 0 for fun_name in ranges }
+        for fun_name, (start, end) in ranges.items():
+            for ins_idx in range(start, end):
+                ins = self.tac.ir_code[ins_idx]
+                if isinstance(ins, Call) and str(ins.target) in calls:
+                    calls[str(ins.target)] += self.instruction_counts[ins_idx]
+
+        exclusive = { fun_name: 0 for fun_name in ranges }
+        inclusive = { fun_name: 0 for fun_name in ranges }
+        for stack, count in self.stack_counts.items():
+            exclusive[stack[-1]] += count
+            # recursion puts a function on the stack more than once, it still only counts once
+            for fun_name in set(stack):
+                inclusive[fun_name] += count
+
+        # the entry function was called by whoever ran the vm
+        for fun_name in ranges:
+            if (fun_name,) in self.stack_counts:
+                calls[fun_name] += 1
+
+        profiles = [FunctionProfile(fun_name, calls[fun_name], exclusive[fun_name], inclusive[fun_name]) for fun_name in ranges]
+        return sorted(profiles, key=lambda profile: -profile.inclusive)
+
+    def get_block_and_loop_profiles(self) -> Tuple[List[BlockProfile], List[LoopProfile]]:
+        # hottest (by instructions executed) first
+        ins_ids = { id(ins): i for i, ins in enumerate(self.tac.ir_code) }
+        ranges = get_function_ranges(self.tac)
+
+        blocks, loops = [], []
+        for fun_name, cfg in build_cfgs(self.tac).items():
+            block_profiles: Dict[BasicBlock, BlockProfile] = {}
+            for block in cfg.blocks:
+                if not block.instructions:
+                    continue
+
+                first_idx = ins_ids[id(block.instructions[0])]
+                name = get_block_name(fun_name, block, first_idx, ranges[fun_name][0])
+                instructions = sum(self.instruction_counts[ins_ids[id(ins)]] for ins in block.instructions)
+                block_profiles[block] = BlockProfile(fun_name, name, self.instruction_counts[first_idx], instructions)
+
+            for loop in cfg.find_loops():
+                header = block_profiles.get(loop.header)
+                if header:
+                    instructions = sum(block_profiles[block].instructions for block in loop.blocks if block in block_profiles)
+                    loops.append(LoopProfile(fun_name, header.label, header.entries, instructions))
+
+            blocks.extend(block_profiles.values())
+
+        return sorted(blocks, key=lambda block: -block.instructions), sorted(loops, key=lambda loop: -loop.instructions)
+
+    def pretty_report(self, top: int = 10) -> str:
+        total = max(self.get_total(), 1)
+        percent = lambda count: f"{count * 100 / total:>6.1f}%"
+
+        lines = [f"{'function':<24} {'calls':>8} {'exclusive':>11} {'':>7} {'inclusive':>11} {'':>7}"]
+        for fun in self.get_function_profiles():
+            lines.append(f"{fun.fun_name:<24} {fun.calls:>8} {fun.exclusive:>11} {percent(fun.exclusive)} {fun.inclusive:>11} {percent(fun.inclusive)}")
+
+        blocks, loops = self.get_block_and_loop_profiles()
+        lines.append("")
+        lines.append(f"{'hot loop':<24} {'function':<16} {'header runs':>11} {'instructions':>12} {'':>7}")
+        for loop in loops[:top]:
+            lines.append(f"{loop.header_label:<24} {loop.fun_name:<16} {loop.header_entries:>11} {loop.instructions:>12} {percent(loop.instructions)}")
+
+        lines.append("")
+        lines.append(f"{'hot block':<24} {'function':<16} {'entries':>11} {'instructions':>12} {'':>7}")
+        for block in blocks[:top]:
+            lines.append(f"{block.label:<24} {block.fun_name:<16} {block.entries:>11} {block.instructions:>12} {percent(block.instructions)}")
+
+        lines.append("")
+        lines.append(f"{'hot instruction':<40} {'index':>6} {'count':>11} {'':>7}")
+        hottest = sorted(range(len(self.instruction_counts)), key=lambda i: -self.instruction_counts[i])
+        for ins_idx in hottest[:top]:
+            if self.instruction_counts[ins_idx]:
+                ins_str = str(self.tac.ir_code[ins_idx])[:40]
+                lines.append(f"{ins_str:<40} {ins_idx:>6} {self.instruction_counts[ins_idx]:>11} {percent(self.instruction_counts[ins_idx])}")
+
+        lines.append(f"{'total':<40} {'':>6} {total:>11}")
+
+        return '\n'.join(lines)
+
+    def get_collapsed_stacks(self, root: str = None) -> str:
+        # one "outer;inner count" line per call stack, the format flamegraph.pl reads
+        lines = []
+        for stack, count in sorted(self.stack_counts.items()):
+            if count:
+                frames = [root, *stack] if root else stack
+                lines.append(f"{';'.join(frames)} {count}")
+
+        return '\n'.join(lines)
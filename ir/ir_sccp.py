@@ -0,0 +1,228 @@
+from ir.ir_cfg import *
+from ir.ir_tacvm import divide, run_typed_alu
+from ir.ir_tacvm_memory import wrap_value
+
+# sparse conditional constant propagation over TAC
+#
+# a dataflow over blocks where each register is undefined (missing from the env), a known
+# constant, or varying. only edges that can execute are followed: a branch on a constant
+# condition marks just the side it takes, so an arm that can never run never pollutes the
+# join after it. registers aren't ssa, so every block keeps the env at its entry instead
+# of one value per register
+#
+# folding computes what native code would: c division, and every result wrapped to the c
+# type of the register it goes to. divisions that trap natively are left alone
+#
+# afterwards constant operands are substituted, arithmetic on constants becomes a move,
+# constant branches become plain fall throughs or jumps, blocks that never execute are
+# deleted along with labels nothing jumps to anymore, and definitions nobody reads are dropped
+
+class Varying:
+    def __repr__(self) -> str:
+        return "varying"
+
+VARYING = Varying()
+
+def is_constant(val: object) -> bool:
+    return val is not None and val is not VARYING
+
+def meet_values(a: object, b: object) -> object:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    # 1, 1.0 and True aren't interchangeable once division gets involved
+    if a is VARYING or b is VARYING or type(a) != type(b) or a != b:
+        return VARYING
+    return a
+
+def as_operand(val: object) -> object:
+    # comparisons fold to bools, the ir only has numbers
+    return int(val) if isinstance(val, bool) else val
+
+class ConstantPropagator:
+    def __init__(self, cfg: FunctionCFG) -> None:
+        self.cfg = cfg
+        self.tac = cfg.tac
+
+        # env at each executable block's entry. register idx -> constant or VARYING
+        self.in_envs: Dict[BasicBlock, Dict[int, object]] = {}
+        self.executable_edges: Set[Tuple[BasicBlock, BasicBlock]] = set()
+
+        self.folded_count = 0
+        self.branch_count = 0
+        self.removed_count = 0
+
+    def get_value(self, operand: object, env: Dict[int, object]) -> object:
+        if isinstance(operand, VirtualRegister):
+            return env.get(operand.register_idx)
+        if isinstance(operand, int | float):
+            return operand
+        # memory and stack addresses
+        return VARYING
+
+    def eval_arithmetic(self, ins: Arithmetic, env: Dict[int, object]) -> object:
+        left, right = self.get_value(ins.left, env), self.get_value(ins.right, env)
+        if left is VARYING or right is VARYING:
+            return VARYING
+        if left is None or right is None:
+            return None
+        # leave a trapping division for runtime
+        if ins.op == "div" and right == 0:
+            return VARYING
+
+        result = run_typed_alu(ins.op, left, right, ins.dest.val_type)
+        # a quotient that doesn't fit its type traps too, like INT_MIN / -1
+        if ins.op == "div" and result != divide(left, right):
+            return VARYING
+        return result
+
+    def transfer(self, ins: TACInstruction, env: Dict[int, object]):
+        if isinstance(ins, Arithmetic) and isinstance(ins.dest, VirtualRegister):
+            env[ins.dest.register_idx] = self.eval_arithmetic(ins, env)
+        elif isinstance(ins, Move) and isinstance(ins.dest, VirtualRegister):
+            val = self.get_value(ins.src, env)
+            env[ins.dest.register_idx] = wrap_value(val, ins.dest.val_type) if is_constant(val) else val
+        else:
+            # params, call results and pops come from elsewhere
+            for reg in get_defs(ins):
+                env[reg.register_idx] = VARYING
+
+    def get_executable_succs(self, block: BasicBlock, env: Dict[int, object]) -> List[BasicBlock]:
+        branch = block.get_branch()
+        if not branch:
+            return [block.next_block] if block.next_block else []
+
+        cond = self.get_value(branch.cond, env)
+        if not is_constant(cond):
+            # an undefined condition is treated as varying so neither arm gets deleted on a guess
+            return [succ for succ in [block.branch_block, block.next_block] if succ]
+
+        taken = (cond != 0) == isinstance(branch, JumpIf)
+        succ = block.branch_block if taken else block.next_block
+        return [succ] if succ else []
+
+    def get_in_env(self, block: BasicBlock, out_envs: Dict[BasicBlock, Dict[int, object]]) -> Dict[int, object]:
+        env: Dict[int, object] = {}
+        for pred in block.preds:
+            if not (pred, block) in self.executable_edges:
+                continue
+            for reg_idx, val in out_envs[pred].items():
+                env[reg_idx] = meet_values(env.get(reg_idx), val)
+
+        return env
+
+    def analyze(self):
+        entry = self.cfg.blocks[0]
+        out_envs: Dict[BasicBlock, Dict[int, object]] = {}
+        worklist = [entry]
+        in_worklist = { entry }
+
+        while worklist:
+            block = worklist.pop()
+            in_worklist.discard(block)
+
+            env = {} if block is entry else self.get_in_env(block, out_envs)
+            self.in_envs[block] = dict(env)
+            for ins in block.instructions:
+                self.transfer(ins, env)
+
+            changed = out_envs.get(block) != env
+            out_envs[block] = env
+
+            for succ in self.get_executable_succs(block, env):
+                if (block, succ) in self.executable_edges and not changed:
+                    continue
+                self.executable_edges.add((block, succ))
+                if not succ in in_worklist:
+                    worklist.append(succ)
+                    in_worklist.add(succ)
+
+    def rewrite_block(self, block: BasicBlock):
+        env = dict(self.in_envs[block])
+        new_instructions = []
+        for ins in block.instructions:
+            def substitute(reg: VirtualRegister) -> object:
+                val = env.get(reg.register_idx)
+                return as_operand(val) if is_constant(val) else reg
+
+            if map_uses(ins, substitute):
+                self.folded_count += 1
+
+            self.transfer(ins, env)
+
+            if isinstance(ins, Arithmetic) and isinstance(ins.dest, VirtualRegister) and is_constant(env[ins.dest.register_idx]):
+                ins = Move(None, ins.dest, as_operand(env[ins.dest.register_idx]))
+                self.folded_count += 1
+
+            new_instructions.append(ins)
+
+        block.instructions = new_instructions
+
+        branch = block.get_branch()
+        if branch and isinstance(branch.cond, int | float):
+            # the branch is decided, keep only the edge it takes
+            block.instructions.pop()
+            if (branch.cond != 0) == isinstance(branch, JumpIf):
+                block.next_block = block.branch_block
+            block.branch_block = None
+            self.branch_count += 1
+
+    def remove_dead_definitions(self):
+        # a register nothing reads anymore doesn't need its moves and arithmetic
+        use_counts: Dict[int, int] = {}
+        for ins in self.cfg.get_instructions():
+            for reg in get_uses(ins):
+                use_counts[reg.register_idx] = use_counts.get(reg.register_idx, 0) + 1
+
+        changed = True
+        while changed:
+            changed = False
+            for block in self.cfg.blocks:
+                kept = []
+                for ins in block.instructions:
+                    is_dead = isinstance(ins, Move | Arithmetic) and isinstance(ins.dest, VirtualRegister) and \
+                        use_counts.get(ins.dest.register_idx, 0) == 0
+                    if not is_dead:
+                        kept.append(ins)
+                        continue
+
+                    for reg in get_uses(ins):
+                        use_counts[reg.register_idx] -= 1
+                    self.removed_count += 1
+                    changed = True
+
+                block.instructions = kept
+
+    def run(self):
+        self.analyze()
+
+        for block in self.cfg.blocks:
+            if block in self.in_envs:
+                self.rewrite_block(block)
+
+        unreachable = { block for block in self.cfg.blocks if not block in self.in_envs }
+        self.removed_count += sum(len(block.instructions) for block in unreachable)
+        if unreachable:
+            self.cfg.remove_blocks(unreachable)
+        else:
+            self.cfg.compute_edges()
+
+        self.remove_dead_definitions()
+        self.cfg.remove_dead_labels()
+
+def propagate_constants(tac: TAC, cfgs: Dict[str, FunctionCFG] = None) -> Tuple[int, int, int]:
+    # returns how many operands/instructions were folded, how many branches were decided
+    # and how many instructions were deleted
+    cfgs = cfgs if cfgs is not None else build_cfgs(tac)
+    folded, branches, removed = 0, 0, 0
+    for cfg in cfgs.values():
+        propagator = ConstantPropagator(cfg)
+        propagator.run()
+        folded += propagator.folded_count
+        branches += propagator.branch_count
+        removed += propagator.removed_count
+
+    write_back_cfgs(tac, cfgs)
+
+    return folded, branches, removed
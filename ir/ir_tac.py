@@ -1,5 +1,6 @@
 from c_ast.pland_ast import *
-from typing import Dict, List
+from c_ast.parse import integral_types
+from typing import Dict, List, Set
 
 # move, jump, jump_if, jump_not, call, ret, add, sub, mul, div, or, and, gt, gte, lt, lte, eq
 
@@ -11,6 +12,8 @@ from typing import Dict, List
 class VirtualRegister:
     register_name: str
     bound_ir_var: str
+    register_idx: int = None # slot in the vm register file / compact encoding
+    val_type: str = None # c type of the values held, None if unknown
 
     def __str__(self) -> str:
         return self.register_name
@@ -25,9 +28,20 @@ class UDVal:
         
         return f"? ({self.annotation})"
 
+@dataclass(eq=False)
+class StackSlot:
+    # the stack memory of a local whose address is taken. as an operand it's the slot's
+    # address, MemoryLocation(slot) is the value in it. where the slot goes in the frame
+    # is up to the vm or the backend, so a recursive call gets its own
+    name: str
+    val_type: str = None # c type of the value held
+
+    def __str__(self) -> str:
+        return f"&{self.name}"
+
 @dataclass
 class MemoryLocation:
-    location: int | VirtualRegister = None # address specified by register or immediate
+    location: int | VirtualRegister | StackSlot = None # address specified by register, slot or immediate
     offset: int = 0 # maybe not used
 
     # stack assigned vars should only be determined at a later stage
@@ -49,6 +63,14 @@ class MemoryLocation:
         else:
             return f"[{self.location}]"
             
+@dataclass
+class Label:
+    name: str
+    ins_idx: int = None # filled in by TAC.resolve_labels
+
+    def __str__(self) -> str:
+        return self.name
+
 @dataclass()
 class TACInstruction: pass
 
@@ -66,14 +88,14 @@ class Move(TypedInstruction):
 
 @dataclass
 class Jump(TACInstruction):
-    dest: str | MemoryLocation | VirtualRegister | int # label, indirection, reg, imm addr
+    dest: Label | str | MemoryLocation | VirtualRegister | int # label, indirection, reg, imm addr
 
     def __str__(self) -> str:
         return f"jump {self.dest}"
 
 @dataclass
 class JumpIf(TACInstruction):
-    dest: str | MemoryLocation | VirtualRegister | int
+    dest: Label | str | MemoryLocation | VirtualRegister | int
     cond: MemoryLocation | VirtualRegister
 
     def __str__(self) -> str:
@@ -81,7 +103,7 @@ class JumpIf(TACInstruction):
 
 @dataclass
 class JumpIfNot(TACInstruction):
-    dest: str | MemoryLocation | VirtualRegister | int
+    dest: Label | str | MemoryLocation | VirtualRegister | int
     cond: MemoryLocation | VirtualRegister
 
     def __str__(self) -> str:
@@ -96,12 +118,12 @@ class Params(TACInstruction):
 
 @dataclass 
 class Call(TACInstruction):
-    target: str | MemoryLocation | VirtualRegister
+    target: Label | str | MemoryLocation | VirtualRegister
     out_register: VirtualRegister
     args: List[VirtualRegister]
 
     def __str__(self) -> str:
-        return f"call {self.target}, {self.out_register}, {', '.join(str(arg) for arg in self.args)}"
+        return f"call {', '.join(str(operand) for operand in [self.target, self.out_register, *self.args])}"
 
 @dataclass
 class Return(TACInstruction):
@@ -110,14 +132,6 @@ class Return(TACInstruction):
     def __str__(self) -> str:
         return f"ret {self.src}"
     
-@dataclass
-class Push(TACInstruction):
-    val: MemoryLocation | VirtualRegister
-    pushed_to: MemoryLocation
-    
-    def __str__(self) -> str:
-        return f"push {self.val}"
-
 @dataclass
 class Pop(TACInstruction):
     dest: MemoryLocation | VirtualRegister
@@ -135,6 +149,33 @@ class Arithmetic(TACInstruction):
     def __str__(self) -> str:
         return f"{self.op} {self.dest}, {self.left}, {self.right}"
 
+def get_base_operands(ins: TACInstruction) -> List[object]:
+    # every operand of an instruction, with memory locations and udvals replaced by what
+    # they are built on
+    operands = []
+    if isinstance(ins, Params):
+        operands = ins.params_regs
+    elif isinstance(ins, Call):
+        operands = [ins.target, ins.out_register, *ins.args]
+    else:
+        operands = [getattr(ins, field) for field in ins.__dataclass_fields__]
+
+    base_operands = []
+    for operand in operands:
+        while isinstance(operand, UDVal | MemoryLocation):
+            operand = operand.val if isinstance(operand, UDVal) else operand.location
+        base_operands.append(operand)
+
+    return base_operands
+
+def instruction_registers(ins: TACInstruction) -> List[VirtualRegister]:
+    # every register an instruction reads or writes, including ones used as addresses
+    return [operand for operand in get_base_operands(ins) if isinstance(operand, VirtualRegister)]
+
+def instruction_stack_slots(ins: TACInstruction) -> List[StackSlot]:
+    # every stack slot an instruction loads, stores or takes the address of
+    return [operand for operand in get_base_operands(ins) if isinstance(operand, StackSlot)]
+
 class TAC:
     def __init__(self) -> None:
         self.current_label_idx = 0
@@ -144,10 +185,14 @@ class TAC:
 
         self.variable_to_location: Dict[str, VirtualRegister | MemoryLocation] = {}
         self.label_to_ins_idx: Dict[str, int] = {}
+        # one Label object per label name, shared by every jump to it
+        self.labels: Dict[str, Label] = {}
         self.ir_code: List[TACInstruction] = []
 
         self.current_function_name: str = None
         self.fun_name_to_locals: Dict[str, List[str]] = {}
+        # ir names of the current function's variables that & is applied to
+        self.address_taken: Set[str] = set()
 
         self.cfg_graph = [] # this comes later
 
@@ -161,14 +206,48 @@ class TAC:
 
     def insert_label(self, label: str):
         self.label_to_ins_idx[label] = self.instruction_idx
+
+    def get_label(self, name: str) -> Label:
+        if not name in self.labels:
+            self.labels[name] = Label(name)
+
+        return self.labels[name]
+
+    def resolve_labels(self):
+        # patch jump and call targets to Label objects carrying their instruction index
+        # rerun after anything moves instructions around; existing Label objects are just updated
+        for name, label in self.labels.items():
+            label.ins_idx = self.label_to_ins_idx.get(name)
+
+        for name, ins_idx in self.label_to_ins_idx.items():
+            self.get_label(name).ins_idx = ins_idx
+
+        for ins in self.ir_code:
+            if isinstance(ins, Jump | JumpIf | JumpIfNot) and isinstance(ins.dest, str):
+                ins.dest = self.get_label(ins.dest)
+            elif isinstance(ins, Call) and isinstance(ins.target, str):
+                ins.target = self.get_label(ins.target)
+
+    def get_ins_idx_to_labels(self) -> Dict[int, List[str]]:
+        ins_idx_to_labels: Dict[int, List[str]] = {}
+        for name, ins_idx in self.label_to_ins_idx.items():
+            ins_idx_to_labels.setdefault(ins_idx, []).append(name)
+
+        return ins_idx_to_labels
     
     def advance_label_idx(self):
         self.current_label_idx += 1
 
-    def get_next_virt_register(self, var_ir_name: str = None) -> int:
+    def get_next_pass_label(self, suffix: str) -> str:
+        # labels for blocks created by optimization passes, which have no ast node
+        label_idx = self.current_label_idx
+        self.advance_label_idx()
+        return f".L{label_idx}_{suffix}"
+
+    def get_next_virt_register(self, var_ir_name: str = None, val_type: str = None) -> VirtualRegister:
         old_id = self.variable_idx
         self.variable_idx += 1
-        return VirtualRegister(f"t{old_id}", var_ir_name)
+        return VirtualRegister(f"t{old_id}", var_ir_name, old_id, val_type)
     
     def get_virt_register(self, var_ir_name: str) -> VirtualRegister:
         return self.variable_to_location[var_ir_name]
@@ -180,14 +259,30 @@ class TAC:
     def assign_variable(self, var_node: VarNode, register: VirtualRegister = None):
         var_ir_name = var_node.get_ir_name()
         self.fun_name_to_locals[self.current_function_name].append(var_ir_name)
-        if register:
+        if var_ir_name in self.address_taken:
+            # stores through a pointer have to be seen by the variable, so it lives in its
+            # stack slot. every read loads it and every assignment stores it
+            self.variable_to_location[var_ir_name] = MemoryLocation(StackSlot(var_ir_name, var_node.get_inferred_type()))
+        elif register:
             register.bound_ir_var = var_ir_name
+            register.val_type = var_node.get_inferred_type()
             self.variable_to_location[var_ir_name] = register
         else:
-            self.variable_to_location[var_ir_name] = self.get_next_virt_register(var_ir_name)
+            self.variable_to_location[var_ir_name] = self.get_next_virt_register(var_ir_name, var_node.get_inferred_type())
+
+    def bind_local(self, fun_name: str, location: VirtualRegister | MemoryLocation, var_ir_name: str):
+        # makes a register or stack slot a local of fun_name, like inlining does with the
+        # callee's locals
+        if isinstance(location, VirtualRegister):
+            location.bound_ir_var = var_ir_name
+        self.variable_to_location[var_ir_name] = location
+        self.fun_name_to_locals[fun_name].append(var_ir_name)
 
     def tac_binary(self, node: OpBinaryNode) -> VirtualRegister:
-        result_reg = self.get_next_virt_register()
+        if node.op in ["logical_and", "logical_or"]:
+            return self.tac_logical(node)
+
+        result_reg = self.get_next_virt_register(val_type=node.get_inferred_type())
         op = { "add": 'add', "sub": 'sub', "mul": "mul", "div": "div", "equality": "eq", 
               "less_than": 'lt', "less_than_equal": "lte", "greater_than": 'gt', "greater_than_equal": "gte",
                "bit_and": 'and', "bit_or": 'or' }[node.op]
@@ -201,40 +296,80 @@ class TAC:
 
         return result_reg
 
-    def tac_unary(self, node: OpUnaryNode) -> VirtualRegister | int:
+    def tac_unary(self, node: OpUnaryNode) -> VirtualRegister | StackSlot | int:
         result_reg = None
 
         if node.op == "neg":
-            result_reg = self.get_next_virt_register()
-            self.add_instruction(Arithmetic(result_reg, "sub", 0, result_reg))
+            result_reg = self.get_next_virt_register(val_type=node.get_inferred_type())
+            self.add_instruction(Arithmetic(result_reg, "sub", 0, self.tac_expr(node.val)))
 
         elif node.op == "ref":
-            # assert isinstance(node.val, VarNode), "referencing rvalue"
-            expr_reg = self.tac_expr(node.val)
-            mem_loc = MemoryLocation()
-            self.variable_to_location[f"ref_{expr_reg.register_name}"] = mem_loc
-            push_ins = Push(expr_reg, mem_loc)
-            self.add_instruction(push_ins)
-            return UDVal("some stack mem", push_ins.pushed_to)
+            assert isinstance(node.val, VarNode), "referencing rvalue"
+            # the variable lives in its stack slot, see assign_variable
+            return self.variable_to_location[node.val.get_ir_name()].location
         
         elif node.op == "deref":
-            result_reg = self.get_next_virt_register()
+            result_reg = self.get_next_virt_register(val_type=node.get_inferred_type())
             mem_loc = MemoryLocation(self.tac_expr(node.val))
             self.add_instruction(Move(None, result_reg, mem_loc))
+
+        elif node.op == "not":
+            result_reg = self.get_next_virt_register(val_type=node.get_inferred_type())
+            self.add_instruction(Arithmetic(result_reg, "eq", self.tac_expr(node.val), 0))
         
         return result_reg
 
+    def tac_cond_jump(self, cond: TypeableASTNode, label: str, jump_when: bool):
+        # jumps to label when cond is true (or false, with jump_when False) and falls through
+        # otherwise. && and || become chains of jumps, so the right side only runs when the
+        # left one doesn't decide the result and no 0/1 value is made for them
+        if isinstance(cond, OpUnaryNode) and cond.op == "not":
+            self.tac_cond_jump(cond.val, label, not jump_when)
+
+        elif isinstance(cond, OpBinaryNode) and cond.op in ["logical_and", "logical_or"]:
+            # && jumps as soon as one side is false, || as soon as one is true
+            decided_by = cond.op == "logical_or"
+            if jump_when == decided_by:
+                self.tac_cond_jump(cond.val1, label, jump_when)
+                self.tac_cond_jump(cond.val2, label, jump_when)
+            else:
+                skip_label = self.get_next_label(cond)
+                self.tac_cond_jump(cond.val1, skip_label, decided_by)
+                self.tac_cond_jump(cond.val2, label, jump_when)
+                self.insert_label(skip_label)
+
+        elif jump_when:
+            self.add_instruction(JumpIf(label, self.tac_expr(cond)))
+        else:
+            self.add_instruction(JumpIfNot(label, self.tac_expr(cond)))
+
+    def tac_logical(self, node: OpBinaryNode) -> VirtualRegister:
+        # && and || used as values still branch, then set the result to 0 or 1
+        result_reg = self.get_next_virt_register(val_type=node.get_inferred_type())
+        false_label = self.get_next_label(node)
+        after_label = self.get_next_label(node)
+
+        self.tac_cond_jump(node, false_label, False)
+        self.add_instruction(Move(None, result_reg, 1))
+        self.add_instruction(Jump(after_label))
+
+        self.insert_label(false_label)
+        self.add_instruction(Move(None, result_reg, 0))
+        self.insert_label(after_label)
+
+        return result_reg
+
     def tac_funcall(self, node: FunCallNode) -> VirtualRegister:
         arg_registers = []
         for arg in node.args:
             arg_registers.append(self.tac_expr(arg))
         
-        out_register = self.get_next_virt_register()
+        out_register = self.get_next_virt_register(val_type=node.get_inferred_type())
         self.add_instruction(Call(node.fun_name, out_register, arg_registers))
 
         return out_register
 
-    def tac_expr(self, expr: TypeableASTNode) -> VirtualRegister | float | int:
+    def tac_expr(self, expr: TypeableASTNode) -> VirtualRegister | StackSlot | float | int:
         if isinstance(expr, OpBinaryNode):
             return self.tac_binary(expr)
         elif isinstance(expr, OpUnaryNode):
@@ -245,7 +380,13 @@ class TAC:
             return expr.val
         elif isinstance(expr, VarNode):
             assert expr.get_ir_name() in self.variable_to_location, "variable not defined"
-            return self.variable_to_location[expr.get_ir_name()]
+            location = self.variable_to_location[expr.get_ir_name()]
+            if isinstance(location, MemoryLocation):
+                # loaded at every read, a store through a pointer may have changed it
+                result_reg = self.get_next_virt_register(val_type=expr.get_inferred_type())
+                self.add_instruction(Move(None, result_reg, location))
+                return result_reg
+            return location
         elif isinstance(expr, TypeCastNode):
             # TODO type casting operations
             return self.tac_expr(expr.val)
@@ -256,7 +397,7 @@ class TAC:
         if stmt.else_body:
             else_block_label = self.get_next_label(stmt.else_body)
 
-            self.add_instruction(JumpIfNot(else_block_label, self.tac_expr(stmt.condition)))
+            self.tac_cond_jump(stmt.condition, else_block_label, False)
             self.tac_stmt_block(stmt.if_body)
 
             after_if_else_label = self.get_next_label(stmt)
@@ -271,7 +412,7 @@ class TAC:
             self.insert_label(after_if_else_label)
         else:
             after_if_label = self.get_next_label(stmt)
-            self.add_instruction(JumpIfNot(after_if_label, self.tac_expr(stmt.condition)))
+            self.tac_cond_jump(stmt.condition, after_if_label, False)
             self.tac_stmt_block(stmt.if_body)
 
             # like before, an extra jump to after_if_label is not necessary if dict insertion order is respected
@@ -285,7 +426,8 @@ class TAC:
             self.assign_variable(stmt.left)
 
         if isinstance(stmt.left, VarNode):
-            left_loc = self.get_virt_register(stmt.left.get_ir_name())
+            # a register, or the stack slot of an address taken variable
+            left_loc = self.variable_to_location[stmt.left.get_ir_name()]
         else:
             # TODO this should be in semantic type checking
             assert isinstance(stmt.left, OpUnaryNode) and stmt.left.op == "deref", "invalid lvalue in deref"
@@ -297,12 +439,17 @@ class TAC:
         self.add_instruction(Return(self.tac_expr(stmt.return_val)))
 
     def tac_stmt_while(self, stmt: StmtWhileNode):
+        # the condition goes after the body so each iteration only takes one branch
         while_start_label = self.get_next_label(stmt.condition)
+        while_cond_label = self.get_next_label(stmt.condition)
+
+        self.add_instruction(Jump(while_cond_label))
         self.insert_label(while_start_label)
 
         self.tac_stmt_block(stmt.body)
 
-        self.add_instruction(JumpIf(while_start_label, self.tac_expr(stmt.condition)))
+        self.insert_label(while_cond_label)
+        self.tac_cond_jump(stmt.condition, while_start_label, True)
 
     def tac_stmt(self, stmt: ASTNode):
         if isinstance(stmt, StmtAssignNode):
@@ -328,33 +475,70 @@ class TAC:
         current_label = self.get_next_label(name=fun_def.fun_name)
         self.current_function_name = current_label
         self.fun_name_to_locals[current_label] = []
+        self.address_taken = get_address_taken(fun_def.body)
         self.insert_label(current_label)
 
         param_regs = []
+        param_slots = []
         for param in fun_def.params:
-            p_reg = self.get_next_virt_register()
+            p_reg = self.get_next_virt_register(val_type=param.param_var.get_inferred_type())
             self.assign_variable(param.param_var, p_reg)
             param_regs.append(p_reg)
+
+            location = self.variable_to_location[param.param_var.get_ir_name()]
+            if isinstance(location, MemoryLocation):
+                param_slots.append(Move(None, location, p_reg))
         
         self.add_instruction(Params(param_regs))
+        # address taken params are stored to their slots as soon as they arrive
+        for store in param_slots:
+            self.add_instruction(store)
         
         self.tac_stmt_block(fun_def.body)
     
     def tac_source_file(self, src_file: SourceFileNode):
         for fun_def in src_file.fun_defs:
             self.tac_fun_def(fun_def)
+
+        self.resolve_labels()
         
-    def pretty_tac_ir(self) -> str:
-        labels = [*self.label_to_ins_idx.keys()]
-        label_idx = 0
+    def get_function_header(self, fun_name: str) -> List[str]:
+        # comment lines after a function's label, so ir_tac_parse can rebuild the locals
+        # and register types that the instructions alone don't show
+        fun_start = self.label_to_ins_idx[fun_name]
+        fun_end = min([idx for name, idx in self.label_to_ins_idx.items()
+                       if name in self.fun_name_to_locals and idx > fun_start], default=len(self.ir_code))
+
+        local_strs = [f"{var_ir_name}={self.variable_to_location[var_ir_name]}" for var_ir_name in self.fun_name_to_locals[fun_name]]
+        reg_types: Dict[int, VirtualRegister] = {}
+        slot_types: Dict[str, StackSlot] = {}
+        for ins in self.ir_code[fun_start:fun_end]:
+            for reg in instruction_registers(ins):
+                if reg.val_type:
+                    reg_types.setdefault(reg.register_idx, reg)
+            for slot in instruction_stack_slots(ins):
+                if slot.val_type:
+                    slot_types.setdefault(slot.name, slot)
+
+        typed = [reg for _, reg in sorted(reg_types.items())] + list(slot_types.values())
+        header = [f"\t# locals {', '.join(local_strs)}".rstrip()]
+        if typed:
+            header.append(f"\t# types {', '.join(f'{operand}:{operand.val_type}' for operand in typed)}")
+
+        return header
 
+    def pretty_tac_ir(self) -> str:
+        ins_idx_to_labels = self.get_ins_idx_to_labels()
         ins_strs = []
 
-        for i in range(self.instruction_idx):
-            if label_idx < len(labels) and i == self.label_to_ins_idx[labels[label_idx]]:
-                ins_strs.append(labels[label_idx] + ":")
-                label_idx += 1
+        # <= to also print labels that point past the last instruction
+        for i in range(self.instruction_idx + 1):
+            for label in ins_idx_to_labels.get(i, []):
+                ins_strs.append(label + ":")
+                if label in self.fun_name_to_locals:
+                    ins_strs.extend(self.get_function_header(label))
+
+            if i < self.instruction_idx:
+                ins_strs.append(f"\t{self.ir_code[i]}")
 
-            ins_strs.append(f"\t{self.ir_code[i]}")
-        
         return '\n'.join(ins_strs)
\ No newline at end of file
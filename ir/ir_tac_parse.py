@@ -0,0 +1,188 @@
+from ir.ir_tac import *
+
+# reads the text TAC.pretty_tac_ir prints back into a TAC
+#
+# one line at a time, no backtracking. a line is a label ("name:"), a comment ("# ..."),
+# or a tab indented instruction. labels not starting with '.' are functions, and the
+# "# locals" / "# types" comments right after a function label carry what the
+# instructions don't show: which registers and stack slots are locals and what c type
+# every one of them has
+#
+# a stack slot prints as &<name>, its address, and [&<name>] for the value in it. names
+# are only unique within a function, so every function gets its own slots
+
+arithmetic_ops = {"add", "sub", "mul", "imul", "div", "eq", "lt", "lte", "gt", "gte", "and", "or"}
+
+class TACParser:
+    def __init__(self, text: str) -> None:
+        self.lines = text.splitlines()
+        self.line_number = 0
+
+        self.tac = TAC()
+        self.registers: Dict[str, VirtualRegister] = {}
+        self.current_function: str = None
+        # the current function's stack slots by name
+        self.stack_slots: Dict[str, StackSlot] = {}
+
+    def error(self, message: str):
+        assert False, f"line {self.line_number}: {message}: {self.lines[self.line_number - 1].strip()}"
+
+    def get_register(self, name: str) -> VirtualRegister:
+        if not name in self.registers:
+            self.registers[name] = VirtualRegister(name, None, int(name[1:]))
+
+        return self.registers[name]
+
+    def get_stack_slot(self, name: str) -> StackSlot:
+        if not name in self.stack_slots:
+            self.stack_slots[name] = StackSlot(name)
+
+        return self.stack_slots[name]
+
+    def is_register(self, token: str) -> bool:
+        return token[0] == 't' and token[1:].isdigit()
+
+    def parse_operand(self, token: str) -> object:
+        # most operands are registers seen before
+        reg = self.registers.get(token)
+        if reg is not None:
+            return reg
+        if self.is_register(token):
+            return self.get_register(token)
+
+        first = token[0]
+        if first.isdigit() or first == '-':
+            try:
+                return int(token)
+            except ValueError:
+                pass
+            try:
+                return float(token)
+            except ValueError:
+                self.error(f"bad number {token}")
+
+        if first == '[':
+            return self.parse_memory_location(token[1:-1])
+
+        if first == '&':
+            return self.get_stack_slot(token[1:])
+
+        if token.startswith("? (") and token[-1] == ')':
+            return UDVal(token[3:-1])
+
+        self.error(f"bad operand {token}")
+
+    def parse_memory_location(self, inside: str) -> MemoryLocation:
+        location, sign, offset = inside.partition(" + ")
+        if not sign:
+            location, sign, offset = inside.partition(" - ")
+
+        address = self.parse_operand(location)
+        if not sign:
+            return MemoryLocation(address)
+
+        return MemoryLocation(address, int(offset) if sign == " + " else -int(offset))
+
+    def parse_label(self, token: str) -> Label:
+        return self.tac.get_label(token)
+
+    def parse_instruction(self, line: str):
+        mnemonic, _, rest = line.partition(' ')
+        # older output has a trailing ", " after calls without arguments
+        operands = [token.strip() for token in rest.split(",")]
+        operands = [token for token in operands if token]
+
+        if mnemonic in arithmetic_ops:
+            if len(operands) != 3:
+                self.error(f"{mnemonic} takes 3 operands")
+            dest, left, right = [self.parse_operand(token) for token in operands]
+            ins = Arithmetic(dest, mnemonic, left, right)
+        elif mnemonic == "move":
+            if len(operands) != 2:
+                self.error("move takes 2 operands")
+            ins = Move(None, self.parse_operand(operands[0]), self.parse_operand(operands[1]))
+        elif mnemonic == "jump":
+            ins = Jump(self.parse_label(operands[0]))
+        elif mnemonic == "jump_if":
+            ins = JumpIf(self.parse_label(operands[0]), self.parse_operand(operands[1]))
+        elif mnemonic == "jump_ifnot":
+            ins = JumpIfNot(self.parse_label(operands[0]), self.parse_operand(operands[1]))
+        elif mnemonic == "params":
+            ins = Params([self.get_register(token) for token in operands])
+        elif mnemonic == "call":
+            if len(operands) < 2:
+                self.error("call needs a target and an out register")
+            ins = Call(self.parse_label(operands[0]), self.get_register(operands[1]),
+                       [self.parse_operand(token) for token in operands[2:]])
+        elif mnemonic == "ret":
+            ins = Return(self.parse_operand(operands[0]))
+        elif mnemonic == "pop":
+            ins = Pop(self.parse_operand(operands[0]))
+        else:
+            self.error(f"unknown instruction {mnemonic}")
+
+        self.tac.add_instruction(ins)
+
+    def parse_comment(self, line: str):
+        kind, _, rest = line[1:].strip().partition(' ')
+        if kind == "locals":
+            for entry in filter(None, rest.split(", ")):
+                var_ir_name, _, location = entry.partition('=')
+                if location[0] == '[':
+                    self.tac.bind_local(self.current_function, self.parse_operand(location), var_ir_name)
+                else:
+                    self.tac.bind_local(self.current_function, self.get_register(location), var_ir_name)
+        elif kind == "types":
+            for entry in filter(None, rest.split(", ")):
+                name, _, val_type = entry.partition(':')
+                operand = self.get_stack_slot(name[1:]) if name[0] == '&' else self.get_register(name)
+                operand.val_type = val_type
+        # anything else is a plain comment
+
+    def parse(self) -> TAC:
+        max_label_idx = -1
+        for line in self.lines:
+            self.line_number += 1
+            stripped = line.strip()
+            if not stripped:
+                continue
+
+            if stripped[0] == '#':
+                if self.current_function is None:
+                    continue
+                self.parse_comment(stripped)
+            elif not line[0].isspace() and stripped[-1] == ':':
+                label = stripped[:-1]
+                if label in self.tac.label_to_ins_idx:
+                    self.error(f"label {label} placed twice")
+                self.tac.insert_label(label)
+
+                if label[0] != '.':
+                    self.current_function = label
+                    self.tac.fun_name_to_locals[label] = []
+                    self.stack_slots = {}
+                elif label.startswith(".L"):
+                    # keep labels made later by passes from clashing with these
+                    label_idx = label[2:].partition('_')[0]
+                    if label_idx.isdigit():
+                        max_label_idx = max(max_label_idx, int(label_idx))
+            else:
+                if self.current_function is None:
+                    self.error("instruction outside of a function")
+                self.parse_instruction(stripped)
+
+        self.tac.current_label_idx = max_label_idx + 1
+        self.tac.variable_idx = max((reg.register_idx for reg in self.registers.values()), default=-1) + 1
+        self.tac.resolve_labels()
+
+        for label in self.tac.labels.values():
+            assert label.ins_idx is not None, f"jump to undefined label {label}"
+
+        return self.tac
+
+def parse_tac(text: str) -> TAC:
+    return TACParser(text).parse()
+
+def read_tac_file(path: str) -> TAC:
+    with open(path, 'r') as f:
+        return parse_tac(f.read())
@@ -1,168 +1,288 @@
+from ir.ir_cfg import get_function_ranges
 from ir.ir_tac import *
+from ir.ir_tacvm_hooks import StopEvent, VMHooks
+from ir.ir_tacvm_memory import LinearMemory, get_integer_wrapper, get_value_format, is_integer_type, wrap_value
+from dataclasses import dataclass
+from typing import Callable, Sequence, Tuple
+import asyncio
+import operator
+import time
+
+def divide(left: object, right: object) -> object:
+    # c division, integers truncate toward zero
+    if isinstance(left, float) or isinstance(right, float):
+        return left / right
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+alu_functions: Dict[str, Callable[[object, object], object]] = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "mul": operator.mul,
+    "imul": operator.mul,
+    "div": divide,
+    "eq": operator.eq,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "and": operator.and_,
+    "or": operator.or_,
+}
+
+def run_alu(op: str, left: object, right: object) -> object:
+    # shared with passes that fold constants, so they compute exactly what the vm would
+    assert op in alu_functions, "unknown operation"
+    return alu_functions[op](left, right)
+
+def run_typed_alu(op: str, left: object, right: object, c_type: str | None) -> object:
+    # what native code leaves in a register of c_type
+    return wrap_value(run_alu(op, left, right), c_type)
+
+# ops whose results can leave the range of their type. comparisons give 0 or 1, and & and
+# | of two values in range stay in it
+wrapping_ops = { "add", "sub", "mul", "imul", "div" }
+
+def get_wrapped_type(ins: Arithmetic) -> str | None:
+    # the integer type the result of ins wraps to on its way into a register, None if it
+    # goes in as it is. memory wraps everything it stores on its own
+    if isinstance(ins.dest, VirtualRegister) and ins.op in wrapping_ops and is_integer_type(ins.dest.val_type):
+        return ins.dest.val_type
+    return None
+
+def is_integer_operand(operand: object) -> bool:
+    # whether operand is known to hold an int. the front end doesn't lower casts yet, so
+    # a float can still turn up in an integer expression
+    if isinstance(operand, VirtualRegister):
+        return operand.val_type is not None and (operand.val_type.endswith('*') or is_integer_type(operand.val_type))
+    return type(operand) is int or isinstance(operand, StackSlot)
+
+# a prepared instruction takes its own index and the running function's registers, and
+# returns the index of the next one to run
+Handler = Callable[[int, List[object]], int]
+Reader = Callable[[List[object]], object]
+Writer = Callable[[List[object], object], None]
+
+# a call takes a word for the return address, one for the base pointer and one for every
+# register and stack slot of the callee off the stack, like a native frame that spills
+# them all
+word_size = 8
+
+def get_register_slots(tac: TAC) -> Tuple[Dict[int, int], Dict[str, int]]:
+    # every register belongs to one function and gets a slot in that function's frame.
+    # returns register idx -> slot and function -> frame size
+    register_slots: Dict[int, int] = {}
+    frame_sizes: Dict[str, int] = {}
+    for fun_name, (start, end) in get_function_ranges(tac).items():
+        fun_slots: Dict[int, int] = {}
+        for ins in tac.ir_code[start:end]:
+            for reg in instruction_registers(ins):
+                fun_slots.setdefault(reg.register_idx, len(fun_slots))
+
+        for reg_idx, slot in fun_slots.items():
+            assert register_slots.get(reg_idx, slot) == slot, f"t{reg_idx} is used by more than one function"
+            register_slots[reg_idx] = slot
+        frame_sizes[fun_name] = len(fun_slots)
+
+    return register_slots, frame_sizes
+
+def get_stack_slot_offsets(tac: TAC) -> Tuple[Dict[int, int], Dict[str, int]]:
+    # every stack slot belongs to one function and gets a word right below the sp its
+    # frame starts at. returns id(slot) -> offset from that sp and function -> slot count
+    slot_offsets: Dict[int, int] = {}
+    slot_counts: Dict[str, int] = {}
+    for fun_name, (start, end) in get_function_ranges(tac).items():
+        fun_slots: Dict[int, int] = {}
+        for ins in tac.ir_code[start:end]:
+            for slot in instruction_stack_slots(ins):
+                fun_slots.setdefault(id(slot), -word_size * (len(fun_slots) + 1))
+
+        for slot_id, offset in fun_slots.items():
+            assert slot_offsets.get(slot_id, offset) == offset, "a stack slot is used by more than one function"
+            slot_offsets[slot_id] = offset
+        slot_counts[fun_name] = len(fun_slots)
+
+    return slot_offsets, slot_counts
+
+@dataclass(slots=True)
+class Frame:
+    fun_name: str
+    # the function's registers by slot. None means not defined yet
+    regs: List[object]
+    # the call to continue after and the caller's register that gets the result
+    return_pc: int | None
+    out_register: VirtualRegister | None
+    # sp at the call, everything the callee pushed goes away with it. its stack slots
+    # are right below
+    sp: int
+
+@dataclass
+class VMSnapshot:
+    # taken between runs, nothing is on the call stack
+    sp: int
+    return_val: object
+    steps: int
+    max_call_depth: int
+    branches: int
+
+@dataclass
+class RunResult:
+    # "returned", "out of steps", "timeout", "stopped" at a hook, or "error" when the
+    # program raised
+    status: str
+    return_val: object
+    # instructions this run executed
+    steps: int
+    error: Exception | None = None
 
 class TACVM:
-    def __init__(self, tac: TAC) -> None:
+    def __init__(self, tac: TAC, memory_size: int = 1 << 20) -> None:
         self.tac = tac
         self.pc = 0
-        self.memory: Dict[int, object] = {}
-        self.reg_file: Dict[str, object] = {}
-        self.reg_file["sp"] = 0xFFFF
-        self.reg_file["bp"] = 0xFFFF
-        self.reg_file["ra"] = 0
-        self.reg_file["rt"] = 0
-
-        # used to get which local vars should be stack saved
+        self.memory = LinearMemory(memory_size)
+        # sp is the lowest byte in use, the stack starts out empty at the top
+        self.sp = self.memory.get_stack_top()
+
+        self.register_slots, self.frame_sizes = get_register_slots(tac)
+        self.slot_offsets, slot_counts = get_stack_slot_offsets(tac)
+        # what a call to each function takes off the stack
+        self.frame_bytes = { fun_name: word_size * (frame_size + 2 + slot_counts[fun_name]) for fun_name, frame_size in self.frame_sizes.items() }
+        # the running function's frame, and its callers' frames
+        self.frame: Frame = None
+        self.frames: List[Frame] = []
+        # the running function's registers, same list as self.frame.regs
+        self.regs: List[object] = []
+
+        # value returned by the entry function
+        self.return_val = None
+        self.steps = 0
+        self.max_call_depth = 0
+        # jumps and conditional branches executed, taken or not
+        self.branches = 0
+
         self.current_function: str = None
-        self.caller_name_stack: List[str] = []
 
         # call args go here. no threads allowed
         self.call_arg_vals = []
 
-        # needs to be a stack because of recursive calls
-        self.ret_registers = []
+        # one closure per instruction, built by prepare
+        self.handlers: List[Handler] = None
 
-        # local_variable
-        self.fun_block_regs: Dict[str, List[VirtualRegister]] = {}
+        # what reset goes back to, taken by snapshot or the first call
+        self.saved: VMSnapshot = None
 
-    def get_src_val(self, source: VirtualRegister | MemoryLocation) -> object:
-        if not isinstance(source, VirtualRegister | MemoryLocation | UDVal):
+        # breakpoints, watchpoints and tracers, see get_hooks. why the last run with hooks stopped
+        self.hooks: VMHooks = None
+        self.stop_event: StopEvent = None
+
+    def get_src_val(self, source: VirtualRegister | MemoryLocation | StackSlot) -> object:
+        if not isinstance(source, VirtualRegister | MemoryLocation | UDVal | StackSlot):
             return source
         
         if isinstance(source, VirtualRegister):
-            return self.reg_file[source.register_name]
+            return self.regs[self.register_slots[source.register_idx]]
+        elif isinstance(source, StackSlot):
+            return self.frame.sp + self.slot_offsets[id(source)]
         elif isinstance(source, UDVal):
             return self.get_src_val(source.val)
-        elif isinstance(source, MemoryLocation) and isinstance(source.location, UDVal):
-            return self.get_src_val(source.location)
         else:
-            return self.memory[self.get_src_val(source.location) + source.offset]
+            return self.memory.load(self.get_src_val(source.location) + source.offset, self.get_memory_type(source))
+
+    def get_stored_val(self, source: object) -> object:
+        # store_val takes anything that isn't a register, memory or an address as is
+        return source if not isinstance(source, VirtualRegister | MemoryLocation | StackSlot) else self.get_src_val(source)
     
     def store_val(self, dest: VirtualRegister | MemoryLocation | object, source: VirtualRegister | MemoryLocation):
-        val = source if not isinstance(source, VirtualRegister | MemoryLocation) else self.get_src_val(source)
+        val = self.get_stored_val(source)
         
         if isinstance(dest, VirtualRegister):
-            self.reg_file[dest.register_name] = val
+            # registers hold what a native one of their type would
+            self.regs[self.register_slots[dest.register_idx]] = wrap_value(val, dest.val_type)
         
         elif isinstance(dest, MemoryLocation):
-            self.memory[self.get_src_val(dest.location) + dest.offset] = val
+            self.memory.store(self.get_src_val(dest.location) + dest.offset, self.get_memory_type(dest), val)
+
+    def get_memory_type(self, mem_loc: MemoryLocation) -> str | None:
+        if isinstance(mem_loc.location, StackSlot):
+            return mem_loc.location.val_type
+
+        location_type = mem_loc.location.val_type if isinstance(mem_loc.location, VirtualRegister) else None
+        if location_type and location_type.endswith('*'):
+            return location_type[:-1]
+        return None
         
-    def set_pc_before(self, dest: VirtualRegister | MemoryLocation):
+    def set_pc_before(self, dest: Label | VirtualRegister | MemoryLocation):
         # minus 1 bc of pc inc after
-        self.pc = self.tac.label_to_ins_idx[self.get_src_val(dest)] - 1
+        if isinstance(dest, Label):
+            self.pc = dest.ins_idx - 1
+        else:
+            self.pc = self.tac.label_to_ins_idx[self.get_src_val(dest)] - 1
 
     def set_current_function(self, curr_fun_name: str):
         self.current_function = curr_fun_name
     
     def run_alu(self, op: str, left: object, right: object) -> object:
-        if op == "add":
-            return left + right
-        elif op == "sub":
-            return left - right
-        elif op == "mul":
-            return left * right
-        elif op == "div":
-            return left / right
-        elif op == "eq":
-            return left == right
-        elif op == "lt":
-            return left < right
-        elif op == "lte":
-            return left <= right
-        elif op == "gt":
-            return left > right
-        elif op == "gte":
-            return left >= right
-        elif op == "and":
-            return left & right
-        elif op == "or":
-            return left | right
-        else:
-            assert False, "unknown operation"
-
-    def push_stack_frame(self):
-        self.caller_name_stack.append(self.current_function)
-        old_bp = self.reg_file["bp"]
-        self.reg_file["bp"] = self.reg_file["sp"]
-        # push the previous base pointer onto the stack
-        self.store_val(MemoryLocation(location=self.reg_file["bp"]), old_bp)
-        self.reg_file["sp"] -= 1
-
-        # push ra on to the stack and set ra to the next instruction
-        self.store_val(MemoryLocation(location=self.reg_file["bp"] - 1), self.reg_file["ra"])
-        self.reg_file["sp"] -= 1
-        self.reg_file["ra"] = self.pc  # no need for + 1 since will automatically inc to next ins
-        
-        # push locals onto stack. intermediate temporaries shouldn't matter
-        for i, var_ir_name in enumerate(self.tac.fun_name_to_locals[self.current_function]):
-            var_reg = self.tac.variable_to_location[var_ir_name]
-            # ignore locals that have escaped to stack (via. &)
-            if not isinstance(var_reg, VirtualRegister): 
-                continue
-
-            # some locals might not be defined yet
-            if not var_reg.register_name in self.reg_file:
-                continue
-            
-            self.store_val(MemoryLocation(self.reg_file["bp"] - i - 2), self.get_src_val(self.tac.variable_to_location[var_ir_name]))
-            self.reg_file["sp"] -= 1
-        
-    def pop_stack_frame(self):
-        self.set_current_function(self.caller_name_stack.pop())
-        # restore locals
-        local_vars = self.tac.fun_name_to_locals[self.current_function]
-        for i, local_var in enumerate(local_vars):
-            var_reg = self.tac.variable_to_location[local_var]
-            # ignore locals that have escaped to stack (via. &)
-            if not isinstance(var_reg, VirtualRegister): 
-                continue
-
-            # some locals might not be defined yet
-            if not var_reg.register_name in self.reg_file:
-                continue
-
-            restore_to_reg = self.tac.get_virt_register(local_var)
-            self.store_val(restore_to_reg, MemoryLocation(self.reg_file["bp"] - i - 2))
-
-        # restore return addr
-        return_to = self.reg_file["ra"]
-        self.reg_file["ra"] = self.get_src_val(MemoryLocation(self.reg_file["bp"] - 1))
-        # restore the base pointer
-        self.reg_file["bp"] = self.get_src_val(MemoryLocation(self.reg_file["bp"]))
-
-        # restore the stack pointer
-        self.reg_file["sp"] = self.reg_file["bp"]
-
-        return return_to
+        return run_alu(op, left, right)
+
+    def enter_frame(self, frame: Frame):
+        self.frame = frame
+        self.regs = frame.regs
+        self.set_current_function(frame.fun_name)
+
+    def start_function(self, fun_name: str, args: Sequence[object] = ()):
+        # runs fun_name as the entry function, its return halts the vm
+        self.enter_frame(Frame(fun_name, [None] * self.frame_sizes[fun_name], None, None, self.sp))
+        self.sp -= self.frame_bytes[fun_name]
+        self.memory.check_stack(self.sp)
+        self.pc = self.tac.label_to_ins_idx[fun_name]
+        self.call_arg_vals.extend(args)
+        self.stop_event = None
+        if self.hooks is not None:
+            self.hooks.resume_pc = None
+
+    def call_function(self, fun_name: str, return_pc: int, out_register: VirtualRegister | None, args: List[object]):
+        # the caller's registers stay in its frame, so nothing needs saving
+        self.frames.append(self.frame)
+        self.max_call_depth = max(self.max_call_depth, len(self.frames))
+        self.enter_frame(Frame(fun_name, [None] * self.frame_sizes[fun_name], return_pc, out_register, self.sp))
+
+        self.sp -= self.frame_bytes[fun_name]
+        self.memory.check_stack(self.sp)
+        self.call_arg_vals.extend(args)
+
+    def return_from_function(self, val: object) -> int:
+        # returns the index of the call to continue after
+        callee = self.frame
+        self.sp = callee.sp
+        self.enter_frame(self.frames.pop())
+        if callee.out_register is not None:
+            self.store_val(callee.out_register, val)
+
+        return callee.return_pc
         
     def run_instruction(self):
         curr_ins = self.tac.ir_code[self.pc]
 
         if isinstance(curr_ins, Move):
-            if isinstance(curr_ins.src, UDVal) and isinstance(curr_ins.src.val, MemoryLocation):
-                    self.store_val(curr_ins.dest, curr_ins.src.val.get_address())
-            else:
-                self.store_val(curr_ins.dest, curr_ins.src)
+            self.store_val(curr_ins.dest, curr_ins.src)
 
         elif isinstance(curr_ins, Jump):
+            self.branches += 1
             self.set_pc_before(curr_ins.dest)
 
         elif isinstance(curr_ins, JumpIf):
+            self.branches += 1
             if self.get_src_val(curr_ins.cond) != 0:
                 self.set_pc_before(curr_ins.dest)
 
         elif isinstance(curr_ins, JumpIfNot):
+            self.branches += 1
             if self.get_src_val(curr_ins.cond) == 0:
                 self.set_pc_before(curr_ins.dest)
 
         elif isinstance(curr_ins, Call):
-            self.push_stack_frame()
-
-            self.set_current_function(curr_ins.target)
-            self.ret_registers.append(curr_ins.out_register)
-
-            for arg in curr_ins.args:
-                self.call_arg_vals.append(self.get_src_val(arg))
-
+            args = [self.get_src_val(arg) for arg in curr_ins.args]
+            self.call_function(curr_ins.target.name, self.pc, curr_ins.out_register, args)
             self.set_pc_before(curr_ins.target)
 
         elif isinstance(curr_ins, Params):
@@ -170,25 +290,19 @@ class TACVM:
                 self.store_val(curr_ins.params_regs[i], self.call_arg_vals.pop())
         
         elif isinstance(curr_ins, Return):
-            if self.ret_registers:
-                self.store_val(self.ret_registers.pop(), curr_ins.src)
-            
-            return_to = self.pop_stack_frame()
-            self.pc = return_to
-
-        elif isinstance(curr_ins, Push):
-            mem_loc = self.tac.variable_to_location[f"ref_{curr_ins.val.register_name}"]
-            mem_loc.set_location(self.reg_file["sp"])
-            self.store_val(mem_loc, curr_ins.val)
-            self.reg_file["sp"] -= 1
-
-            # this is to update "post arch selection addrs" like sp offsets to ref vars
-            curr_ins.pushed_to = mem_loc
-        
+            # returning from the entry function halts the vm
+            if not self.frames:
+                self.return_val = self.get_src_val(curr_ins.src)
+                self.sp = self.frame.sp
+                self.pc = len(self.tac.ir_code)
+                return
+
+            self.pc = self.return_from_function(self.get_stored_val(curr_ins.src))
+
         elif isinstance(curr_ins, Pop):
-            mem_loc = MemoryLocation(self.reg_file["sp"])
-            self.store_val(curr_ins.dest, self.get_src_val(mem_loc))
-            self.reg_file["sp"] += 1
+            pop_type = curr_ins.dest.val_type if isinstance(curr_ins.dest, VirtualRegister) else None
+            self.store_val(curr_ins.dest, self.memory.load(self.sp, pop_type))
+            self.sp += get_value_format(pop_type).size
         
         elif isinstance(curr_ins, Arithmetic):
             left, right = self.get_src_val(curr_ins.left), self.get_src_val(curr_ins.right)
@@ -197,10 +311,319 @@ class TACVM:
         
         self.pc += 1
 
-    def run(self):
-        self.set_current_function("main")
-        self.pc = self.tac.label_to_ins_idx["main"]
-        
-        while self.pc < len(self.tac.ir_code):
-            # print("running: ", self.tac.ir_code[self.pc]); input()
-            self.run_instruction()
\ No newline at end of file
+    def get_reader(self, source: object) -> Reader:
+        # get_src_val with the isinstance checks done once
+        memory = self.memory
+        if not isinstance(source, VirtualRegister | MemoryLocation | UDVal | StackSlot):
+            return lambda regs: source
+
+        if isinstance(source, VirtualRegister):
+            slot = self.register_slots[source.register_idx]
+            return lambda regs: regs[slot]
+        elif isinstance(source, StackSlot):
+            # the slot of the running call
+            offset = self.slot_offsets[id(source)]
+            return lambda regs: self.frame.sp + offset
+        elif isinstance(source, UDVal):
+            return self.get_reader(source.val)
+        elif isinstance(source.location, VirtualRegister):
+            slot, offset, c_type = self.register_slots[source.location.register_idx], source.offset, self.get_memory_type(source)
+            return lambda regs: memory.load(regs[slot] + offset, c_type)
+        elif isinstance(source.location, StackSlot):
+            offset, c_type = self.slot_offsets[id(source.location)] + source.offset, self.get_memory_type(source)
+            return lambda regs: memory.load(self.frame.sp + offset, c_type)
+        else:
+            c_type = self.get_memory_type(source)
+            return lambda regs: memory.load(source.location + source.offset, c_type)
+
+    def get_stored_reader(self, source: object) -> Reader:
+        if not isinstance(source, VirtualRegister | MemoryLocation | StackSlot):
+            return lambda regs: source
+        return self.get_reader(source)
+
+    def get_writer(self, dest: object) -> Writer:
+        if isinstance(dest, VirtualRegister):
+            slot, c_type = self.register_slots[dest.register_idx], dest.val_type
+            def write_reg(regs: List[object], val: object):
+                regs[slot] = wrap_value(val, c_type)
+            return write_reg
+        elif isinstance(dest, MemoryLocation):
+            return lambda regs, val: self.store_val(dest, val)
+        else:
+            return lambda regs, val: None
+
+    def get_jump_target(self, dest: Label | VirtualRegister | MemoryLocation) -> Callable[[List[object]], int]:
+        if isinstance(dest, Label):
+            ins_idx = dest.ins_idx
+            return lambda regs: ins_idx
+        read_dest = self.get_reader(dest)
+        return lambda regs: self.tac.label_to_ins_idx[read_dest(regs)]
+
+    def prepare_arithmetic(self, ins: Arithmetic) -> Handler:
+        alu = alu_functions[ins.op]
+
+        # registers and constants are most of what loops run, those get their own closures.
+        # results that can overflow wrap to the dest register's type
+        if isinstance(ins.dest, VirtualRegister) and isinstance(ins.left, VirtualRegister):
+            dest_slot, left_slot = self.register_slots[ins.dest.register_idx], self.register_slots[ins.left.register_idx]
+            wrapped_type = get_wrapped_type(ins)
+            if wrapped_type is None:
+                wrap = None
+            elif is_integer_operand(ins.left) and is_integer_operand(ins.right):
+                wrap = get_integer_wrapper(wrapped_type)
+            else:
+                wrap = lambda val: wrap_value(val, wrapped_type)
+
+            if isinstance(ins.right, VirtualRegister):
+                right_slot = self.register_slots[ins.right.register_idx]
+                if wrap is not None:
+                    def run_reg_reg_wrapped(pc: int, regs: List[object]) -> int:
+                        regs[dest_slot] = wrap(alu(regs[left_slot], regs[right_slot]))
+                        return pc + 1
+                    return run_reg_reg_wrapped
+
+                def run_reg_reg(pc: int, regs: List[object]) -> int:
+                    regs[dest_slot] = alu(regs[left_slot], regs[right_slot])
+                    return pc + 1
+                return run_reg_reg
+
+            if isinstance(ins.right, int | float):
+                right = ins.right
+                if wrap is not None:
+                    def run_reg_const_wrapped(pc: int, regs: List[object]) -> int:
+                        regs[dest_slot] = wrap(alu(regs[left_slot], right))
+                        return pc + 1
+                    return run_reg_const_wrapped
+
+                def run_reg_const(pc: int, regs: List[object]) -> int:
+                    regs[dest_slot] = alu(regs[left_slot], right)
+                    return pc + 1
+                return run_reg_const
+
+        read_left, read_right = self.get_reader(ins.left), self.get_reader(ins.right)
+        write = self.get_writer(ins.dest)
+        def run_arithmetic(pc: int, regs: List[object]) -> int:
+            write(regs, alu(read_left(regs), read_right(regs)))
+            return pc + 1
+        return run_arithmetic
+
+    def prepare_move(self, ins: Move) -> Handler:
+        if isinstance(ins.dest, VirtualRegister) and isinstance(ins.src, VirtualRegister) \
+            and ins.dest.val_type in (None, ins.src.val_type):
+            # the value is already what the dest holds
+            dest_slot, src_slot = self.register_slots[ins.dest.register_idx], self.register_slots[ins.src.register_idx]
+            def run_copy(pc: int, regs: List[object]) -> int:
+                regs[dest_slot] = regs[src_slot]
+                return pc + 1
+            return run_copy
+        else:
+            read = self.get_stored_reader(ins.src)
+
+        write = self.get_writer(ins.dest)
+        def run_move(pc: int, regs: List[object]) -> int:
+            write(regs, read(regs))
+            return pc + 1
+        return run_move
+
+    def prepare_branch(self, ins: Jump | JumpIf | JumpIfNot) -> Handler:
+        get_target = self.get_jump_target(ins.dest)
+        if isinstance(ins, Jump):
+            def run_jump(pc: int, regs: List[object]) -> int:
+                self.branches += 1
+                return get_target(regs)
+            return run_jump
+
+        read_cond = self.get_reader(ins.cond)
+        jump_when_zero = isinstance(ins, JumpIfNot)
+        def run_cond_jump(pc: int, regs: List[object]) -> int:
+            self.branches += 1
+            return get_target(regs) if (read_cond(regs) == 0) == jump_when_zero else pc + 1
+        return run_cond_jump
+
+    def prepare_call(self, ins: Call) -> Handler:
+        arg_readers = [self.get_reader(arg) for arg in ins.args]
+        get_target = self.get_jump_target(ins.target)
+        fun_name, out_register = ins.target.name, ins.out_register
+        def run_call(pc: int, regs: List[object]) -> int:
+            self.call_function(fun_name, pc, out_register, [read(regs) for read in arg_readers])
+            return get_target(regs)
+        return run_call
+
+    def prepare_return(self, ins: Return) -> Handler:
+        read_return, read_stored = self.get_reader(ins.src), self.get_stored_reader(ins.src)
+        code_len = len(self.tac.ir_code)
+        def run_return(pc: int, regs: List[object]) -> int:
+            # returning from the entry function halts the vm
+            if not self.frames:
+                self.return_val = read_return(regs)
+                self.sp = self.frame.sp
+                return code_len
+            return self.return_from_function(read_stored(regs)) + 1
+        return run_return
+
+    def prepare_instruction(self, ins: TACInstruction) -> Handler:
+        if isinstance(ins, Move):
+            return self.prepare_move(ins)
+        elif isinstance(ins, Jump | JumpIf | JumpIfNot):
+            return self.prepare_branch(ins)
+        elif isinstance(ins, Call):
+            return self.prepare_call(ins)
+        elif isinstance(ins, Return):
+            return self.prepare_return(ins)
+        elif isinstance(ins, Arithmetic):
+            return self.prepare_arithmetic(ins)
+
+        elif isinstance(ins, Params):
+            writers = [self.get_writer(reg) for reg in reversed(ins.params_regs)]
+            def run_params(pc: int, regs: List[object]) -> int:
+                for write in writers:
+                    write(regs, self.call_arg_vals.pop())
+                return pc + 1
+            return run_params
+
+        elif isinstance(ins, Pop):
+            write, memory = self.get_writer(ins.dest), self.memory
+            pop_type = ins.dest.val_type if isinstance(ins.dest, VirtualRegister) else None
+            pop_size = get_value_format(pop_type).size
+            def run_pop(pc: int, regs: List[object]) -> int:
+                write(regs, memory.load(self.sp, pop_type))
+                self.sp += pop_size
+                return pc + 1
+            return run_pop
+
+        return lambda pc, regs: pc + 1
+
+    def prepare(self) -> List[Handler]:
+        # translates every instruction into a closure once, so running one is a single call
+        # instead of the isinstance ladder in run_instruction. labels have to be resolved
+        self.handlers = [self.prepare_instruction(ins) for ins in self.tac.ir_code]
+        return self.handlers
+
+    def snapshot(self):
+        # replaces the last snapshot. memory only keeps track of the pages written since
+        assert not self.frames, "can't snapshot in the middle of a call"
+        self.memory.snapshot()
+        self.saved = VMSnapshot(self.sp, self.return_val, self.steps, self.max_call_depth, self.branches)
+
+    def reset(self):
+        # back to the last snapshot. lists the closures hold on to are changed in place
+        saved = self.saved
+        assert saved is not None, "no snapshot to reset to"
+        self.memory.restore()
+
+        self.pc, self.sp = 0, saved.sp
+        self.return_val, self.steps, self.max_call_depth, self.branches = saved.return_val, saved.steps, saved.max_call_depth, saved.branches
+        self.frame, self.regs = None, []
+        self.frames.clear()
+        self.call_arg_vals.clear()
+        self.set_current_function(None)
+
+    def call(self, entry: str, args: Sequence[object] = (), interpret: bool = False) -> object:
+        # runs entry(*args) from the state before the first call and returns its result.
+        # the closures, register slots and everything else derived from the tac are kept
+        if self.saved is None:
+            self.snapshot()
+        else:
+            self.reset()
+
+        self.run(interpret, entry, args)
+        return self.return_val
+
+    def run(self, interpret: bool = False, entry: str = "main", args: Sequence[object] = ()):
+        self.start_function(entry, args)
+
+        if interpret:
+            while self.pc < len(self.tac.ir_code):
+                self.run_instruction()
+                self.steps += 1
+            return
+
+        if self.hooks is not None and self.hooks.is_active():
+            self.hooks.run(None)
+            return
+
+        handlers = self.handlers if self.handlers is not None else self.prepare()
+        code_len, pc, steps = len(handlers), self.pc, 0
+        while pc < code_len:
+            # calls and returns switch self.regs
+            pc = handlers[pc](pc, self.regs)
+            steps += 1
+
+        self.pc = pc
+        self.steps += steps
+
+    def get_hooks(self) -> VMHooks:
+        # installs hooks on first use. the closures run the hooked loop while any are set
+        if self.hooks is None:
+            self.hooks = VMHooks(self)
+        return self.hooks
+
+    def remove_hooks(self):
+        self.hooks = None
+
+    def run_for(self, max_steps: int) -> bool:
+        # runs at most max_steps more instructions of the started run and returns whether it
+        # finished. everything it needs to go on is in the vm, so runs can be interleaved
+        assert self.frame is not None, "no run was started"
+        # a stop from an earlier slice is only reported by the slice that hit it
+        self.stop_event = None
+        if self.hooks is not None and self.hooks.is_active():
+            return self.hooks.run(max_steps)
+
+        handlers = self.handlers if self.handlers is not None else self.prepare()
+        code_len, pc, steps = len(handlers), self.pc, 0
+        while pc < code_len and steps < max_steps:
+            pc = handlers[pc](pc, self.regs)
+            steps += 1
+
+        self.pc = pc
+        self.steps += steps
+        return pc >= code_len
+
+    def run_slices(self, slice_steps: int, max_steps: int | None, timeout: float | None):
+        # generator behind run_limited and run_async, yields between slices and returns
+        # the RunResult
+        start_steps, deadline = self.steps, None if timeout is None else time.perf_counter() + timeout
+        while True:
+            steps = self.steps - start_steps
+            if max_steps is not None and steps >= max_steps:
+                return RunResult("out of steps", None, steps)
+            if deadline is not None and time.perf_counter() >= deadline:
+                return RunResult("timeout", None, steps)
+
+            budget = slice_steps if max_steps is None else min(slice_steps, max_steps - steps)
+            try:
+                if self.run_for(budget):
+                    return RunResult("returned", self.return_val, self.steps - start_steps)
+                if self.stop_event is not None:
+                    return RunResult("stopped", None, self.steps - start_steps)
+            except Exception as e:
+                # the instructions of the failed slice aren't counted
+                return RunResult("error", None, self.steps - start_steps, e)
+
+            yield
+
+    def run_limited(self, entry: str = "main", args: Sequence[object] = (), max_steps: int | None = None,
+                    timeout: float | None = None, slice_steps: int = 10000) -> RunResult:
+        # run with an instruction budget and a wall clock timeout in seconds, checked every
+        # slice_steps instructions
+        self.start_function(entry, args)
+        slices = self.run_slices(slice_steps, max_steps, timeout)
+        while True:
+            try:
+                next(slices)
+            except StopIteration as stop:
+                return stop.value
+
+    async def run_async(self, entry: str = "main", args: Sequence[object] = (), max_steps: int | None = None,
+                        timeout: float | None = None, slice_steps: int = 10000) -> RunResult:
+        # run_limited that gives the event loop back after every slice, so any number of vms
+        # can share one loop
+        self.start_function(entry, args)
+        slices = self.run_slices(slice_steps, max_steps, timeout)
+        while True:
+            try:
+                next(slices)
+            except StopIteration as stop:
+                return stop.value
+            await asyncio.sleep(0)
@@ -0,0 +1,122 @@
+from ir.ir_cfg import get_defs
+from ir.ir_tac import *
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+# breakpoints, watchpoints and tracing for the TACVM
+#
+# TACVM.run and run_for look at vm.hooks once per call. with hooks installed they hand the
+# run to VMHooks.run, a copy of their loop that checks the hooks around every
+# instruction, so runs without hooks keep the plain loop and pay nothing. breakpoints stop
+# before the instruction at their index runs, watchpoints right after the instruction
+# that changed what they watch. a stopped run leaves the reason in vm.stop_event and goes
+# on from where it stopped with run_for
+
+@dataclass
+class StopEvent:
+    # "breakpoint", "register" or "memory"
+    kind: str
+    # the instruction about to run for breakpoints, the one that wrote for watchpoints
+    pc: int
+    # the label or index, the register, or (address, size)
+    where: object
+    old: object = None
+    new: object = None
+
+# called with the vm and the index of every instruction before it runs
+Tracer = Callable[[object, int], None]
+
+class VMHooks:
+    def __init__(self, vm) -> None:
+        self.vm = vm
+        # instruction idx -> the label or index the breakpoint was set with
+        self.breakpoints: Dict[int, str | int] = {}
+        # register idx -> register
+        self.watched_registers: Dict[int, VirtualRegister] = {}
+        self.watched_memory: List[Tuple[int, int]] = []
+        self.tracers: List[Tracer] = []
+
+        # the breakpoint the run stopped at doesn't stop it again when it goes on
+        self.resume_pc: int | None = None
+
+    def is_active(self) -> bool:
+        return bool(self.breakpoints or self.watched_registers or self.watched_memory or self.tracers)
+
+    def get_ins_idx(self, where: str | int) -> int:
+        return self.vm.tac.label_to_ins_idx[where] if isinstance(where, str) else where
+
+    def add_breakpoint(self, where: str | int):
+        # where is a label (functions included) or an instruction index
+        self.breakpoints[self.get_ins_idx(where)] = where
+
+    def remove_breakpoint(self, where: str | int):
+        self.breakpoints.pop(self.get_ins_idx(where), None)
+
+    def watch_register(self, reg: VirtualRegister | str):
+        if isinstance(reg, str):
+            registers = { reg.register_name: reg for ins in self.vm.tac.ir_code for reg in instruction_registers(ins) }
+            assert reg in registers, f"no register {reg}"
+            reg = registers[reg]
+        self.watched_registers[reg.register_idx] = reg
+
+    def watch_memory(self, addr: int, size: int = 1):
+        self.watched_memory.append((addr, size))
+
+    def add_tracer(self, tracer: Tracer):
+        self.tracers.append(tracer)
+
+    def get_watched_writes(self, ins: TACInstruction) -> List[Tuple[VirtualRegister, List[object]]]:
+        # the watched registers ins writes, with the register list they are in. a call's out
+        # register is written by the callee's return, into the caller's frame
+        vm = self.vm
+        if isinstance(ins, Return):
+            out_register = vm.frame.out_register
+            if vm.frames and isinstance(out_register, VirtualRegister) and out_register.register_idx in self.watched_registers:
+                return [(out_register, vm.frames[-1].regs)]
+            return []
+        elif isinstance(ins, Call):
+            return []
+
+        return [(reg, vm.regs) for reg in get_defs(ins) if isinstance(reg, VirtualRegister) and reg.register_idx in self.watched_registers]
+
+    def run(self, max_steps: int | None) -> bool:
+        # TACVM.run_for with the hooks checked, returns whether the run finished
+        vm = self.vm
+        handlers = vm.handlers if vm.handlers is not None else vm.prepare()
+        code, code_len = vm.tac.ir_code, len(handlers)
+        data, register_slots = vm.memory.data, vm.register_slots
+
+        vm.stop_event = None
+        pc, steps = vm.pc, 0
+        while pc < code_len and (max_steps is None or steps < max_steps):
+            if pc in self.breakpoints and pc != self.resume_pc:
+                vm.stop_event = StopEvent("breakpoint", pc, self.breakpoints[pc])
+                self.resume_pc = pc
+                break
+            self.resume_pc = None
+
+            for tracer in self.tracers:
+                tracer(vm, pc)
+
+            writes = [(reg, regs, regs[register_slots[reg.register_idx]]) for reg, regs in self.get_watched_writes(code[pc])]
+            old_memory = [bytes(data[addr:addr + size]) for addr, size in self.watched_memory]
+
+            ran_pc = pc
+            pc = handlers[pc](pc, vm.regs)
+            steps += 1
+
+            for reg, regs, old in writes:
+                new = regs[register_slots[reg.register_idx]]
+                if type(new) is not type(old) or new != old:
+                    vm.stop_event = StopEvent("register", ran_pc, reg, old, new)
+            for (addr, size), old in zip(self.watched_memory, old_memory):
+                new = bytes(data[addr:addr + size])
+                if new != old:
+                    vm.stop_event = StopEvent("memory", ran_pc, (addr, size), old, new)
+
+            if vm.stop_event is not None:
+                break
+
+        vm.pc = pc
+        vm.steps += steps
+        return pc >= code_len
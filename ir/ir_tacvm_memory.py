@@ -0,0 +1,134 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Set
+import struct
+
+# linear memory for the TACVM
+#
+# one preallocated bytearray addressed in bytes. the bottom guard_size bytes are never
+# handed out, so null and small pointers fault instead of reading something. the stack
+# takes the rest and grows down from the top. values are stored little endian with the
+# size of their c type, and integers wrap to that size on store like they would natively.
+# stores mark the pages they touch, so going back to a snapshot only copies the pages
+# written since it was taken
+
+class MemoryFault(Exception):
+    pass
+
+integral_formats = { "char": "b", "short": "h", "int": "i", "long": "q" }
+float_formats = { "float": "f", "double": "d" }
+
+page_shift = 12
+
+@dataclass
+class ValueFormat:
+    size: int
+    load_struct: struct.Struct
+    # integers are masked and stored unsigned, loads give them their sign back
+    store_struct: struct.Struct
+    mask: int | None # None for floats
+    sign_bit: int | None # None for floats and unsigned types
+
+def make_value_format(c_type: str | None) -> ValueFormat:
+    # pointers, and values whose type isn't known, take a full 8 byte word
+    if c_type in float_formats:
+        value_struct = struct.Struct(f"<{float_formats[c_type]}")
+        return ValueFormat(value_struct.size, value_struct, value_struct, None, None)
+
+    base = c_type.removeprefix("unsigned ") if c_type else None
+    fmt = integral_formats.get(base, "q")
+    is_unsigned = base != c_type and base in integral_formats
+    load_fmt = fmt.upper() if is_unsigned else fmt
+
+    load_struct = struct.Struct(f"<{load_fmt}")
+    bits = 8 * load_struct.size
+    return ValueFormat(load_struct.size, load_struct, struct.Struct(f"<{fmt.upper()}"), (1 << bits) - 1,
+                       None if is_unsigned else 1 << (bits - 1))
+
+value_formats: Dict[str | None, ValueFormat] = {}
+
+def get_value_format(c_type: str | None) -> ValueFormat:
+    if not c_type in value_formats:
+        value_formats[c_type] = make_value_format(c_type)
+    return value_formats[c_type]
+
+def is_integer_type(c_type: str | None) -> bool:
+    # pointers aren't, their arithmetic doesn't wrap
+    return c_type is not None and not c_type.endswith('*') and get_value_format(c_type).mask is not None
+
+def get_integer_wrapper(c_type: str) -> Callable[[int], int]:
+    # wrap_value for ints going into an integer type, without the checks
+    value_format = get_value_format(c_type)
+    mask, sign_bit = value_format.mask, value_format.sign_bit
+    if sign_bit is None:
+        return lambda val: val & mask
+    return lambda val: ((val + sign_bit) & mask) - sign_bit
+
+def wrap_value(val: object, c_type: str | None) -> object:
+    # what a native register or variable of c_type holds after val is put in it: integers
+    # wrap around, floats going into integers truncate. unknown types keep val as is
+    if c_type is None or not isinstance(val, int | float):
+        return val
+
+    value_format = get_value_format(c_type)
+    if value_format.mask is None:
+        return float(val)
+
+    val = int(val) & value_format.mask
+    if value_format.sign_bit is not None and val & value_format.sign_bit:
+        val -= value_format.mask + 1
+    return val
+
+class LinearMemory:
+    def __init__(self, size: int = 1 << 20, guard_size: int = 4096) -> None:
+        assert guard_size < size, "no room for the stack"
+        self.size = size
+        self.guard_size = guard_size
+        self.data = bytearray(size)
+
+        # contents at the last snapshot, and the pages stored to since
+        self.snapshot_data: bytes = None
+        self.dirty_pages: Set[int] = set()
+
+    def get_stack_top(self) -> int:
+        return self.size
+
+    def check_access(self, addr: int, size: int):
+        if not isinstance(addr, int) or addr < self.guard_size or addr + size > self.size:
+            raise MemoryFault(f"invalid access of {size} bytes at {addr}")
+
+    def check_stack(self, sp: int):
+        # the stack grows down into the guard
+        if sp < self.guard_size:
+            raise MemoryFault(f"stack overflow, sp {sp} is below {self.guard_size}")
+
+    def load(self, addr: int, c_type: str | None) -> object:
+        value_format = get_value_format(c_type)
+        self.check_access(addr, value_format.size)
+        return value_format.load_struct.unpack_from(self.data, addr)[0]
+
+    def store(self, addr: int, c_type: str | None, val: object):
+        value_format = get_value_format(c_type)
+        self.check_access(addr, value_format.size)
+        # values can straddle two pages
+        self.dirty_pages.add(addr >> page_shift)
+        self.dirty_pages.add((addr + value_format.size - 1) >> page_shift)
+        if value_format.mask is None:
+            value_format.store_struct.pack_into(self.data, addr, float(val))
+        else:
+            value_format.store_struct.pack_into(self.data, addr, int(val) & value_format.mask)
+
+    def get_used_bytes(self, sp: int) -> int:
+        return self.size - sp
+
+    def snapshot(self):
+        # replaces the last snapshot
+        self.snapshot_data = bytes(self.data)
+        self.dirty_pages.clear()
+
+    def restore(self):
+        # back to the last snapshot, in time proportional to the pages written since
+        assert self.snapshot_data is not None, "no snapshot to restore"
+        for page in self.dirty_pages:
+            start, end = page << page_shift, (page + 1) << page_shift
+            self.data[start:end] = self.snapshot_data[start:end]
+        self.dirty_pages.clear()
@@ -0,0 +1,165 @@
+from ir.ir_cfg import *
+
+# self tail call and accumulator recursion elimination over TAC
+#
+# `return f(x);` inside f becomes moves into f's parameters and a jump back to the
+# start of f's body. `return n * f(n - 1);` style recursion gets an accumulator
+# register: the call site folds n into the accumulator and jumps back, and every other
+# return in f returns accumulator op value instead. only integer ops that are
+# associative and commutative qualify, so reordering the operations keeps the result.
+# functions with stack slots keep their calls
+
+accumulator_identity = { "add": 0, "mul": 1, "imul": 1, "and": -1, "or": 0 }
+
+class TailRecursionEliminator:
+    def __init__(self, cfg: FunctionCFG) -> None:
+        self.cfg = cfg
+        self.tac = cfg.tac
+        self.fun_name = cfg.fun_name
+
+        self.tail_call_count = 0
+        self.accumulator_count = 0
+
+    def is_self_call(self, ins: TACInstruction) -> bool:
+        return isinstance(ins, Call) and str(ins.target) == self.fun_name
+
+    def find_sites(self, use_counts: Dict[int, int]) -> List[Tuple[BasicBlock, str | None]]:
+        # (block, accumulator op or None for a plain tail call). the call is always the
+        # last instruction before the return, or followed by the one accumulating op
+        sites = []
+        for block in self.cfg.blocks:
+            ins = block.instructions
+            if len(ins) < 2 or not isinstance(ins[-1], Return):
+                continue
+
+            ret = ins[-1]
+            if self.is_self_call(ins[-2]) and ret.src is ins[-2].out_register:
+                sites.append((block, None))
+                continue
+
+            if len(ins) < 3 or not self.is_self_call(ins[-3]) or not isinstance(ins[-2], Arithmetic):
+                continue
+
+            call, arith = ins[-3], ins[-2]
+            if not arith.op in accumulator_identity or ret.src is not arith.dest or not is_integral_register(arith.dest):
+                continue
+            if use_counts.get(call.out_register.register_idx, 0) != 1:
+                continue
+
+            operands = [arith.left, arith.right]
+            if sum(op is call.out_register for op in operands) != 1:
+                continue
+
+            sites.append((block, arith.op))
+
+        return sites
+
+    def split_entry(self) -> BasicBlock:
+        # the loop goes back to right after params
+        entry = self.cfg.blocks[0]
+        body = BasicBlock([], entry.instructions[1:])
+        body.next_block = entry.next_block
+        body.branch_block = entry.branch_block
+
+        entry.instructions = entry.instructions[:1]
+        entry.next_block = body
+        entry.branch_block = None
+
+        self.cfg.blocks.insert(1, body)
+        self.cfg.compute_edges()
+
+        return body
+
+    def run(self):
+        entry = self.cfg.blocks[0]
+        if not entry.instructions or not isinstance(entry.instructions[0], Params):
+            return
+        # every call needs its own stack slots, an address of the caller's may be passed on
+        if any(instruction_stack_slots(ins) for ins in self.cfg.get_instructions()):
+            return
+
+        use_counts: Dict[int, int] = {}
+        for ins in self.cfg.get_instructions():
+            for reg in get_uses(ins):
+                use_counts[reg.register_idx] = use_counts.get(reg.register_idx, 0) + 1
+
+        sites = self.find_sites(use_counts)
+        # only one accumulator per function. sites using a different op stay calls
+        accumulator_op = next((op for _, op in sites if op), None)
+        sites = [(block, op) for block, op in sites if op is None or op == accumulator_op]
+        if not sites:
+            return
+
+        params = entry.instructions[0].params_regs
+        body = self.split_entry()
+
+        accumulator = None
+        if accumulator_op:
+            accumulator_ins = next(block.instructions[-2] for block, op in sites if op)
+            accumulator = self.tac.get_next_virt_register(val_type=accumulator_ins.dest.val_type)
+            entry.instructions.append(Move(None, accumulator, accumulator_identity[accumulator_op]))
+
+        site_blocks = set()
+        for block, op in sites:
+            site_blocks.add(block)
+            call_idx = len(block.instructions) - (3 if op else 2)
+            call = block.instructions[call_idx]
+            new_instructions = block.instructions[:call_idx]
+
+            if op:
+                arith = block.instructions[-2]
+                operand = arith.right if arith.left is call.out_register else arith.left
+                new_instructions.append(Arithmetic(accumulator, op, accumulator, operand))
+                self.accumulator_count += 1
+            else:
+                self.tail_call_count += 1
+
+            new_instructions.extend(self.get_param_moves(params, call.args))
+
+            block.instructions = new_instructions
+            block.next_block = body
+
+        if accumulator:
+            # every remaining return hands back accumulator op value
+            for block in self.cfg.blocks:
+                if block in site_blocks or not block.instructions or not isinstance(block.instructions[-1], Return):
+                    continue
+
+                ret = block.instructions[-1]
+                result = self.tac.get_next_virt_register(val_type=accumulator.val_type)
+                block.instructions[-1:] = [Arithmetic(result, accumulator_op, accumulator, ret.src), Return(result)]
+
+        self.cfg.compute_edges()
+
+    def get_param_moves(self, params: List[VirtualRegister], args: List[object]) -> List[Move]:
+        # arguments that read a parameter are copied first, since the parameters get overwritten
+        param_idxs = { reg.register_idx for reg in params }
+        moves = []
+        safe_args = []
+        for param, arg in zip(params, args):
+            reads_param = any(reg.register_idx in param_idxs and reg is not param for reg in get_operand_uses(arg))
+            if reads_param:
+                copy_reg = self.tac.get_next_virt_register(val_type=param.val_type)
+                moves.append(Move(None, copy_reg, arg))
+                arg = copy_reg
+            safe_args.append(arg)
+
+        for param, arg in zip(params, safe_args):
+            if arg is not param:
+                moves.append(Move(None, param, arg))
+
+        return moves
+
+def eliminate_tail_recursion(tac: TAC, cfgs: Dict[str, FunctionCFG] = None) -> Tuple[int, int]:
+    # returns how many plain tail calls and accumulator calls became jumps
+    cfgs = cfgs if cfgs is not None else build_cfgs(tac)
+    tail_calls, accumulated = 0, 0
+    for cfg in cfgs.values():
+        eliminator = TailRecursionEliminator(cfg)
+        eliminator.run()
+        tail_calls += eliminator.tail_call_count
+        accumulated += eliminator.accumulator_count
+
+    write_back_cfgs(tac, cfgs)
+
+    return tail_calls, accumulated
@@ -0,0 +1,400 @@
+from ir.ir_cfg import *
+from ir.ir_loops import get_def_sites, get_use_sites, find_basic_induction_variables
+from ir.ir_tacvm import run_alu
+from ir.ir_tacvm_memory import wrap_value
+from dataclasses import fields
+import copy
+
+# unrolling of counted while loops over TAC
+#
+# a counted loop has a header that only compares a basic induction variable against a
+# constant or a register the loop never writes, and leaves the loop from nowhere else.
+# when the induction variable starts at a known constant the trip count is found by
+# stepping the comparison, and loops with few enough iterations are replaced by that many
+# copies of their body with no branches left.
+#
+# other loops get a copy of the body unrolled factor times in front of them. a guard
+# checks that factor more iterations will all run (the induction variable is monotonic,
+# so checking the last one is enough) and the original loop stays behind as the remainder.
+# the guard is repeated at the bottom of the copies, so one branch runs per factor iterations.
+# it compares the induction variable against the bound moved back by factor - 1 steps,
+# rather than stepping the induction variable ahead, which could wrap around. so the bound
+# has to be a known constant that stays in the induction variable's type once moved
+#
+# every copy gets its own temporaries, so a temporary keeps a single definition
+
+comparison_ops = {"eq", "lt", "lte", "gt", "gte"}
+# op with its operands swapped
+swapped_ops = { "lt": "gt", "lte": "gte", "gt": "lt", "gte": "lte", "eq": "eq" }
+# op that holds exactly when op doesn't
+negated_ops = { "lt": "gte", "lte": "gt", "gt": "lte", "gte": "lt" }
+
+@dataclass
+class UnrollReport:
+    fully_unrolled: List[Tuple[str, str, int]] # (function, loop header, trip count)
+    partially_unrolled: List[Tuple[str, str, int]] # (function, loop header, factor)
+    skipped: List[Tuple[str, str, str]] # (function, loop header, reason)
+
+    def __str__(self) -> str:
+        lines = [f"fully unrolled {len(self.fully_unrolled)} loops, partially unrolled {len(self.partially_unrolled)}"]
+        for fun_name, header, trips in self.fully_unrolled:
+            lines.append(f"  {fun_name} {header}: {trips} iterations, no branches left")
+        for fun_name, header, factor in self.partially_unrolled:
+            lines.append(f"  {fun_name} {header}: by {factor}, one branch per {factor} iterations")
+        for fun_name, header, reason in self.skipped:
+            lines.append(f"  skipped {fun_name} {header}: {reason}")
+
+        return '\n'.join(lines)
+
+@dataclass
+class CountedLoop:
+    loop: Loop
+    body_entry: BasicBlock
+    exit: BasicBlock
+    compare: Arithmetic
+    iv: VirtualRegister
+    step: int
+    bound: object
+    # the loop keeps going while the comparison is true, rather than while it's false
+    continue_when_true: bool
+
+    def get_body_blocks(self) -> List[BasicBlock]:
+        return sorted(self.loop.blocks - { self.loop.header }, key=lambda b: b.layout_idx)
+
+    def get_body_size(self) -> int:
+        return sum(len(block.instructions) for block in self.get_body_blocks())
+
+    def keeps_going(self, iv_val: int, bound_val: int) -> bool:
+        left, right = (iv_val, bound_val) if self.compare.left is self.iv else (bound_val, iv_val)
+        return bool(run_alu(self.compare.op, left, right)) == self.continue_when_true
+
+    def is_monotonic(self) -> bool:
+        # whether the condition failing at some iteration means it fails at every later one
+        op = self.compare.op if self.compare.left is self.iv else swapped_ops[self.compare.op]
+        if not self.continue_when_true:
+            op = negated_ops.get(op)
+
+        if op in ["lt", "lte"]:
+            return self.step > 0
+        elif op in ["gt", "gte"]:
+            return self.step < 0
+        return False
+
+class LoopUnroller:
+    def __init__(self, cfg: FunctionCFG, factor: int = 4, max_full_trips: int = 16, max_unrolled_size: int = 64) -> None:
+        self.cfg = cfg
+        self.tac = cfg.tac
+        # partially unrolled loops run this many iterations per trip through the guard
+        self.factor = factor
+        # loops with more iterations than this are never fully unrolled
+        self.max_full_trips = max_full_trips
+        # no loop's body is copied into more instructions than this
+        self.max_unrolled_size = max_unrolled_size
+
+        self.report = UnrollReport([], [], [])
+
+    def get_loop_name(self, loop: Loop) -> str:
+        return loop.header.labels[0] if loop.header.labels else f"block {loop.header.layout_idx}"
+
+    def find_counted_loop(self, loop: Loop) -> CountedLoop | str:
+        # returns why the loop isn't counted when it isn't
+        header = loop.header
+        branch = header.get_branch()
+        if not branch or len(header.instructions) != 2:
+            return "header does more than compare"
+
+        compare = header.instructions[0]
+        if not isinstance(compare, Arithmetic) or not compare.op in comparison_ops or compare.dest != branch.cond:
+            return "header does more than compare"
+
+        if any(exit_block is not header for exit_block, _ in loop.get_exits()):
+            return "leaves the loop from the body"
+        if any(other.header in loop.blocks for other in self.cfg.find_loops() if other is not loop and other.header is not header):
+            return "has inner loops"
+
+        body_blocks = [block for block in loop.blocks if block is not header]
+        if any(isinstance(ins, Pop) for block in body_blocks for ins in block.instructions):
+            return "pops from the stack"
+
+        loop_def_sites = get_def_sites(sorted(loop.blocks, key=lambda b: b.layout_idx))
+        ivs = find_basic_induction_variables(loop_def_sites)
+
+        iv, bound = compare.left, compare.right
+        if not isinstance(iv, VirtualRegister) or not iv.register_idx in ivs:
+            iv, bound = bound, iv
+        if not isinstance(iv, VirtualRegister) or not iv.register_idx in ivs:
+            return "no induction variable in the condition"
+
+        if isinstance(bound, VirtualRegister):
+            if bound.register_idx in loop_def_sites:
+                return "bound changes in the loop"
+        elif not isinstance(bound, int) or isinstance(bound, bool):
+            return "bound isn't an integer"
+
+        # every iteration has to update the induction variable exactly once
+        _, step, update_ins = ivs[iv.register_idx]
+        update_block = next(block for block, ins in loop_def_sites[iv.register_idx] if ins is update_ins)
+        if not all(self.cfg.dominates(update_block, latch) for latch in loop.latches):
+            return "induction variable isn't updated every iteration"
+
+        # the comparison's result goes nowhere but the branch
+        use_sites = get_use_sites(self.cfg.blocks)
+        if len(use_sites.get(compare.dest.register_idx, [])) != 1:
+            return "comparison is used elsewhere"
+
+        body_entry, exit = (header.branch_block, header.next_block) if header.branch_block in loop.blocks \
+            else (header.next_block, header.branch_block)
+        continue_when_true = (header.branch_block in loop.blocks) == isinstance(branch, JumpIf)
+
+        return CountedLoop(loop, body_entry, exit, compare, iv, step, bound, continue_when_true)
+
+    def get_entering_block(self, loop: Loop) -> BasicBlock | None:
+        outside_preds = [pred for pred in loop.header.preds if not pred in loop.blocks]
+        return outside_preds[0] if len(outside_preds) == 1 else None
+
+    def find_constant_value(self, reg: VirtualRegister, block: BasicBlock) -> int | None:
+        # the constant reg holds at the end of block, found by walking back while each
+        # block has a single predecessor
+        visited = set()
+        while block is not None and not block in visited:
+            visited.add(block)
+            for ins in reversed(block.instructions):
+                if any(d.register_idx == reg.register_idx for d in get_defs(ins)):
+                    if isinstance(ins, Move) and isinstance(ins.src, int) and not isinstance(ins.src, bool):
+                        return ins.src
+                    return None
+
+            block = block.preds[0] if len(block.preds) == 1 else None
+
+        return None
+
+    def get_trip_count(self, counted: CountedLoop) -> int | None:
+        # None when it's unknown or more than max_full_trips
+        entering = self.get_entering_block(counted.loop)
+        if entering is None:
+            return None
+
+        iv_val = self.find_constant_value(counted.iv, entering)
+        bound_val = counted.bound if isinstance(counted.bound, int) else self.find_constant_value(counted.bound, entering)
+        if iv_val is None or bound_val is None:
+            return None
+
+        trips = 0
+        while counted.keeps_going(iv_val, bound_val):
+            if trips == self.max_full_trips:
+                return None
+            iv_val += counted.step
+            trips += 1
+
+        return trips
+
+    def redirect(self, pred: BasicBlock, old: BasicBlock, new: BasicBlock):
+        if pred.next_block is old:
+            pred.next_block = new
+        if pred.branch_block is old:
+            pred.branch_block = new
+            pred.get_branch().dest = self.cfg.get_block_label(new)
+
+    def get_renamable_temps(self, body_blocks: List[BasicBlock]) -> Set[int]:
+        # temporaries defined once in the body before all of their uses, which are in the
+        # body too. anything else might carry a value from one iteration into the next
+        body_set = set(body_blocks)
+        def_sites = get_def_sites(self.cfg.blocks)
+        use_sites = get_use_sites(self.cfg.blocks)
+
+        renamable = set()
+        for reg_idx, sites in def_sites.items():
+            if len(sites) != 1 or not sites[0][0] in body_set:
+                continue
+
+            def_block, def_ins = sites[0]
+            if any(reg.register_idx == reg_idx and reg.bound_ir_var is not None for reg in get_defs(def_ins)):
+                continue
+
+            def_idx = find_instruction(def_block.instructions, def_ins)
+            uses = use_sites.get(reg_idx, [])
+            if all(use_block in body_set and self.cfg.dominates(def_block, use_block) and
+                   (use_block is not def_block or def_idx < find_instruction(use_block.instructions, use_ins))
+                   for use_block, use_ins in uses):
+                renamable.add(reg_idx)
+
+        return renamable
+
+    def clone_body(self, counted: CountedLoop, continue_to: BasicBlock) -> List[BasicBlock]:
+        # copies the body blocks with fresh temporaries. edges back to the header go to
+        # continue_to instead. the first block returned is the copy of the body entry
+        body_blocks = counted.get_body_blocks()
+        body_blocks.remove(counted.body_entry)
+        body_blocks.insert(0, counted.body_entry)
+
+        renamed = self.get_renamable_temps(body_blocks)
+        reg_map: Dict[int, VirtualRegister] = {}
+
+        def clone_operand(operand: object) -> object:
+            if isinstance(operand, VirtualRegister):
+                if not operand.register_idx in renamed:
+                    return operand
+                if not operand.register_idx in reg_map:
+                    reg_map[operand.register_idx] = self.tac.get_next_virt_register(val_type=operand.val_type)
+                return reg_map[operand.register_idx]
+            elif isinstance(operand, MemoryLocation) and isinstance(operand.location, VirtualRegister):
+                location = clone_operand(operand.location)
+                return operand if location is operand.location else MemoryLocation(location, operand.offset)
+            elif isinstance(operand, list):
+                return [clone_operand(x) for x in operand]
+
+            return operand
+
+        block_map: Dict[BasicBlock, BasicBlock] = {}
+        for block in body_blocks:
+            instructions = []
+            for ins in block.instructions:
+                new_ins = copy.copy(ins)
+                for f in fields(ins):
+                    setattr(new_ins, f.name, clone_operand(getattr(ins, f.name)))
+                instructions.append(new_ins)
+
+            block_map[block] = BasicBlock([], instructions)
+
+        def clone_succ(succ: BasicBlock | None) -> BasicBlock | None:
+            if succ is counted.loop.header:
+                return continue_to
+            return block_map.get(succ, succ)
+
+        for block, new_block in block_map.items():
+            new_block.next_block = clone_succ(block.next_block)
+            if block.branch_block is not None:
+                new_block.branch_block = clone_succ(block.branch_block)
+                new_block.get_branch().dest = self.cfg.get_block_label(new_block.branch_block)
+
+        return [block_map[block] for block in body_blocks]
+
+    def insert_blocks(self, blocks: List[BasicBlock], before: BasicBlock):
+        idx = self.cfg.blocks.index(before)
+        self.cfg.blocks[idx:idx] = blocks
+
+    def unroll_fully(self, counted: CountedLoop, trips: int):
+        loop = counted.loop
+        entering = self.get_entering_block(loop)
+        first_body = counted.get_body_blocks()[0]
+
+        # copies are made back to front so each knows the copy it continues to
+        copies: List[List[BasicBlock]] = []
+        continue_to = counted.exit
+        for _ in range(trips):
+            copies.insert(0, self.clone_body(counted, continue_to))
+            continue_to = copies[0][0]
+
+        self.redirect(entering, loop.header, continue_to)
+        self.insert_blocks([block for blocks in copies for block in blocks], first_body)
+        self.cfg.remove_blocks(loop.blocks)
+
+    def get_guard_bound(self, counted: CountedLoop) -> int | None:
+        # the bound the induction variable is compared against to check factor iterations
+        # ahead, None when it isn't a known constant or doesn't fit the induction variable
+        bound_val = counted.bound
+        if isinstance(bound_val, VirtualRegister):
+            entering = self.get_entering_block(counted.loop)
+            bound_val = self.find_constant_value(bound_val, entering) if entering is not None else None
+        if bound_val is None:
+            return None
+
+        guard_bound = bound_val - (self.factor - 1) * counted.step
+        if wrap_value(guard_bound, counted.iv.val_type) != guard_bound:
+            return None
+        return guard_bound
+
+    def make_guard(self, counted: CountedLoop, guard_bound: int, keep_going: bool, target: BasicBlock) -> BasicBlock:
+        # a block that branches to target when the next factor iterations all run (or when
+        # they don't, with keep_going False)
+        compare = counted.compare
+        cond = self.tac.get_next_virt_register(val_type=compare.dest.val_type)
+        left, right = (counted.iv, guard_bound) if compare.left is counted.iv else (guard_bound, counted.iv)
+
+        jump_if_true = keep_going == counted.continue_when_true
+        branch_type = JumpIf if jump_if_true else JumpIfNot
+        guard = BasicBlock([], [Arithmetic(cond, compare.op, left, right),
+                                branch_type(self.cfg.get_block_label(target), cond)])
+        guard.branch_block = target
+
+        return guard
+
+    def unroll_by_factor(self, counted: CountedLoop, guard_bound: int) -> BasicBlock:
+        loop = counted.loop
+        header = loop.header
+        first_body = counted.get_body_blocks()[0]
+
+        # entering -> top guard -> copies -> bottom guard -> back to the first copy or
+        # on to the original loop, which runs whatever is left
+        bottom_guard = BasicBlock([], [])
+        copies: List[List[BasicBlock]] = []
+        continue_to = bottom_guard
+        for _ in range(self.factor):
+            copies.insert(0, self.clone_body(counted, continue_to))
+            continue_to = copies[0][0]
+
+        top_guard = self.make_guard(counted, guard_bound, False, header)
+        top_guard.next_block = copies[0][0]
+        filled = self.make_guard(counted, guard_bound, True, copies[0][0])
+        bottom_guard.instructions = filled.instructions
+        bottom_guard.branch_block = filled.branch_block
+        bottom_guard.next_block = header
+
+        for pred in [pred for pred in header.preds if not pred in loop.blocks]:
+            self.redirect(pred, header, top_guard)
+
+        self.insert_blocks([top_guard] + [block for blocks in copies for block in blocks] + [bottom_guard], first_body)
+        self.cfg.compute_edges()
+
+        # header of the unrolled loop
+        return copies[0][0]
+
+    def run(self):
+        # loops are found again after each unroll since blocks were replaced
+        done_headers = set()
+        while True:
+            loops = [loop for loop in self.cfg.find_loops() if not loop.header in done_headers]
+            if not loops:
+                break
+
+            loop = loops[0]
+            done_headers.add(loop.header)
+            loop_name = self.get_loop_name(loop)
+
+            counted = self.find_counted_loop(loop)
+            if isinstance(counted, str):
+                self.report.skipped.append((self.cfg.fun_name, loop_name, counted))
+                continue
+
+            body_size = counted.get_body_size()
+            trips = self.get_trip_count(counted)
+            if trips is not None and trips * body_size <= self.max_unrolled_size:
+                self.unroll_fully(counted, trips)
+                self.report.fully_unrolled.append((self.cfg.fun_name, loop_name, trips))
+            elif self.factor < 2:
+                self.report.skipped.append((self.cfg.fun_name, loop_name, "unroll factor below 2"))
+            elif body_size * self.factor > self.max_unrolled_size:
+                self.report.skipped.append((self.cfg.fun_name, loop_name, "body too large"))
+            elif not counted.is_monotonic():
+                self.report.skipped.append((self.cfg.fun_name, loop_name, "condition can't be checked ahead"))
+            elif (guard_bound := self.get_guard_bound(counted)) is None:
+                self.report.skipped.append((self.cfg.fun_name, loop_name, "bound isn't a constant the guard can move"))
+            else:
+                done_headers.add(self.unroll_by_factor(counted, guard_bound))
+                self.report.partially_unrolled.append((self.cfg.fun_name, loop_name, self.factor))
+
+        self.cfg.remove_dead_labels()
+
+def unroll_loops(tac: TAC, cfgs: Dict[str, FunctionCFG] = None, factor: int = 4, max_full_trips: int = 16, max_unrolled_size: int = 64) -> UnrollReport:
+    cfgs = cfgs if cfgs is not None else build_cfgs(tac)
+    report = UnrollReport([], [], [])
+    for cfg in cfgs.values():
+        unroller = LoopUnroller(cfg, factor, max_full_trips, max_unrolled_size)
+        unroller.run()
+        report.fully_unrolled += unroller.report.fully_unrolled
+        report.partially_unrolled += unroller.report.partially_unrolled
+        report.skipped += unroller.report.skipped
+
+    write_back_cfgs(tac, cfgs)
+
+    return report
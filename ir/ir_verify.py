@@ -0,0 +1,83 @@
+from ir.ir_cfg import *
+
+# structural checks on TAC, run between passes in debug mode. every problem is an
+# assertion naming the offending instruction
+
+def verify_register(tac: TAC, reg: VirtualRegister, where: str):
+    assert reg.register_idx is not None, f"{where}: register {reg} has no index"
+    assert 0 <= reg.register_idx < tac.variable_idx, f"{where}: register {reg} out of range ({tac.variable_idx} registers)"
+    assert reg.register_name == f"t{reg.register_idx}", f"{where}: register {reg} has index {reg.register_idx}"
+
+def verify_label(tac: TAC, label: object, where: str, fun_range: Tuple[int, int] = None):
+    assert isinstance(label, Label), f"{where}: target {label} is not a resolved label"
+    assert tac.labels.get(label.name) is label, f"{where}: label {label} is not the shared Label object"
+    assert label.name in tac.label_to_ins_idx, f"{where}: label {label} is never placed"
+    assert label.ins_idx == tac.label_to_ins_idx[label.name], f"{where}: label {label} resolved to a stale index"
+
+    if fun_range:
+        start, end = fun_range
+        # a label at the end of a function shares its index with the next function
+        assert start <= label.ins_idx <= end, f"{where}: jump to {label} leaves the function"
+
+def verify_tac(tac: TAC):
+    code_len = len(tac.ir_code)
+    assert tac.instruction_idx == code_len, f"instruction_idx {tac.instruction_idx} != {code_len} instructions"
+
+    for label, ins_idx in tac.label_to_ins_idx.items():
+        assert 0 <= ins_idx <= code_len, f"label {label} placed at {ins_idx}, past the end"
+
+    for fun_name, local_vars in tac.fun_name_to_locals.items():
+        assert fun_name in tac.label_to_ins_idx, f"function {fun_name} has no label"
+        for var_ir_name in local_vars:
+            assert var_ir_name in tac.variable_to_location, f"{fun_name}: local {var_ir_name} has no location"
+
+    ranges = get_function_ranges(tac)
+    covered = 0
+    for fun_name, (start, end) in ranges.items():
+        assert start == covered, f"instructions {covered}..{start} belong to no function"
+        covered = end
+
+        if start < end:
+            assert isinstance(tac.ir_code[start], Params), f"{fun_name}: does not start with params"
+
+        for ins_idx in range(start, end):
+            ins = tac.ir_code[ins_idx]
+            where = f"{fun_name}+{ins_idx - start} ({ins})"
+            assert isinstance(ins, TACInstruction), f"{where}: not an instruction"
+
+            if isinstance(ins, Params):
+                assert ins_idx == start, f"{where}: params in the middle of a function"
+            elif isinstance(ins, Jump | JumpIf | JumpIfNot):
+                verify_label(tac, ins.dest, where, (start, end))
+            elif isinstance(ins, Call):
+                verify_label(tac, ins.target, where)
+                assert ins.target.name in tac.fun_name_to_locals, f"{where}: call to unknown function {ins.target}"
+
+            for reg in get_defs(ins) + get_uses(ins):
+                verify_register(tac, reg, where)
+
+    assert covered == code_len, f"instructions {covered}..{code_len} belong to no function"
+
+def verify_cfgs(tac: TAC, cfgs: Dict[str, FunctionCFG]):
+    # a cached cfg has to cover exactly the instructions of its function, jumps aside since
+    # blocks keep those as edges, and its branches have to go where their labels are
+    ranges = get_function_ranges(tac)
+    assert list(cfgs) == list(ranges), f"cfgs for {list(cfgs)}, functions are {list(ranges)}"
+
+    for fun_name, (start, end) in ranges.items():
+        cfg = cfgs[fun_name]
+        code = [ins for ins in tac.ir_code[start:end] if not (isinstance(ins, Jump) and isinstance(ins.dest, Label))]
+        block_code = cfg.get_instructions()
+        assert len(code) == len(block_code), f"{fun_name}: {len(block_code)} instructions in blocks, {len(code)} in the code"
+        for ins, block_ins in zip(code, block_code):
+            assert ins is block_ins, f"{fun_name}: block has {block_ins} where the code has {ins}"
+
+        for block in cfg.blocks:
+            branch = block.get_branch()
+            if branch:
+                assert block.branch_block is not None and str(branch.dest) in block.branch_block.labels, \
+                    f"{fun_name}: {branch} doesn't lead to its branch block"
+
+def verify_call_graph(tac: TAC, call_graph: Dict[str, Set[str]]):
+    actual = get_call_graph(tac)
+    assert call_graph == actual, f"cached call graph {call_graph}, code calls {actual}"
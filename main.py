@@ -3,22 +3,72 @@ from c_ast.parse import Parser, LiteralNode
 from c_ast.semantics import Checker
 from ir.ir_tac import TAC
 from ir.ir_tacvm import TACVM
+from ir.ir_passes import get_default_pass_manager
+from ir.ir_parallel import compile_functions
 from cgen.x86_cgen import X86VirtCodeGen
+from cgen.x86_regalloc import allocate_registers
+from cgen.x86_isel import X86InstructionSelector
+import sys
 
 if __name__ == "__main__":
     import argparse
+    pass_manager = get_default_pass_manager()
+
     argp = argparse.ArgumentParser(prog="pyplandc", description="A C compiler written in Python")
     argp.add_argument("-i", "--input_file", type=str, default="/dev/stdin")
     argp.add_argument("-o", "--output_file", type=str, default="/dev/stdout")
+    argp.add_argument("-p", "--passes", type=str, nargs="*", default=[], choices=pass_manager.get_optimization_names(),
+                      help="passes to run, in order. AST passes always run before TAC ones")
+    argp.add_argument("--emit", type=str, default="x86", choices=["x86", "tac"])
+    argp.add_argument("--time-passes", action="store_true", help="print per pass time, peak memory and ir size to stderr")
+    argp.add_argument("--verify-ir", action="store_true", help="check the TAC after every pass")
+    argp.add_argument("--regalloc", action="store_true",
+                      help="keep variables in registers picked by linear scan instead of on the stack")
+    argp.add_argument("--x86-from", type=str, default="ast", choices=["ast", "tac"],
+                      help="generate x86 from the typed AST, or select it from the TAC after the TAC passes (always register allocated)")
+    argp.add_argument("-j", "--jobs", type=int, default=None,
+                      help="lower, optimize and generate code for functions in this many processes")
 
     opt = argp.parse_args()
+    pass_manager.verify = opt.verify_ir
+    pass_manager.track_memory = opt.time_passes
+
     with open(opt.input_file, 'r') as f:
         source_file = f.read()
 
-    result = Parser(Lexer(source_file).tokenize(), source_file).parse()
-    Checker().check_source_file(result)
-    x86 = X86VirtCodeGen()
-    x86.x86_source_file(result)
+    pass_manager.ast = pass_manager.timed("parse", lambda: Parser(Lexer(source_file).tokenize(), source_file).parse(), "ast")
+    pass_manager.run_pass("check")
+
+    ast_passes = [name for name in opt.passes if pass_manager.passes[name].ir == "ast"]
+    tac_passes = [name for name in opt.passes if pass_manager.passes[name].ir == "tac"]
+    pass_manager.run(ast_passes)
+
+    x86_from_ast = opt.emit == "x86" and opt.x86_from == "ast"
+    x86 = None
+    if opt.jobs is not None:
+        assert opt.jobs >= 1, "need at least one job"
+        x86 = compile_functions(pass_manager, tac_passes, opt.jobs,
+                                emit_tac=not x86_from_ast or bool(tac_passes), emit_x86=x86_from_ast,
+                                use_virt_regs=opt.regalloc)
+    elif not x86_from_ast or tac_passes:
+        pass_manager.lower_to_tac()
+        pass_manager.run(tac_passes)
+
+    if opt.emit == "tac":
+        output = pass_manager.tac.pretty_tac_ir()
+    else:
+        if not x86_from_ast:
+            x86 = X86InstructionSelector(pass_manager.tac)
+            pass_manager.timed("x86_isel", x86.x86_tac)
+        elif x86 is None:
+            x86 = X86VirtCodeGen(use_virt_regs=opt.regalloc)
+            pass_manager.timed("x86_gen", lambda: x86.x86_source_file(pass_manager.ast), "ast")
+        if opt.regalloc or not x86_from_ast:
+            pass_manager.timed("regalloc", lambda: allocate_registers(x86), "ast")
+        output = x86.pretty_x86()
+
+    if opt.time_passes:
+        print(pass_manager.pretty_stats(), file=sys.stderr)
 
     with open(opt.output_file, 'w') as f:
-        f.write(x86.pretty_x86() + '\n')
\ No newline at end of file
+        f.write(output + '\n')